@@ -1,18 +1,49 @@
-from flask import Flask, render_template, request, jsonify, session, send_from_directory
+from flask import Flask, render_template, request, jsonify, session, send_file, Response, stream_with_context, g, abort
+from werkzeug.security import safe_join
+from werkzeug.formparser import parse_form_data
+from werkzeug.exceptions import RequestEntityTooLarge
 from flask_cors import CORS
-from instagrapi import Client
-import google.generativeai as genai
 import os
+import sys
+import signal
 import json
 import re
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta
 import uuid
+import random
+from urllib.parse import urlparse
 from pathlib import Path
 import secrets
 from dotenv import load_dotenv
 from apscheduler.schedulers.background import BackgroundScheduler
+from PIL import Image, ImageOps
 import threading
+import time
+import heapq
+import atexit
+from contextlib import contextmanager
+from collections import OrderedDict
+import bisect
+import sqlite3
+import socket
+import base64
+import hashlib
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+import itertools
+import mimetypes
+import csv
+import io
+from typing import TYPE_CHECKING
+
+# instagrapi и google.generativeai импортируются при первом использовании:
+# вместе они занимают большую часть времени импорта app.py
+if TYPE_CHECKING:
+    from instagrapi import Client
 
 load_dotenv()
 
@@ -20,7 +51,7 @@ app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', secrets.token_hex(32))
 CORS(app)
 
-# Создаем необходимые директории
+# Папки данных (создаются в init_storage() при запуске приложения)
 BASE_DIR = Path(__file__).parent
 DATA_DIR = BASE_DIR / 'data'
 PHOTOS_DIR = DATA_DIR / 'photos'
@@ -29,9 +60,6 @@ SESSION_DIR = DATA_DIR / 'session'
 POSTS_DIR = DATA_DIR / 'posts'
 SCHEDULED_DIR = DATA_DIR / 'scheduled'
 
-for directory in [DATA_DIR, PHOTOS_DIR, VIDEOS_DIR, SESSION_DIR, POSTS_DIR, SCHEDULED_DIR]:
-    directory.mkdir(exist_ok=True)
-
 # Instagram клиент
 ig_client = None
 
@@ -40,149 +68,2019 @@ def get_session_file(username: str) -> Path:
     safe_username = re.sub(r'[^A-Za-z0-9_.-]+', '_', username or '')
     return SESSION_DIR / f'{safe_username}.json'
 
-def load_client_for_username(username: str) -> Client:
+def load_client_for_username(username: str) -> 'Client':
+    from instagrapi import Client
+    
     client = Client()
     session_file = get_session_file(username)
     if session_file.exists():
         client.load_settings(session_file)
     return client
 
-# Gemini клиент
+# Кэш готовых клиентов по username
+IG_CLIENT_CACHE_SIZE = int(os.getenv('IG_CLIENT_CACHE_SIZE', '16'))
+IG_CLIENT_CACHE_TTL = int(os.getenv('IG_CLIENT_CACHE_TTL', '3600'))
+
+class InstagramClientCache:
+    """
+    LRU/TTL кэш instagrapi Client по username.
+    
+    Клиент создается и читает файл сессии один раз, а не на каждую
+    публикацию. Изменившиеся настройки (cookies) записываются обратно
+    в файл сессии лениво: при вытеснении, истечении TTL и периодически.
+    Публикации в один аккаунт сериализуются через account_lock().
+    """
+    
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # username -> (client, created_at)
+        self._account_locks = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'builds': 0, 'build_time_total': 0.0, 'writebacks': 0}
+    
+    def account_lock(self, username: str) -> threading.RLock:
+        """Блокировка аккаунта: одновременно только одна операция с клиентом"""
+        with self._lock:
+            lock = self._account_locks.get(username)
+            if lock is None:
+                lock = self._account_locks[username] = threading.RLock()
+            return lock
+    
+    def get(self, username: str) -> 'Client':
+        expired = None
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry and time.monotonic() - entry[1] < self.ttl:
+                self._entries.move_to_end(username)
+                self._stats['hits'] += 1
+                return entry[0]
+            if entry:
+                expired = self._entries.pop(username)[0]
+            self._stats['misses'] += 1
+        
+        if expired is not None:
+            self._write_back(username, expired)
+        
+        started = time.perf_counter()
+        client = load_client_for_username(username)
+        with self._lock:
+            self._stats['builds'] += 1
+            self._stats['build_time_total'] += time.perf_counter() - started
+        self.put(username, client)
+        return client
+    
+    def put(self, username: str, client: 'Client'):
+        evicted = []
+        with self._lock:
+            self._entries[username] = (client, time.monotonic())
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                evicted.append(self._entries.popitem(last=False))
+                self._stats['evictions'] += 1
+        for evicted_username, (evicted_client, _) in evicted:
+            self._write_back(evicted_username, evicted_client)
+    
+    def mark_dirty(self, username: str):
+        """Отмечает, что настройки клиента изменились и их нужно сохранить"""
+        with self._lock:
+            self._dirty.add(username)
+    
+    def _write_back(self, username: str, client: 'Client'):
+        with self._lock:
+            if username not in self._dirty:
+                return
+            self._dirty.discard(username)
+        try:
+            client.dump_settings(get_session_file(username))
+            with self._lock:
+                self._stats['writebacks'] += 1
+        except Exception as e:
+            print(f"❌ Ошибка сохранения сессии {username}: {e}")
+    
+    def flush(self):
+        """Сохраняет настройки всех измененных клиентов в файлы сессий"""
+        with self._lock:
+            dirty = [(username, self._entries[username][0]) for username in self._dirty if username in self._entries]
+        for username, client in dirty:
+            with self.account_lock(username):
+                self._write_back(username, client)
+    
+    def invalidate(self, username: str):
+        with self._lock:
+            entry = self._entries.pop(username, None)
+        if entry:
+            self._write_back(username, entry[0])
+    
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+            stats['dirty'] = len(self._dirty)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else None
+        stats['avg_build_time'] = round(stats['build_time_total'] / stats['builds'], 4) if stats['builds'] else None
+        stats['build_time_total'] = round(stats['build_time_total'], 4)
+        return stats
+
+ig_clients = InstagramClientCache(IG_CLIENT_CACHE_SIZE, IG_CLIENT_CACHE_TTL)
+atexit.register(ig_clients.flush)
+
+# Публикация разделена на загрузку файлов (rupload) и configure. Элементы
+# карусели загружаются параллельно (не больше ALBUM_UPLOAD_WORKERS на аккаунт),
+# запланированные посты загружаются заранее (см. PRESTAGE_LEAD_TIME)
+ALBUM_UPLOAD_WORKERS = int(os.getenv('ALBUM_UPLOAD_WORKERS', '4'))
+# Пауза перед configure, пока Instagram обрабатывает файлы (как в instagrapi)
+CONFIGURE_DELAY = 3
+# Повторы configure, как в instagrapi: (попыток, пауза после "Transcode not finished yet")
+CONFIGURE_RETRIES = {'photo': (10, 0), 'video': (50, 10), 'album': (50, 3)}
+
+upload_id_lock = threading.Lock()
+last_upload_id = 0
+
+def reserve_upload_id() -> str:
+    """
+    Уникальный upload_id для параллельных загрузок.
+    
+    instagrapi берет upload_id из текущего времени в миллисекундах, поэтому
+    у одновременных загрузок он совпадал бы. Каждый вызов получает свою миллисекунду.
+    """
+    global last_upload_id
+    with upload_id_lock:
+        now_ms = int(time.time() * 1000)
+        if now_ms <= last_upload_id:
+            time.sleep((last_upload_id - now_ms + 1) / 1000)
+            now_ms = max(int(time.time() * 1000), last_upload_id + 1)
+        last_upload_id = now_ms
+        return str(now_ms)
+
+def upload_worker_client(client: 'Client') -> 'Client':
+    """
+    Отдельный клиент с той же сессией для параллельной загрузки.
+    
+    instagrapi Client и его requests.Session не потокобезопасны, а ошибки
+    instagrapi читают client.last_json, который перезаписал бы соседний поток.
+    """
+    from instagrapi import Client
+    
+    worker = Client(proxy=getattr(client, 'proxy', None), delay_range=client.delay_range)
+    worker.set_settings(client.get_settings())
+    return worker
+
+def rupload_error_fields(response) -> dict:
+    """Поля ответа для исключения instagrapi - из самого ответа, а не из общего состояния клиента"""
+    try:
+        data = response.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def video_rupload(client: 'Client', path: Path, upload_id: str, to_album: bool = False) -> tuple:
+    """
+    Загрузка видео как в Client.video_rupload из instagrapi, но с заданным upload_id.
+    
+    Client.video_rupload в instagrapi 2.1.5 не принимает upload_id и берет его
+    из текущего времени, поэтому у параллельных элементов карусели он мог
+    совпасть. Файл отправляется потоком, а не читается в память целиком.
+    Возвращает (ширина, высота, длительность, обложка).
+    """
+    from instagrapi import config
+    from instagrapi.exceptions import VideoNotUpload
+    from instagrapi.mixins.video import analyze_video
+    from instagrapi.utils import dumps
+    
+    width, height, duration, thumbnail = analyze_video(path, None)
+    upload_name = f'{upload_id}_0_{random.randint(1000000000, 9999999999)}'
+    rupload_params = {
+        'retry_context': '{"num_step_auto_retry":0,"num_reupload":0,"num_step_manual_retry":0}',
+        'media_type': '2',
+        'xsharing_user_ids': dumps([client.user_id]),
+        'upload_id': upload_id,
+        'upload_media_duration_ms': str(int(duration * 1000)),
+        'upload_media_width': str(width),
+        'upload_media_height': str(height),
+    }
+    headers = {}
+    if to_album:
+        rupload_params['is_sidecar'] = '1'
+        headers = {'Segment-Start-Offset': '0', 'Segment-Type': '3'}
+    headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'X-Instagram-Rupload-Params': dumps(rupload_params),
+        'X_FB_VIDEO_WATERFALL_ID': str(uuid.uuid4()),
+    })
+    url = f'https://{config.API_DOMAIN}/rupload_igvideo/{upload_name}'
+    
+    response = client.private.get(url, headers=headers)
+    if response.status_code != 200:
+        raise VideoNotUpload(response.text, response=response, **rupload_error_fields(response))
+    
+    video_len = str(path.stat().st_size)
+    with open(path, 'rb') as fp:
+        response = client.private.post(url, data=fp, headers={
+            'Offset': '0',
+            'X-Entity-Name': upload_name,
+            'X-Entity-Length': video_len,
+            'Content-Type': 'application/octet-stream',
+            'Content-Length': video_len,
+            'X-Entity-Type': 'video/mp4',
+            **headers
+        })
+    if response.status_code != 200:
+        raise VideoNotUpload(response.text, response=response, **rupload_error_fields(response))
+    return width, height, duration, Path(thumbnail)
+
+class AlbumUploadProgress:
+    """Ход загрузки элементов карусели по аккаунтам (последняя публикация каждого аккаунта)"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._albums = {}
+    
+    def start(self, username: str, paths: list, staged: bool = False):
+        """staged=True - элементы загружены заранее, осталось опубликовать"""
+        with self._lock:
+            self._albums[username] = {
+                'status': 'uploading',
+                'started': datetime.now().isoformat(),
+                'children': [{'file': Path(path).name, 'status': 'staged' if staged else 'queued',
+                              'size': os.path.getsize(path)} for path in paths]
+            }
+    
+    def update_child(self, username: str, index: int, status: str, **fields):
+        with self._lock:
+            child = self._albums[username]['children'][index]
+            child['status'] = status
+            child.update(fields)
+            return sum(1 for item in self._albums[username]['children'] if item['status'] == 'uploaded')
+    
+    def set_status(self, username: str, status: str, error: str = None):
+        with self._lock:
+            album = self._albums[username]
+            album.update({'status': status, 'error': error})
+            if status in ('published', 'failed'):
+                album['finished'] = datetime.now().isoformat()
+    
+    def get(self, username: str):
+        with self._lock:
+            album = self._albums.get(username)
+            return json.loads(json.dumps(album)) if album else None
+
+album_progress = AlbumUploadProgress()
+
+def upload_media_item(client: 'Client', path: Path, to_album: bool) -> dict:
+    """Загружает один файл без публикации, возвращает upload_id и параметры для configure"""
+    suffix = path.suffix.lower()
+    if suffix in ('.jpg', '.jpeg', '.webp'):
+        with track_external('instagram', 'photo_rupload'):
+            upload_id, width, height = client.photo_rupload(path, upload_id=reserve_upload_id(), to_album=to_album)
+        return {'type': 'photo', 'upload_id': upload_id, 'width': width, 'height': height}
+    if suffix == '.mp4':
+        upload_id = reserve_upload_id()
+        with track_external('instagram', 'video_rupload'):
+            width, height, duration, thumbnail = video_rupload(client, path, upload_id, to_album=to_album)
+            # Обложку элемента карусели загружаем сразу, одиночного видео - загрузит video_configure
+            if to_album:
+                client.photo_rupload(thumbnail, upload_id)
+        return {'type': 'video', 'upload_id': upload_id, 'width': width, 'height': height,
+                'duration': duration, 'thumbnail': str(thumbnail)}
+    raise ValueError(f'Неподдерживаемый формат файла: {path.name}')
+
+def upload_media_items(client: 'Client', username: str, paths: list, track_progress: bool = True) -> list:
+    """
+    Загружает файлы поста параллельно, возвращает их описания в исходном порядке.
+    
+    Время загрузки карусели близко к самому долгому элементу, а не к сумме.
+    Каждый элемент загружается своим клиентом (см. upload_worker_client).
+    При ошибке одного элемента еще не начатые загрузки отменяются, а ошибка
+    возвращается сразу, не дожидаясь уже идущих загрузок.
+    """
+    to_album = len(paths) > 1
+    track_progress = track_progress and to_album
+    if track_progress:
+        album_progress.start(username, paths)
+    
+    def upload(index: int, path: Path) -> dict:
+        if track_progress:
+            album_progress.update_child(username, index, 'uploading')
+        started = time.perf_counter()
+        try:
+            item = upload_media_item(upload_worker_client(client) if to_album else client, path, to_album)
+        except Exception as e:
+            if track_progress:
+                album_progress.update_child(username, index, 'failed', error=str(e))
+            raise
+        elapsed = round(time.perf_counter() - started, 2)
+        if track_progress:
+            uploaded = album_progress.update_child(username, index, 'uploaded', upload_id=item['upload_id'], elapsed=elapsed)
+            print(f"📤 {username}: загружено {uploaded}/{len(paths)} ({path.name}, {elapsed} с)")
+        return item
+    
+    if not to_album:
+        items = [upload(0, Path(paths[0]))]
+        EXTERNAL_BYTES.inc(os.path.getsize(paths[0]), service='instagram', direction='up')
+        return items
+    
+    items = [None] * len(paths)
+    workers = max(1, min(ALBUM_UPLOAD_WORKERS, len(paths)))
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='media-upload')
+    futures = {pool.submit(upload, index, Path(path)): index for index, path in enumerate(paths)}
+    try:
+        for future in as_completed(futures):
+            items[futures[future]] = future.result()
+    except Exception as e:
+        # Уже начатые загрузки идут своими клиентами, их результат просто не используется
+        pool.shutdown(wait=False, cancel_futures=True)
+        if track_progress:
+            album_progress.set_status(username, 'failed', str(e))
+        raise
+    pool.shutdown()
+    EXTERNAL_BYTES.inc(sum(os.path.getsize(path) for path in paths), service='instagram', direction='up')
+    return items
+
+def album_child(item: dict) -> dict:
+    """Описание элемента карусели для album_configure (как в instagrapi album_upload)"""
+    from instagrapi.utils import date_time_original, dumps
+    
+    extra = dumps({'source_width': item['width'], 'source_height': item['height']})
+    if item['type'] == 'photo':
+        return {
+            'upload_id': item['upload_id'],
+            'edits': dumps({'crop_original_size': [item['width'], item['height']], 'crop_center': [0.0, -0.0], 'crop_zoom': 1.0}),
+            'extra': extra,
+            'scene_capture_type': '',
+            'scene_type': None
+        }
+    return {
+        'upload_id': item['upload_id'],
+        'clips': dumps([{'length': item['duration'], 'source_type': '4'}]),
+        'extra': extra,
+        'length': item['duration'],
+        'poster_frame_index': '0',
+        'filter_type': '0',
+        'video_result': '',
+        'date_time_original': date_time_original(time.localtime()),
+        'audio_muted': 'false'
+    }
+
+def configure_media(client: 'Client', username: str, items: list, caption: str):
+    """Публикует загруженные файлы одним configure, повторяя, пока Instagram обрабатывает видео"""
+    from instagrapi.exceptions import AlbumConfigureError, PhotoConfigureError, VideoConfigureError
+    from instagrapi.extractors import extract_media_v1
+    
+    if len(items) > 1:
+        kind, error_class = 'album', AlbumConfigureError
+        children = [album_child(item) for item in items]
+        configure = lambda: client.album_configure(children, caption)
+    elif items[0]['type'] == 'photo':
+        item = items[0]
+        kind, error_class = 'photo', PhotoConfigureError
+        configure = lambda: client.photo_configure(item['upload_id'], item['width'], item['height'], caption)
+    else:
+        item = items[0]
+        kind, error_class = 'video', VideoConfigureError
+        configure = lambda: client.video_configure(item['upload_id'], item['width'], item['height'],
+                                                   item['duration'], Path(item['thumbnail']), caption)
+    
+    track_progress = kind == 'album'
+    if track_progress:
+        album_progress.set_status(username, 'configuring')
+    attempts, transcode_delay = CONFIGURE_RETRIES[kind]
+    for attempt in range(attempts):
+        time.sleep(CONFIGURE_DELAY)
+        try:
+            with track_external('instagram', f'{kind}_configure'):
+                configured = configure()
+        except Exception as e:
+            if 'Transcode not finished yet' in str(e):
+                time.sleep(transcode_delay)
+                continue
+            if track_progress:
+                album_progress.set_status(username, 'failed', str(e))
+            raise
+        if configured:
+            client.expose()
+            if track_progress:
+                album_progress.set_status(username, 'published')
+            return extract_media_v1(configured.get('media'))
+    if track_progress:
+        album_progress.set_status(username, 'failed', f'{kind}_configure не завершился')
+    raise error_class(response=client.last_response, **client.last_json)
+
+def is_stale_upload_error(error: Exception) -> bool:
+    """
+    Instagram не нашел загруженные заранее файлы и просит загрузить их заново.
+    
+    Только в этом случае configure точно не создал пост и повторная загрузка
+    безопасна; остальные ошибки (лимиты, feedback_required, разбор ответа)
+    обрабатывает обычный повтор планировщика.
+    """
+    from instagrapi.exceptions import ClientError
+    
+    return isinstance(error, ClientError) and getattr(error, 'message', '') == 'media_needs_reupload'
+
+def publish_media(username: str, caption: str, photo_paths: list, video_paths: list, load_staged=None):
+    """
+    Публикует пост от имени аккаунта через кэшированный клиент.
+    
+    load_staged - функция, возвращающая заранее загруженные файлы поста
+    (см. PRESTAGE_LEAD_TIME) или None; вызывается под блокировкой аккаунта,
+    чтобы дождаться загрузки, которая идет прямо сейчас.
+    """
+    # Нормализуем фото до захвата блокировки аккаунта
+    photo_paths = prepare_photos_for_publish(photo_paths)
+    # Instagram поддерживает альбомы с миксом фото и видео
+    paths = photo_paths + video_paths
+    with ig_clients.account_lock(username):
+        client = ig_clients.get(username)
+        try:
+            items = load_staged() if load_staged else None
+            if items:
+                if len(items) > 1:
+                    album_progress.start(username, paths, staged=True)
+                try:
+                    media = configure_media(client, username, items, caption)
+                    PRESTAGED_PUBLISHES.inc(result='used')
+                    return media
+                except Exception as e:
+                    if not is_stale_upload_error(e):
+                        raise
+                    # Загрузки устарели - загружаем файлы заново
+                    PRESTAGED_PUBLISHES.inc(result='reuploaded')
+                    print(f"♻️ Заранее загруженные файлы не приняты ({e}), загружаем заново")
+            
+            items = upload_media_items(client, username, paths)
+            return configure_media(client, username, items, caption)
+        finally:
+            # instagrapi обновляет cookies после запросов - сохраним их лениво
+            ig_clients.mark_dirty(username)
+
+# Gemini клиент (настраивается при первом запросе, см. get_gemini_model)
 gemini_api_key = os.getenv('GEMINI_API_KEY')
-if gemini_api_key:
-    genai.configure(api_key=gemini_api_key)
 
 # Segmind API key (for Kling AI)
 segmind_api_key = os.getenv('SEGMIND_API_KEY')
 
+# ==================== METRICS ====================
+
+# Границы корзин гистограмм задержек (секунды): от быстрых API до генерации видео
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class Metric:
+    """Базовая метрика: значения по набору меток"""
+    
+    TYPE = ''
+    
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, '')) for label in self.labelnames)
+    
+    @staticmethod
+    def _escape(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    
+    def _format_labels(self, key: tuple, extra: dict = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{self._escape(value)}"' for name, value in pairs) + '}'
+    
+    def samples(self) -> list:
+        with self._lock:
+            return [f'{self.name}{self._format_labels(key)} {value}' for key, value in self._values.items()]
+    
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.TYPE}']
+        return '\n'.join(lines + self.samples())
+
+class Counter(Metric):
+    TYPE = 'counter'
+    
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """Значение считывается функцией в момент запроса /metrics"""
+    
+    TYPE = 'gauge'
+    
+    def __init__(self, name: str, help_text: str, callback):
+        super().__init__(name, help_text)
+        self.callback = callback
+    
+    def samples(self) -> list:
+        try:
+            return [f'{self.name} {self.callback()}']
+        except Exception as e:
+            print(f"⚠️ Не удалось получить метрику {self.name}: {e}")
+            return []
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state['buckets'][index] += 1
+            state['sum'] += value
+            state['count'] += 1
+    
+    def samples(self) -> list:
+        lines = []
+        with self._lock:
+            for key, state in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, state['buckets']):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": str(bound)})} {cumulative}')
+                lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": "+Inf"})} {state["count"]}')
+                lines.append(f'{self.name}_sum{self._format_labels(key)} {state["sum"]}')
+                lines.append(f'{self.name}_count{self._format_labels(key)} {state["count"]}')
+        return lines
+
+class MetricsRegistry:
+    """Встроенный реестр метрик в формате Prometheus (без внешних зависимостей)"""
+    
+    def __init__(self):
+        self._metrics = []
+    
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+metrics = MetricsRegistry()
+
+# Внешние зависимости: Pollinations, Segmind, Gemini, Instagram
+EXTERNAL_LATENCY = metrics.register(Histogram(
+    'external_request_duration_seconds', 'Длительность запросов к внешним сервисам', ('service', 'operation')))
+EXTERNAL_ERRORS = metrics.register(Counter(
+    'external_request_errors_total', 'Ошибки запросов к внешним сервисам', ('service', 'operation')))
+EXTERNAL_BYTES = metrics.register(Counter(
+    'external_bytes_total', 'Байты, отправленные во внешние сервисы и полученные из них', ('service', 'direction')))
+
+# HTTP маршруты приложения
+ROUTE_LATENCY = metrics.register(Histogram(
+    'http_request_duration_seconds', 'Длительность обработки запросов Flask', ('endpoint', 'method')))
+ROUTE_ERRORS = metrics.register(Counter(
+    'http_request_errors_total', 'Ответы Flask с кодом 5xx', ('endpoint', 'method', 'status')))
+
+# Планировщик автопубликации
+SCHEDULER_TICK = metrics.register(Histogram(
+    'scheduler_tick_duration_seconds', 'Длительность одного прохода планировщика'))
+SCHEDULER_LAG = metrics.register(Histogram(
+    'scheduler_publish_lag_seconds', 'Задержка начала публикации относительно scheduled_time'))
+SCHEDULED_PUBLISHED = metrics.register(Counter(
+    'scheduled_posts_processed_total', 'Обработанные запланированные посты', ('result',)))
+PRESTAGED_PUBLISHES = metrics.register(Counter(
+    'prestaged_publishes_total', 'Публикации с заранее загруженными файлами', ('result',)))
+
+# Имена сервисов для хостов внешних API
+EXTERNAL_SERVICE_NAMES = {
+    'image.pollinations.ai': 'pollinations',
+    'api.segmind.com': 'segmind',
+}
+
+def external_service_name(host: str) -> str:
+    return EXTERNAL_SERVICE_NAMES.get(host, host)
+
+@contextmanager
+def track_external(service: str, operation: str):
+    """Замеряет длительность вызова внешнего сервиса и считает ошибки"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        EXTERNAL_ERRORS.inc(service=service, operation=operation)
+        raise
+    finally:
+        EXTERNAL_LATENCY.observe(time.perf_counter() - started, service=service, operation=operation)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        ROUTE_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        if response.status_code >= 500:
+            ROUTE_ERRORS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# ==================== HTTP CLIENTS ====================
+
+# Общие пулы соединений к внешним API (keep-alive вместо нового TCP+TLS на каждый запрос)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '20'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))
+HTTP_BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', '0.5'))
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', '30'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '180'))
+
+# Таймауты чтения по хостам (генерация на стороне API может идти долго)
+HTTP_HOST_READ_TIMEOUTS = {
+    'image.pollinations.ai': float(os.getenv('POLLINATIONS_TIMEOUT', '180')),
+    'api.segmind.com': float(os.getenv('SEGMIND_TIMEOUT', '450')),
+}
+
+# GET безопасно повторять при любой временной ошибке. POST (платная генерация)
+# повторяем, только если сервер явно отказал в обработке запроса
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_STATUS_CODES_UNSAFE = {429, 503}
+
+class CountingConnectionMixin:
+    """Сообщает адаптеру об открытии и закрытии соединения"""
+    adapter = None
+    
+    def connect(self):
+        super().connect()
+        self.adapter.count_connection('opened')
+    
+    def close(self):
+        was_open = self.sock is not None
+        super().close()
+        if was_open:
+            self.adapter.count_connection('closed')
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter со своими счетчиками соединений.
+    
+    Классы пулов и соединений подменяются через публичные точки расширения
+    urllib3 (pool_classes_by_scheme, ConnectionCls), а не чтением его внутренних структур.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        self._connections = {'opened': 0, 'closed': 0}
+        self._connections_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+    
+    def count_connection(self, key: str):
+        with self._connections_lock:
+            self._connections[key] += 1
+    
+    def connection_stats(self) -> dict:
+        with self._connections_lock:
+            return dict(self._connections)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        pool_classes = {}
+        for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items():
+            connection_cls = type(f'Counting{pool_cls.ConnectionCls.__name__}',
+                                  (CountingConnectionMixin, pool_cls.ConnectionCls), {'adapter': self})
+            pool_classes[scheme] = type(f'Counting{pool_cls.__name__}', (pool_cls,), {'ConnectionCls': connection_cls})
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+class HostClient:
+    """
+    HTTP клиент одного хоста: пул соединений, таймауты по умолчанию,
+    повторы с экспоненциальной задержкой и случайным разбросом (jitter).
+    """
+    
+    def __init__(self, host: str, read_timeout: float):
+        self.host = host
+        self.service = external_service_name(host)
+        self.timeout = (HTTP_CONNECT_TIMEOUT, read_timeout)
+        self.session = requests.Session()
+        self._adapter = CountingHTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'retries': 0, 'errors': 0, 'in_flight': 0}
+    
+    def _count(self, key: str, delta: int = 1):
+        with self._lock:
+            self._stats[key] += delta
+    
+    @staticmethod
+    def backoff_delay(attempt: int, response=None) -> float:
+        """Задержка перед повтором: Retry-After от сервера или full jitter"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), HTTP_BACKOFF_MAX)
+        return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+    
+    def request(self, method: str, url: str, retries: int = HTTP_MAX_RETRIES, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        idempotent = method.upper() in ('GET', 'HEAD', 'OPTIONS')
+        retry_statuses = RETRY_STATUS_CODES if idempotent else RETRY_STATUS_CODES_UNSAFE
+        retry_exceptions = (requests.exceptions.ConnectionError, requests.exceptions.Timeout) if idempotent \
+            else (requests.exceptions.ConnectTimeout,)
+        body = kwargs.get('data')
+        
+        for attempt in range(retries + 1):
+            if attempt:
+                self._count('retries')
+                # Потоковое тело нужно перемотать в начало перед повтором
+                if hasattr(body, 'rewind'):
+                    body.rewind()
+            self._count('requests')
+            self._count('in_flight')
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except retry_exceptions as e:
+                EXTERNAL_ERRORS.inc(service=self.service, operation=method)
+                if attempt >= retries:
+                    self._count('errors')
+                    raise
+                delay = self.backoff_delay(attempt)
+                print(f"🔁 {method} {self.host}: {e.__class__.__name__}, повтор через {delay:.1f} с")
+                time.sleep(delay)
+                continue
+            except Exception:
+                self._count('errors')
+                EXTERNAL_ERRORS.inc(service=self.service, operation=method)
+                raise
+            finally:
+                self._count('in_flight', -1)
+                EXTERNAL_LATENCY.observe(time.perf_counter() - started, service=self.service, operation=method)
+            
+            self._record_bytes(body, response, kwargs.get('stream', False))
+            
+            if response.status_code in retry_statuses and attempt < retries:
+                delay = self.backoff_delay(attempt, response)
+                print(f"🔁 {method} {self.host}: HTTP {response.status_code}, повтор через {delay:.1f} с")
+                response.close()
+                time.sleep(delay)
+                continue
+            if response.status_code >= 400:
+                self._count('errors')
+                EXTERNAL_ERRORS.inc(service=self.service, operation=method)
+            return response
+    
+    def _record_bytes(self, body, response, stream: bool):
+        if body is not None:
+            EXTERNAL_BYTES.inc(len(body), service=self.service, direction='up')
+        # Потоковые ответы учитываются там, где их тело реально читается
+        content_length = response.headers.get('Content-Length', '')
+        if not stream and content_length.isdigit():
+            EXTERNAL_BYTES.inc(int(content_length), service=self.service, direction='down')
+    
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        connections = self._adapter.connection_stats()
+        open_connections = connections['opened'] - connections['closed']
+        stats.update({
+            'pool_maxsize': HTTP_POOL_SIZE,
+            'connections_opened': connections['opened'],
+            'open_connections': open_connections,
+            # Открытые соединения, не занятые запросом, ждут повторного использования в пуле
+            'idle_connections': max(open_connections - stats['in_flight'], 0),
+            'timeout': list(self.timeout)
+        })
+        return stats
+
+class HTTPClientRegistry:
+    """Реестр HostClient: один клиент (и пул соединений) на каждый хост"""
+    
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+    
+    def for_url(self, url: str) -> HostClient:
+        host = urlparse(url).netloc
+        with self._lock:
+            client = self._clients.get(host)
+            if client is None:
+                client = HostClient(host, HTTP_HOST_READ_TIMEOUTS.get(host, HTTP_READ_TIMEOUT))
+                self._clients[host] = client
+            return client
+    
+    def stats(self) -> dict:
+        with self._lock:
+            clients = list(self._clients.values())
+        return {client.host: client.stats() for client in clients}
+
+http_clients = HTTPClientRegistry()
+
+@app.route('/api/http/stats', methods=['GET'])
+def http_stats():
+    """Статистика пулов соединений к внешним API"""
+    return jsonify({'success': True, 'hosts': http_clients.stats()})
+
+# ==================== POSTS STORE ====================
+
+# История и запланированные посты хранятся в SQLite с индексами
+POSTS_DB = DATA_DIR / 'posts.db'
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+class SQLiteStore:
+    """
+    Базовый класс для хранилищ в SQLite: схема и соединение на поток.
+    
+    База открывается при первом обращении, а не при импорте app.py.
+    """
+    
+    SCHEMA = ''
+    # Колонки, появившиеся позже: в старых базах таблицы TABLE их добавляем при открытии.
+    # ADDED_SCHEMA (индексы по этим колонкам) выполняется после их добавления
+    TABLE = None
+    ADDED_COLUMNS = ()
+    ADDED_SCHEMA = ''
+    
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+    
+    def _create_schema(self, conn: sqlite3.Connection):
+        with conn:
+            conn.executescript(self.SCHEMA)
+        if self.ADDED_COLUMNS:
+            with conn:
+                # Несколько воркеров могут стартовать одновременно - миграция под блокировкой записи
+                conn.execute('BEGIN IMMEDIATE')
+                columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({self.TABLE})')}
+                for column, column_type in self.ADDED_COLUMNS:
+                    if column not in columns:
+                        conn.execute(f'ALTER TABLE {self.TABLE} ADD COLUMN {column} {column_type}')
+        if self.ADDED_SCHEMA:
+            with conn:
+                conn.executescript(self.ADDED_SCHEMA)
+    
+    def _connect(self) -> sqlite3.Connection:
+        # Отдельное соединение на поток: Flask и планировщик работают в разных потоках
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with self._schema_lock:
+                if not self._schema_ready:
+                    self._create_schema(conn)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+class PostStore(SQLiteStore):
+    """
+    Индексированное хранилище постов (опубликованных и запланированных).
+    
+    Каждая строка хранит полный JSON поста плюс отдельные колонки для
+    фильтров и сортировки, поэтому страница истории читается по индексу
+    и не зависит от общего количества постов.
+    """
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT,
+            status TEXT NOT NULL,
+            sort_time TEXT NOT NULL,
+            scheduled_time TEXT,
+            source_file TEXT UNIQUE,
+            data TEXT NOT NULL,
+            lease_owner TEXT,
+            lease_expires REAL,
+            staged TEXT,
+            staging_owner TEXT,
+            staging_expires REAL,
+            change_seq INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_posts_sort ON posts(sort_time DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_posts_user_sort ON posts(username, sort_time DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_posts_status_sort ON posts(status, sort_time DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS idx_posts_scheduled ON posts(status, scheduled_time);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    '''
+    
+    # Колонки аренды, заранее загруженных файлов и номера изменения появились позже
+    TABLE = 'posts'
+    ADDED_COLUMNS = (('lease_owner', 'TEXT'), ('lease_expires', 'REAL'),
+                     ('staged', 'TEXT'), ('staging_owner', 'TEXT'), ('staging_expires', 'REAL'),
+                     ('change_seq', 'INTEGER'))
+    ADDED_SCHEMA = '''
+        CREATE INDEX IF NOT EXISTS idx_posts_change_seq ON posts(change_seq);
+        CREATE INDEX IF NOT EXISTS idx_posts_leased ON posts(lease_expires) WHERE lease_owner IS NOT NULL;
+    '''
+    
+    # Номер изменения для синхронизации очереди планировщика: каждая запись,
+    # меняющая статус или время поста, получает следующий номер. Записи в
+    # SQLite идут по одной, поэтому номера растут в порядке коммитов
+    NEXT_SEQ = '(SELECT COALESCE(MAX(change_seq), 0) + 1 FROM posts)'
+    
+    @staticmethod
+    def _columns(post_data: dict):
+        status = post_data.get('status') or 'published'
+        # Тот же ключ сортировки, что и раньше: время публикации по расписанию или время создания
+        sort_time = post_data.get('scheduled_time') or post_data.get('timestamp') or ''
+        return post_data.get('username'), status, sort_time, post_data.get('scheduled_time')
+    
+    @staticmethod
+    def _row_to_post(row) -> dict:
+        post_data = json.loads(row['data'])
+        post_data['status'] = row['status']
+        post_data['post_id'] = row['id']
+        return post_data
+    
+    def add_post(self, post_data: dict, source_file: str = None) -> int:
+        username, status, sort_time, scheduled_time = self._columns(post_data)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'INSERT INTO posts (username, status, sort_time, scheduled_time, source_file, data, change_seq) '
+                f'VALUES (?, ?, ?, ?, ?, ?, {self.NEXT_SEQ})',
+                (username, status, sort_time, scheduled_time, source_file, json.dumps(post_data, ensure_ascii=False))
+            )
+            return cursor.lastrowid
+    
+    def add_posts(self, posts: list) -> list:
+        """Добавляет пачку постов одной транзакцией (все или ни одного), возвращает их id"""
+        post_ids = []
+        with self._connect() as conn:
+            for post_data in posts:
+                username, status, sort_time, scheduled_time = self._columns(post_data)
+                cursor = conn.execute(
+                    'INSERT INTO posts (username, status, sort_time, scheduled_time, data, change_seq) '
+                    f'VALUES (?, ?, ?, ?, ?, {self.NEXT_SEQ})',
+                    (username, status, sort_time, scheduled_time, json.dumps(post_data, ensure_ascii=False))
+                )
+                post_ids.append(cursor.lastrowid)
+        return post_ids
+    
+    def update_post(self, post_id: int, post_data: dict):
+        post_data = {k: v for k, v in post_data.items() if k != 'post_id'}
+        username, status, sort_time, scheduled_time = self._columns(post_data)
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE posts SET username = ?, status = ?, sort_time = ?, scheduled_time = ?, data = ?, '
+                f'change_seq = {self.NEXT_SEQ} WHERE id = ?',
+                (username, status, sort_time, scheduled_time, json.dumps(post_data, ensure_ascii=False), post_id)
+            )
+    
+    def get_post(self, post_id: int):
+        row = self._connect().execute('SELECT * FROM posts WHERE id = ?', (post_id,)).fetchone()
+        return self._row_to_post(row) if row else None
+    
+    @staticmethod
+    def _run_at(row) -> datetime:
+        # Арендованный пост или пост, ожидающий повтора после ошибки, - не раньше окончания аренды
+        run_at = datetime.fromisoformat(row['scheduled_time'])
+        if row['lease_expires']:
+            run_at = max(run_at, datetime.fromtimestamp(row['lease_expires']))
+        return run_at
+    
+    def _last_seq(self, conn) -> int:
+        return conn.execute('SELECT COALESCE(MAX(change_seq), 0) FROM posts').fetchone()[0]
+    
+    def scheduled_posts(self):
+        """
+        Все ожидающие публикации посты [(id, время)] и номер последнего изменения.
+        
+        Дальше очередь обновляется через changed_posts(номер).
+        """
+        conn = self._connect()
+        with conn:
+            # Посты и номер - из одного снимка базы
+            conn.execute('BEGIN')
+            rows = conn.execute(
+                "SELECT id, scheduled_time, lease_expires FROM posts WHERE status = 'scheduled' ORDER BY scheduled_time"
+            ).fetchall()
+            last_seq = self._last_seq(conn)
+        return [(row['id'], self._run_at(row)) for row in rows], last_seq
+    
+    def changed_posts(self, since_seq: int):
+        """
+        Изменения очереди после since_seq: (changes, recovered, номер последнего изменения).
+        
+        changes - [(id, время или None)], None - пост больше не ждет публикации.
+        recovered - [(id, время)] постов, аренда которых истекла без записи
+        результата (воркер упал): такие посты не меняются в базе сами.
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN')
+            rows = conn.execute(
+                'SELECT id, status, scheduled_time, lease_expires FROM posts WHERE change_seq > ? ORDER BY change_seq',
+                (since_seq,)
+            ).fetchall()
+            expired = conn.execute(
+                "SELECT id, scheduled_time, lease_expires FROM posts "
+                "WHERE lease_owner IS NOT NULL AND lease_expires <= ? AND status = 'scheduled'",
+                (time.time(),)
+            ).fetchall()
+            last_seq = self._last_seq(conn)
+        changes = [(row['id'], self._run_at(row) if row['status'] == 'scheduled' else None) for row in rows]
+        return changes, [(row['id'], self._run_at(row)) for row in expired], max(last_seq, since_seq)
+    
+    def claim_post(self, post_id: int, owner: str, ttl: float):
+        """
+        Атомарно берет наступивший запланированный пост в аренду на ttl секунд.
+        
+        Возвращает (post_data, предыдущий владелец аренды) или None, если пост
+        уже не запланирован, его время не наступило или аренда другого
+        воркера еще действует. Предыдущий владелец не None - аренда
+        перехвачена у воркера, который не продлил ее (упал или завис).
+        """
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT * FROM posts WHERE id = ?', (post_id,)).fetchone()
+            if (row is None or row['status'] != 'scheduled'
+                    or datetime.fromisoformat(row['scheduled_time']) > datetime.now()
+                    or (row['lease_expires'] and row['lease_expires'] > now)):
+                return None
+            conn.execute('UPDATE posts SET lease_owner = ?, lease_expires = ? WHERE id = ?', (owner, now + ttl, post_id))
+        return self._row_to_post(row), row['lease_owner']
+    
+    def renew_leases(self, post_ids: list, owner: str, ttl: float) -> int:
+        """Продлевает аренды постов этого воркера, возвращает число продленных"""
+        if not post_ids:
+            return 0
+        placeholders = ', '.join('?' for _ in post_ids)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE posts SET lease_expires = ? WHERE lease_owner = ? AND status = 'scheduled' AND id IN ({placeholders})",
+                (time.time() + ttl, owner, *post_ids)
+            )
+            return cursor.rowcount
+    
+    def release_post(self, post_id: int, owner: str, retry_at: datetime):
+        """Снимает аренду после неудачной публикации: пост снова доступен любому воркеру с retry_at"""
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE posts SET lease_owner = NULL, lease_expires = ?, '
+                f'change_seq = {self.NEXT_SEQ} WHERE id = ? AND lease_owner = ?',
+                (retry_at.timestamp(), post_id, owner)
+            )
+    
+    def finish_post(self, post_id: int, owner: str, post_data: dict) -> bool:
+        """
+        Сохраняет результат публикации и снимает аренду.
+        
+        Возвращает False, если к этому моменту аренда уже принадлежала другому воркеру.
+        """
+        post_data = {k: v for k, v in post_data.items() if k != 'post_id'}
+        username, status, sort_time, scheduled_time = self._columns(post_data)
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT lease_owner FROM posts WHERE id = ?', (post_id,)).fetchone()
+            conn.execute(
+                'UPDATE posts SET username = ?, status = ?, sort_time = ?, scheduled_time = ?, data = ?, '
+                'lease_owner = NULL, lease_expires = NULL, staged = NULL, staging_owner = NULL, staging_expires = NULL, '
+                f'change_seq = {self.NEXT_SEQ} WHERE id = ?',
+                (username, status, sort_time, scheduled_time, json.dumps(post_data, ensure_ascii=False), post_id)
+            )
+        return row is not None and row['lease_owner'] == owner
+    
+    def posts_to_stage(self, until: datetime) -> list:
+        """
+        Запланированные на ближайшее время посты (до until), которые можно загрузить заранее.
+        
+        Возвращает [(id, scheduled_time, staged)]; посты, которые сейчас
+        публикуются или загружаются другим воркером, пропускаются.
+        """
+        now = time.time()
+        rows = self._connect().execute(
+            "SELECT id, scheduled_time, staged FROM posts WHERE status = 'scheduled' "
+            "AND scheduled_time > ? AND scheduled_time <= ? "
+            "AND (lease_owner IS NULL OR lease_expires <= ?) AND (staging_expires IS NULL OR staging_expires <= ?) "
+            "ORDER BY scheduled_time",
+            (datetime.now().isoformat(), until.isoformat(), now, now)
+        ).fetchall()
+        return [(row['id'], datetime.fromisoformat(row['scheduled_time']), json.loads(row['staged']) if row['staged'] else None)
+                for row in rows]
+    
+    def claim_staging(self, post_id: int, owner: str, ttl: float):
+        """Атомарно берет пост на предварительную загрузку, возвращает post_data или None"""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT * FROM posts WHERE id = ?', (post_id,)).fetchone()
+            if (row is None or row['status'] != 'scheduled'
+                    or (row['lease_owner'] and row['lease_expires'] > now)
+                    or (row['staging_expires'] and row['staging_expires'] > now)):
+                return None
+            conn.execute('UPDATE posts SET staging_owner = ?, staging_expires = ? WHERE id = ?', (owner, now + ttl, post_id))
+        return self._row_to_post(row)
+    
+    def renew_staging_leases(self, post_ids: list, owner: str, ttl: float) -> int:
+        """Продлевает аренды загрузки постов этого воркера, возвращает число продленных"""
+        if not post_ids:
+            return 0
+        placeholders = ', '.join('?' for _ in post_ids)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE posts SET staging_expires = ? WHERE staging_owner = ? AND status = 'scheduled' AND id IN ({placeholders})",
+                (time.time() + ttl, owner, *post_ids)
+            )
+            return cursor.rowcount
+    
+    def save_staged(self, post_id: int, owner: str, staged: dict) -> bool:
+        """Сохраняет загруженные файлы поста и снимает аренду загрузки"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE posts SET staged = ?, staging_owner = NULL, staging_expires = NULL "
+                "WHERE id = ? AND staging_owner = ? AND status = 'scheduled'",
+                (json.dumps(staged), post_id, owner)
+            )
+            return cursor.rowcount > 0
+    
+    def release_staging(self, post_id: int, owner: str, retry_at: datetime):
+        """Снимает аренду после неудачной загрузки, следующая попытка - не раньше retry_at"""
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE posts SET staging_owner = NULL, staging_expires = ? WHERE id = ? AND staging_owner = ?',
+                (retry_at.timestamp(), post_id, owner)
+            )
+    
+    def get_staged(self, post_id: int):
+        row = self._connect().execute('SELECT staged FROM posts WHERE id = ?', (post_id,)).fetchone()
+        return json.loads(row['staged']) if row and row['staged'] else None
+    
+    # Изменять можно только запланированные посты, которые сейчас не публикуются
+    # (аренды нет или она истекла)
+    EDITABLE_SCHEDULED = "status = 'scheduled' AND (lease_owner IS NULL OR lease_expires <= ?)"
+    
+    def reschedule_posts(self, changes: list) -> list:
+        """
+        Переносит запланированные посты [(id, новое время)] одной транзакцией.
+        
+        Возвращает id перенесенных постов. Опубликованные, отмененные и
+        публикуемые прямо сейчас посты пропускаются. Отложенный после
+        ошибки повтор сбрасывается - пост выйдет в новое время.
+        """
+        now = time.time()
+        updated = []
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for post_id, scheduled_time in changes:
+                value = scheduled_time.isoformat()
+                cursor = conn.execute(
+                    "UPDATE posts SET scheduled_time = ?, sort_time = ?, data = json_set(data, '$.scheduled_time', ?), "
+                    f"lease_owner = NULL, lease_expires = NULL, change_seq = {self.NEXT_SEQ} "
+                    f"WHERE id = ? AND {self.EDITABLE_SCHEDULED}",
+                    (value, value, value, post_id, now)
+                )
+                if cursor.rowcount:
+                    updated.append(post_id)
+        return updated
+    
+    def cancel_posts(self, post_ids: list) -> list:
+        """Отменяет запланированные посты одной транзакцией, возвращает id отмененных"""
+        now = time.time()
+        cancelled = []
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for post_id in post_ids:
+                cursor = conn.execute(
+                    "UPDATE posts SET status = 'cancelled', data = json_set(data, '$.status', 'cancelled'), "
+                    f"lease_owner = NULL, lease_expires = NULL, change_seq = {self.NEXT_SEQ} "
+                    f"WHERE id = ? AND {self.EDITABLE_SCHEDULED}",
+                    (post_id, now)
+                )
+                if cursor.rowcount:
+                    cancelled.append(post_id)
+        return cancelled
+    
+    @staticmethod
+    def encode_cursor(sort_time: str, post_id: int) -> str:
+        return base64.urlsafe_b64encode(f'{sort_time}|{post_id}'.encode('utf-8')).decode('ascii')
+    
+    @staticmethod
+    def decode_cursor(cursor: str):
+        sort_time, post_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').rsplit('|', 1)
+        return sort_time, int(post_id)
+    
+    def list_posts(self, limit: int = HISTORY_PAGE_SIZE, cursor: str = None, username: str = None,
+                   status: str = None, date_from: str = None, date_to: str = None):
+        """Страница постов (новые сверху) и курсор следующей страницы"""
+        conditions = []
+        params = []
+        if username:
+            conditions.append('username = ?')
+            params.append(username)
+        if status:
+            conditions.append('status = ?')
+            params.append(status)
+        if date_from:
+            conditions.append('sort_time >= ?')
+            params.append(date_from)
+        if date_to:
+            conditions.append('sort_time <= ?')
+            params.append(date_to)
+        if cursor:
+            sort_time, post_id = self.decode_cursor(cursor)
+            conditions.append('(sort_time < ? OR (sort_time = ? AND id < ?))')
+            params.extend([sort_time, sort_time, post_id])
+        
+        query = 'SELECT * FROM posts'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY sort_time DESC, id DESC LIMIT ?'
+        params.append(limit + 1)
+        
+        rows = self._connect().execute(query, params).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self.encode_cursor(rows[-1]['sort_time'], rows[-1]['id'])
+        return [self._row_to_post(row) for row in rows], next_cursor
+    
+    def import_json_dirs(self, posts_dir: Path, scheduled_dir: Path) -> int:
+        """Однократный импорт старых JSON файлов из data/posts и data/scheduled"""
+        conn = self._connect()
+        if conn.execute("SELECT value FROM meta WHERE key = 'json_imported'").fetchone():
+            return 0
+        
+        imported = 0
+        with conn:
+            # Несколько процессов могут стартовать одновременно: импортирует тот, кто первым взял блокировку
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute("SELECT value FROM meta WHERE key = 'json_imported'").fetchone():
+                return 0
+            for directory, default_status in [(posts_dir, 'published'), (scheduled_dir, 'scheduled')]:
+                for json_file in directory.glob('*.json'):
+                    try:
+                        with open(json_file, 'r', encoding='utf-8') as f:
+                            post_data = json.load(f)
+                    except Exception as e:
+                        print(f"❌ Ошибка чтения файла {json_file.name}: {e}")
+                        continue
+                    # Устанавливаем статус если его нет (для старых постов)
+                    post_data.setdefault('status', default_status)
+                    username, status, sort_time, scheduled_time = self._columns(post_data)
+                    cursor = conn.execute(
+                        'INSERT OR IGNORE INTO posts (username, status, sort_time, scheduled_time, source_file, data, change_seq) '
+                        f'VALUES (?, ?, ?, ?, ?, ?, {self.NEXT_SEQ})',
+                        (username, status, sort_time, scheduled_time, f'{directory.name}/{json_file.name}',
+                         json.dumps(post_data, ensure_ascii=False))
+                    )
+                    imported += cursor.rowcount
+            conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', ?)", (datetime.now().isoformat(),))
+        return imported
+
+post_store = PostStore(POSTS_DB)
+
+# ==================== PUBLISH PHOTO NORMALIZATION ====================
+
+# Фото перед публикацией приводятся к требованиям Instagram: поворот по EXIF,
+# соотношение сторон 4:5 - 1.91:1, ширина 1080 px, JPEG без метаданных
+NORMALIZED_DIR = DATA_DIR / 'normalized'
+PUBLISH_PHOTO_WIDTH = int(os.getenv('PUBLISH_PHOTO_WIDTH', '1080'))
+PUBLISH_PHOTO_QUALITY = int(os.getenv('PUBLISH_PHOTO_QUALITY', '88'))
+PUBLISH_PHOTO_FIT = os.getenv('PUBLISH_PHOTO_FIT', 'crop')  # crop - обрезать, pad - добавить поля
+PUBLISH_PAD_COLOR = os.getenv('PUBLISH_PAD_COLOR', '#ffffff')
+# Кэш копий ограничен по размеру и возрасту, давно не использованные удаляются первыми
+NORMALIZED_CACHE_MAX_MB = int(os.getenv('NORMALIZED_CACHE_MAX_MB', '1024'))
+NORMALIZED_CACHE_MAX_AGE = int(os.getenv('NORMALIZED_CACHE_MAX_AGE', str(30 * 24 * 3600)))
+# Копии, использованные за последний час, не удаляются: они могут публиковаться прямо сейчас
+NORMALIZED_CACHE_MIN_AGE = 3600
+PUBLISH_MIN_ASPECT = 4 / 5
+PUBLISH_MAX_ASPECT = 1.91
+
+def clamp_publish_aspect(aspect: float) -> float:
+    return min(max(aspect, PUBLISH_MIN_ASPECT), PUBLISH_MAX_ASPECT)
+
+def normalize_photo(source_path: str, target_path: str, target_aspect: float, fit: str,
+                    width: int, quality: int, pad_color: str) -> str:
+    """
+    Готовит копию фото для публикации (выполняется в отдельном процессе).
+    
+    target_aspect=None - подходящее соотношение сторон определяется по самому фото.
+    """
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    aspect = image.width / image.height
+    target_aspect = clamp_publish_aspect(target_aspect or aspect)
+    
+    # Не увеличиваем фото: итоговая ширина не больше исходной (с учетом обрезки/полей)
+    if fit == 'pad':
+        fitted_width = max(image.width, image.height * target_aspect)
+    else:
+        fitted_width = min(image.width, image.height * target_aspect)
+    out_width = int(min(width, fitted_width))
+    size = (out_width, max(1, round(out_width / target_aspect)))
+    
+    if size != image.size:
+        if fit == 'pad':
+            image = ImageOps.pad(image, size, Image.LANCZOS, color=pad_color)
+        else:
+            image = ImageOps.fit(image, size, Image.LANCZOS)
+    
+    tmp_path = f'{target_path}.{os.getpid()}.tmp'
+    image.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(tmp_path, target_path)
+    return target_path
+
+def verify_uploaded_photo(path: str, quality: int) -> dict:
+    """
+    Полная проверка загруженного фото (выполняется в отдельном процессе).
+    
+    Битые и обрезанные файлы отсеиваются при декодировании, а не при публикации.
+    Фото с поворотом в EXIF или не в RGB пересохраняется повернутым и в RGB.
+    """
+    with Image.open(path) as image:
+        image.load()
+        orientation = image.getexif().get(0x0112, 1)
+        if orientation == 1 and image.mode in ('RGB', 'L'):
+            return {'width': image.width, 'height': image.height, 'normalized': False}
+        icc_profile = image.info.get('icc_profile')
+        normalized = ImageOps.exif_transpose(image)
+        if normalized.mode not in ('RGB', 'L'):
+            normalized = normalized.convert('RGB')
+            # Профиль CMYK не подходит к RGB-пикселям
+            icc_profile = None
+    
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    save_options = {'quality': quality, 'optimize': True, 'exif': normalized.getexif()}
+    if icc_profile:
+        save_options['icc_profile'] = icc_profile
+    normalized.save(tmp_path, 'JPEG', **save_options)
+    os.replace(tmp_path, path)
+    return {'width': normalized.width, 'height': normalized.height, 'normalized': True}
+
+NORMALIZE_WORKERS = int(os.getenv('NORMALIZE_WORKERS', str(min(4, os.cpu_count() or 1))))
+normalize_executor = None
+normalize_executor_lock = threading.Lock()
+normalize_worker_barrier = None
+
+def init_normalize_worker(barrier):
+    global normalize_worker_barrier
+    normalize_worker_barrier = barrier
+
+def normalize_worker_ready() -> int:
+    """Задача прогрева: ждет, пока такие же задачи займут все процессы пула"""
+    normalize_worker_barrier.wait(timeout=60)
+    return os.getpid()
+
+def create_normalize_executor():
+    """
+    Пул процессов для нормализации (работа с изображениями грузит CPU).
+    
+    Все процессы создаются через fork сразу, до запуска потоков планировщика:
+    NORMALIZE_WORKERS задач прогрева ждут друг друга на барьере, поэтому
+    каждой нужен свой процесс. Функции для пула должны быть объявлены выше.
+    Там, где fork недоступен (Windows), используется пул потоков: при spawn
+    каждый процесс заново импортировал бы app.py вместе с планировщиком.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return ThreadPoolExecutor(max_workers=NORMALIZE_WORKERS, thread_name_prefix='normalize')
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(NORMALIZE_WORKERS)
+    executor = ProcessPoolExecutor(max_workers=NORMALIZE_WORKERS, mp_context=context,
+                                   initializer=init_normalize_worker, initargs=(barrier,))
+    warmup = [executor.submit(normalize_worker_ready) for _ in range(NORMALIZE_WORKERS)]
+    pids = {future.result() for future in warmup}
+    print(f"✅ Пул подготовки фото запущен (процессов: {len(pids)})")
+    return executor
+
+def start_normalize_pool():
+    """Создает пул процессов нормализации; вызывается из create_app() до запуска потоков"""
+    global normalize_executor
+    with normalize_executor_lock:
+        if normalize_executor is None:
+            normalize_executor = create_normalize_executor()
+
+def get_normalize_executor():
+    """
+    Пул нормализации. Процессу, который не создал пул при старте (скрипты,
+    импорт app.py без create_app), достается пул потоков: fork при
+    работающих потоках небезопасен.
+    """
+    global normalize_executor
+    with normalize_executor_lock:
+        if normalize_executor is None:
+            normalize_executor = ThreadPoolExecutor(max_workers=NORMALIZE_WORKERS, thread_name_prefix='normalize')
+        return normalize_executor
+
+def photo_source_hash(source_path: Path, params: tuple) -> str:
+    """Хэш содержимого фото и параметров нормализации - ключ кэша производных"""
+    digest = hashlib.sha256(repr(params).encode('utf-8'))
+    with open(source_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def publish_target_aspect(photo_paths: list):
+    """Для карусели все фото приводятся к соотношению сторон первого фото"""
+    if len(photo_paths) < 2:
+        return None
+    with Image.open(photo_paths[0]) as image:
+        # Ориентация из EXIF: при повороте на 90 градусов ширина и высота меняются местами
+        width, height = image.size
+        if image.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+    return clamp_publish_aspect(width / height)
+
+def prepare_photos_for_publish(photo_paths: list, wait: bool = True) -> list:
+    """
+    Возвращает пути к нормализованным копиям фото (из кэша или созданным заново).
+    
+    wait=False только ставит нормализацию в очередь (например, при планировании
+    поста), чтобы к моменту публикации копии уже были готовы.
+    При ошибке нормализации публикуется исходный файл.
+    """
+    try:
+        target_aspect = publish_target_aspect(photo_paths) if photo_paths else None
+    except Exception as e:
+        print(f"⚠️ Не удалось прочитать размеры фото: {e}")
+        return photo_paths
+    
+    params = (target_aspect, PUBLISH_PHOTO_FIT, PUBLISH_PHOTO_WIDTH, PUBLISH_PHOTO_QUALITY, PUBLISH_PAD_COLOR)
+    jobs = []
+    for photo_path in photo_paths:
+        try:
+            target_path = NORMALIZED_DIR / f'{photo_source_hash(Path(photo_path), params)[:40]}.jpg'
+            try:
+                # mtime - время последнего использования копии, по нему чистится кэш
+                os.utime(target_path)
+                jobs.append((photo_path, str(target_path), None))
+                continue
+            except FileNotFoundError:
+                pass
+            future = get_normalize_executor().submit(normalize_photo, str(photo_path), str(target_path), *params)
+            jobs.append((photo_path, str(target_path), future))
+        except Exception as e:
+            print(f"⚠️ Не удалось подготовить фото {photo_path}: {e}")
+            jobs.append((photo_path, None, None))
+    
+    if not wait:
+        return photo_paths
+    
+    prepared = []
+    for photo_path, target_path, future in jobs:
+        try:
+            if future is not None:
+                future.result()
+            prepared.append(target_path or photo_path)
+        except Exception as e:
+            print(f"⚠️ Ошибка нормализации {photo_path}, публикуем исходный файл: {e}")
+            prepared.append(photo_path)
+    return prepared
+
+def prune_normalized_cache():
+    """
+    Удаляет подготовленные копии фото, не использованные дольше NORMALIZED_CACHE_MAX_AGE,
+    и самые давно использованные сверх NORMALIZED_CACHE_MAX_MB.
+    
+    Удаленная копия при следующей публикации просто создается заново.
+    """
+    now = time.time()
+    try:
+        entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                   for entry in os.scandir(NORMALIZED_DIR) if entry.is_file()]
+    except FileNotFoundError:
+        return
+    
+    total_size = 0
+    removed = removed_size = 0
+    for mtime, size, path in sorted(entries, reverse=True):
+        total_size += size
+        age = now - mtime
+        if age < NORMALIZED_CACHE_MIN_AGE:
+            continue
+        # Остатки прерванной нормализации (*.tmp) удаляются всегда
+        if path.endswith('.tmp') or age > NORMALIZED_CACHE_MAX_AGE or total_size > NORMALIZED_CACHE_MAX_MB * 1024 * 1024:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            total_size -= size
+            removed += 1
+            removed_size += size
+    if removed:
+        print(f"🧹 Удалено подготовленных копий фото: {removed} ({removed_size / 1024 / 1024:.1f} МБ)")
+
 # ==================== SCHEDULER SETUP ====================
 
-# Создаем планировщик для автопубликации постов
+# Создаем планировщик для автопубликации постов. Запускается не при импорте,
+# а в create_app() или отдельной командой: python app.py scheduler
 scheduler = BackgroundScheduler()
 scheduler_lock = threading.Lock()
+scheduler_start_lock = threading.Lock()
 
-def check_and_publish_scheduled_posts():
-    """Проверяет и публикует запланированные посты"""
-    global ig_client
+# Публикует ли этот процесс запланированные посты. Веб-процессы с
+# RUN_SCHEDULER=false только сохраняют посты в базу, публикует их
+# отдельный процесс планировщика
+RUN_SCHEDULER = os.getenv('RUN_SCHEDULER', 'true').lower() in ('1', 'true', 'yes')
+publishing_enabled = threading.Event()
+
+# Через сколько секунд повторять публикацию поста после ошибки
+SCHEDULER_RETRY_DELAY = int(os.getenv('SCHEDULER_RETRY_DELAY', '60'))
+
+# Несколько процессов (gunicorn воркеры, перезагрузчик Flask) запускают свои
+# планировщики. Пост публикует только воркер, взявший его в аренду в базе;
+# аренда продлевается, пока идет публикация, и истекает, если воркер упал
+SCHEDULER_WORKER_ID = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+SCHEDULER_LEASE_TTL = int(os.getenv('SCHEDULER_LEASE_TTL', '300'))
+# Как часто перечитывать очередь из базы: посты, запланированные другими
+# воркерами, и посты с истекшей арендой (0 - не перечитывать)
+SCHEDULER_SYNC_INTERVAL = int(os.getenv('SCHEDULER_SYNC_INTERVAL', '30'))
+
+# Файлы поста загружаются в Instagram заранее, за PRESTAGE_LEAD_TIME секунд
+# до публикации (0 - не загружать), в назначенное время остается только
+# configure. Загрузки старше PRESTAGE_MAX_AGE считаются устаревшими
+PRESTAGE_LEAD_TIME = int(os.getenv('PRESTAGE_LEAD_TIME', '900'))
+PRESTAGE_MAX_AGE = int(os.getenv('PRESTAGE_MAX_AGE', '3600'))
+PRESTAGE_WORKERS = int(os.getenv('PRESTAGE_WORKERS', '2'))
+
+# Сколько постов публикуется одновременно (разные аккаунты - параллельно)
+PUBLISH_WORKERS = int(os.getenv('PUBLISH_WORKERS', '4'))
+# Минимальный интервал между публикациями в один аккаунт (секунды)
+PUBLISH_MIN_SPACING = int(os.getenv('PUBLISH_MIN_SPACING', '30'))
+# Догоняющий режим: посты, просроченные больше чем на CATCHUP_THRESHOLD
+# (например, после простоя сервера), публикуются с увеличенным интервалом
+PUBLISH_CATCHUP_THRESHOLD = int(os.getenv('PUBLISH_CATCHUP_THRESHOLD', '300'))
+PUBLISH_CATCHUP_SPACING = int(os.getenv('PUBLISH_CATCHUP_SPACING', '300'))
+
+class ScheduledPostQueue:
+    """
+    Очередь запланированных постов в памяти (min-heap по scheduled_time).
+    
+    Посты читаются из базы один раз при старте, дальше очередь
+    обновляется инкрементально. Удаление/перенос поста помечает старую
+    запись кучи устаревшей (lazy deletion), поэтому все операции O(log n).
+    """
+    
+    def __init__(self):
+        self._heap = []
+        self._entries = {}  # post_id -> scheduled_time
+        self._lock = threading.Lock()
+        self._sync_seq = 0  # номер последнего изменения в базе, уже учтенного в очереди
+    
+    def load(self, store: PostStore):
+        """Загружает все запланированные посты из базы, заменяя содержимое очереди"""
+        scheduled, last_seq = store.scheduled_posts()
+        with self._lock:
+            self._entries = dict(scheduled)
+            self._heap = [(scheduled_time, post_id) for post_id, scheduled_time in scheduled]
+            heapq.heapify(self._heap)
+            self._sync_seq = last_seq
+        return len(scheduled)
+    
+    def sync(self, store: PostStore) -> int:
+        """
+        Применяет изменения из базы после прошлой синхронизации, возвращает их число.
+        
+        Читаются только измененные посты, остальные записи очереди (в том
+        числе отложенные из-за занятого аккаунта) не трогаются. Посты с
+        истекшей арендой добавляются, только если их нет в очереди.
+        """
+        with self._lock:
+            since_seq = self._sync_seq
+        changes, recovered, last_seq = store.changed_posts(since_seq)
+        with self._lock:
+            for post_id, scheduled_time in changes:
+                if scheduled_time is None:
+                    self._entries.pop(post_id, None)
+                elif self._entries.get(post_id) != scheduled_time:
+                    self._entries[post_id] = scheduled_time
+                    heapq.heappush(self._heap, (scheduled_time, post_id))
+            for post_id, scheduled_time in recovered:
+                if post_id not in self._entries:
+                    self._entries[post_id] = scheduled_time
+                    heapq.heappush(self._heap, (scheduled_time, post_id))
+            self._sync_seq = max(self._sync_seq, last_seq)
+        return len(changes) + len(recovered)
+    
+    def push(self, post_id: int, scheduled_time: datetime):
+        with self._lock:
+            self._entries[post_id] = scheduled_time
+            heapq.heappush(self._heap, (scheduled_time, post_id))
+    
+    def remove(self, post_id: int):
+        with self._lock:
+            self._entries.pop(post_id, None)
+    
+    def _drop_stale(self):
+        while self._heap and self._entries.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+    
+    def peek_time(self):
+        """Время ближайшего поста или None, если очередь пуста"""
+        with self._lock:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+    
+    def pop_due(self, now: datetime, limit: int = None):
+        """Извлекает посты, время которых уже наступило (самые старые первыми)"""
+        due = []
+        with self._lock:
+            self._drop_stale()
+            while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+                scheduled_time, post_id = heapq.heappop(self._heap)
+                del self._entries[post_id]
+                due.append(post_id)
+                self._drop_stale()
+        return due
+    
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+scheduled_queue = ScheduledPostQueue()
+
+class ScheduledPublisher:
+    """
+    Пул публикации запланированных постов.
+    
+    Посты разных аккаунтов публикуются параллельно (не больше max_workers
+    одновременно), посты одного аккаунта - строго по одному и не чаще,
+    чем раз в spacing секунд. Планировщик только раздает посты в пул и
+    сразу освобождается.
+    """
+    
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='publish')
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._in_flight_posts = set()
+        self._busy_accounts = set()
+        self._next_slot = {}  # username -> datetime, раньше которого публиковать нельзя
+        self._stats = {'published': 0, 'failed': 0, 'deferred': 0, 'catchup': 0,
+                       'claim_conflicts': 0, 'reclaimed': 0, 'leases_lost': 0,
+                       'staged': 0, 'staging_failed': 0}
+    
+    def free_slots(self) -> int:
+        with self._lock:
+            return self.max_workers - self._in_flight
+    
+    def account_available_at(self, username: str, now: datetime):
+        """None, если аккаунт свободен, иначе время, когда можно попробовать снова"""
+        with self._lock:
+            if username in self._busy_accounts:
+                return now + timedelta(seconds=max(PUBLISH_MIN_SPACING, 1))
+            next_slot = self._next_slot.get(username)
+            return next_slot if next_slot and next_slot > now else None
+    
+    def defer(self, post_id: int, run_at: datetime):
+        with self._lock:
+            self._stats['deferred'] += 1
+        scheduled_queue.push(post_id, run_at)
+    
+    def count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
     
+    def in_flight_posts(self) -> list:
+        with self._lock:
+            return list(self._in_flight_posts)
+    
+    def submit(self, post_id: int, post_data: dict, spacing: int, catchup: bool = False):
+        username = post_data['username']
+        with self._lock:
+            self._in_flight += 1
+            self._in_flight_posts.add(post_id)
+            self._busy_accounts.add(username)
+            if catchup:
+                self._stats['catchup'] += 1
+        self._executor.submit(self._run, post_id, post_data, spacing)
+    
+    def _run(self, post_id: int, post_data: dict, spacing: int):
+        username = post_data['username']
+        try:
+            publish_scheduled_post(post_id, post_data)
+            succeeded = True
+        except Exception as e:
+            print(f"❌ Ошибка при автопубликации поста #{post_id}: {e}")
+            # В случае ошибки повторяем попытку позже (любым воркером)
+            retry_at = datetime.now() + timedelta(seconds=SCHEDULER_RETRY_DELAY)
+            try:
+                post_store.release_post(post_id, SCHEDULER_WORKER_ID, retry_at)
+            except Exception as release_error:
+                print(f"❌ Не удалось снять аренду поста #{post_id}: {release_error}")
+            scheduled_queue.push(post_id, retry_at)
+            succeeded = False
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._in_flight_posts.discard(post_id)
+                self._busy_accounts.discard(username)
+                self._next_slot[username] = datetime.now() + timedelta(seconds=spacing)
+            # Освободился слот - раздаем следующие посты
+            arm_scheduler()
+        with self._lock:
+            self._stats['published' if succeeded else 'failed'] += 1
+        SCHEDULED_PUBLISHED.inc(result='published' if succeeded else 'failed')
+    
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'in_flight': self._in_flight,
+                'max_workers': self.max_workers,
+                'busy_accounts': sorted(self._busy_accounts),
+                'worker_id': SCHEDULER_WORKER_ID,
+                'publishing': publishing_enabled.is_set()
+            })
+        stats['queued'] = len(scheduled_queue)
+        return stats
+
+scheduled_publisher = ScheduledPublisher(PUBLISH_WORKERS)
+
+metrics.register(Gauge('scheduled_posts_queued', 'Запланированные посты в очереди', lambda: len(scheduled_queue)))
+metrics.register(Gauge('scheduled_posts_in_flight', 'Посты, публикуемые прямо сейчас',
+                       lambda: scheduled_publisher.stats()['in_flight']))
+
+def arm_scheduler():
+    """Ставит единственный job планировщика на время ближайшего поста"""
+    if not publishing_enabled.is_set():
+        return
+    next_time = scheduled_queue.peek_time()
+    if next_time is None:
+        if scheduler.get_job('check_scheduled'):
+            scheduler.remove_job('check_scheduled')
+        return
+    scheduler.add_job(
+        check_and_publish_scheduled_posts, 'date',
+        run_date=max(next_time, datetime.now()),
+        id='check_scheduled', replace_existing=True,
+        misfire_grace_time=None, max_instances=2
+    )
+
+def enqueue_scheduled_posts(posts: list):
+    """Добавляет сохраненные посты [(id, время)] в очередь без пересканирования базы"""
+    # Процесс без автопубликации очередь не ведет: посты из базы
+    # подхватит процесс планировщика при синхронизации
+    if not publishing_enabled.is_set():
+        return
+    for post_id, scheduled_time in posts:
+        scheduled_queue.push(post_id, scheduled_time)
+    arm_scheduler()
+
+def publish_scheduled_post(post_id: int, post_data: dict):
+    """Публикует один запланированный пост и сохраняет результат в историю"""
+    print(f"⏰ Публикация запланированного поста: #{post_id}")
+    lag = (datetime.now() - datetime.fromisoformat(post_data['scheduled_time'])).total_seconds()
+    SCHEDULER_LAG.observe(max(lag, 0))
+    
+    caption = post_data['caption']
+    photo_filenames = post_data.get('photos', [])
+    video_filenames = post_data.get('videos', [])
+    
+    photo_paths = [str(PHOTOS_DIR / filename) for filename in photo_filenames]
+    video_paths = [str(VIDEOS_DIR / filename) for filename in video_filenames]
+    
+    media = publish_media(post_data['username'], caption, photo_paths, video_paths,
+                          load_staged=lambda: staged_items(post_store.get_staged(post_id), post_data))
+    
+    # Обновляем статус, сохраняем в историю и снимаем аренду
+    post_data['status'] = 'published'
+    post_data['published_time'] = datetime.now().isoformat()
+    post_data['id'] = media.pk
+    if not post_store.finish_post(post_id, SCHEDULER_WORKER_ID, post_data):
+        scheduled_publisher.count('leases_lost')
+        print(f"⚠️ Аренда поста #{post_id} истекла во время публикации, увеличьте SCHEDULER_LEASE_TTL")
+    
+    print(f"✅ Пост успешно опубликован автоматически: {media.pk}")
+
+prestage_executor = ThreadPoolExecutor(max_workers=PRESTAGE_WORKERS, thread_name_prefix='prestage')
+staging_lock = threading.Lock()
+staging_posts = set()  # посты, которые этот процесс загружает прямо сейчас
+
+def staged_items(staged: dict, post_data: dict):
+    """Загруженные заранее файлы поста, если они еще не устарели"""
+    if not staged or staged.get('files') != post_data.get('photos', []) + post_data.get('videos', []):
+        return None
+    if time.time() - staged['uploaded_at'] >= PRESTAGE_MAX_AGE:
+        return None
+    # Обложку одиночного видео video_configure загружает из локального файла
+    if any(item['type'] == 'video' and not os.path.exists(item['thumbnail']) for item in staged['items']):
+        return None
+    return staged['items']
+
+def stage_scheduled_post(post_id: int):
+    """Загружает файлы запланированного поста в Instagram без публикации"""
+    try:
+        post_data = post_store.claim_staging(post_id, SCHEDULER_WORKER_ID, SCHEDULER_LEASE_TTL)
+        if post_data is None or not post_data.get('username'):
+            return
+        files = post_data.get('photos', []) + post_data.get('videos', [])
+        photo_paths = prepare_photos_for_publish([str(PHOTOS_DIR / filename) for filename in post_data.get('photos', [])])
+        paths = photo_paths + [str(VIDEOS_DIR / filename) for filename in post_data.get('videos', [])]
+        username = post_data['username']
+        
+        started = time.perf_counter()
+        with ig_clients.account_lock(username):
+            client = ig_clients.get(username)
+            try:
+                uploaded_at = time.time()
+                items = upload_media_items(client, username, paths, track_progress=False)
+            finally:
+                ig_clients.mark_dirty(username)
+        if not post_store.save_staged(post_id, SCHEDULER_WORKER_ID, {'files': files, 'items': items, 'uploaded_at': uploaded_at}):
+            # Аренда истекла или пост успели изменить/опубликовать - загрузка не сохранена
+            scheduled_publisher.count('staging_failed')
+            print(f"⚠️ Загрузка поста #{post_id} не сохранена: аренда загрузки потеряна или пост изменился")
+            return
+        scheduled_publisher.count('staged')
+        print(f"📦 Файлы поста #{post_id} загружены заранее ({len(items)} шт., {time.perf_counter() - started:.1f} с)")
+    except Exception as e:
+        scheduled_publisher.count('staging_failed')
+        print(f"❌ Ошибка предварительной загрузки поста #{post_id}: {e}")
+        try:
+            post_store.release_staging(post_id, SCHEDULER_WORKER_ID,
+                                       datetime.now() + timedelta(seconds=SCHEDULER_RETRY_DELAY))
+        except Exception as release_error:
+            print(f"❌ Не удалось снять аренду загрузки поста #{post_id}: {release_error}")
+    finally:
+        with staging_lock:
+            staging_posts.discard(post_id)
+
+def prestage_scheduled_posts():
+    """Отправляет на предварительную загрузку посты, до публикации которых меньше PRESTAGE_LEAD_TIME"""
+    try:
+        candidates = post_store.posts_to_stage(datetime.now() + timedelta(seconds=PRESTAGE_LEAD_TIME))
+    except Exception as e:
+        print(f"❌ Ошибка поиска постов для предварительной загрузки: {e}")
+        return
+    for post_id, scheduled_time, staged in candidates:
+        # Загрузка уже есть и не устареет к моменту публикации
+        if staged and staged['uploaded_at'] + PRESTAGE_MAX_AGE > scheduled_time.timestamp():
+            continue
+        with staging_lock:
+            if post_id in staging_posts:
+                continue
+            staging_posts.add(post_id)
+        prestage_executor.submit(stage_scheduled_post, post_id)
+
+def check_and_publish_scheduled_posts():
+    """Раздает в пул публикации посты, время которых наступило"""
     # Используем блокировку для предотвращения одновременного выполнения
     if not scheduler_lock.acquire(blocking=False):
         print("⏸️ Планировщик уже выполняется, пропускаем...")
         return
     
+    tick_started = time.perf_counter()
     try:
         now = datetime.now()
-        
-        # Получаем список всех файлов СНАЧАЛА, чтобы избежать изменений во время итерации
-        scheduled_files = list(SCHEDULED_DIR.glob('*.json'))
-        
-        # Проходим по всем запланированным постам
-        for scheduled_file in scheduled_files:
-            # КРИТИЧНО: Проверяем существование файла перед обработкой
-            if not scheduled_file.exists():
-                continue
+        # Берем посты по одному (самые старые первыми), пока есть свободные слоты.
+        # Остальные остаются в очереди до освобождения слота
+        while scheduled_publisher.free_slots() > 0:
+            due = scheduled_queue.pop_due(now, limit=1)
+            if not due:
+                break
+            post_id = due[0]
             
-            # КРИТИЧНО: Сразу пытаемся удалить файл, чтобы другие процессы его не увидели
-            # Это предотвращает дублирование публикации
             try:
-                # Читаем и удаляем файл атомарно
-                with open(scheduled_file, 'r', encoding='utf-8') as f:
-                    post_data = json.load(f)
-                
-                # Сразу удаляем файл, чтобы другой процесс его не увидел
-                scheduled_file.unlink()
-                
-            except FileNotFoundError:
-                # Файл уже удалён другим процессом
-                continue
+                post_data = post_store.get_post(post_id)
             except Exception as e:
-                print(f"❌ Ошибка чтения файла {scheduled_file.name}: {e}")
+                print(f"❌ Ошибка чтения поста #{post_id}: {e}")
                 continue
-                
+            
+            # Проверяем, не был ли пост удален или уже опубликован
+            if post_data is None or post_data.get('status') != 'scheduled':
+                print(f"⚠️ Пост #{post_id} уже не запланирован, пропускаем")
+                continue
+            
+            post_username = post_data.get('username')
+            if not post_username:
+                # Без username пост опубликовать невозможно, оставляем его в истории как запланированный
+                print(f"❌ В запланированном посте нет username: #{post_id}")
+                continue
+            
+            # Аккаунт занят или интервал между публикациями еще не прошел
+            available_at = scheduled_publisher.account_available_at(post_username, now)
+            if available_at is not None:
+                scheduled_publisher.defer(post_id, available_at)
+                continue
+            
+            # Берем пост в аренду: его не опубликует параллельно другой воркер
             try:
-                # Проверяем, не был ли уже опубликован этот пост
-                if post_data.get('status') == 'published':
-                    print(f"⚠️ Пост {scheduled_file.name} уже был опубликован, пропускаем")
-                    continue
-                
-                scheduled_time = datetime.fromisoformat(post_data['scheduled_time'])
-                
-                # Если время ещё не пришло, возвращаем файл обратно
-                if now < scheduled_time:
-                    with open(scheduled_file, 'w', encoding='utf-8') as f:
-                        json.dump(post_data, f, ensure_ascii=False, indent=2)
-                    continue
-                
-                # Время пришло - публикуем
-                print(f"⏰ Публикация запланированного поста: {scheduled_file.name}")
-                
-                # Готовим клиент для username поста
-                post_username = post_data.get('username')
-                if not post_username:
-                    print(f"❌ В запланированном посте нет username: {scheduled_file.name}")
-                    # Возвращаем файл обратно
-                    with open(scheduled_file, 'w', encoding='utf-8') as f:
-                        json.dump(post_data, f, ensure_ascii=False, indent=2)
-                    continue
-                try:
-                    local_client = load_client_for_username(post_username)
-                except Exception as e:
-                    print(f"❌ Ошибка загрузки сессии для {post_username}: {e}")
-                    with open(scheduled_file, 'w', encoding='utf-8') as f:
-                        json.dump(post_data, f, ensure_ascii=False, indent=2)
-                    continue
-                
-                # Публикуем пост
-                caption = post_data['caption']
-                photo_filenames = post_data.get('photos', [])
-                video_filenames = post_data.get('videos', [])
-                
-                photo_paths = [str(PHOTOS_DIR / filename) for filename in photo_filenames]
-                video_paths = [str(VIDEOS_DIR / filename) for filename in video_filenames]
-                
-                # Публикуем
-                media = None
-                if len(video_paths) == 1 and len(photo_paths) == 0:
-                    media = local_client.video_upload(video_paths[0], caption)
-                elif len(photo_paths) == 1 and len(video_paths) == 0:
-                    media = local_client.photo_upload(photo_paths[0], caption)
-                else:
-                    all_paths = photo_paths + video_paths
-                    media = local_client.album_upload(all_paths, caption)
-                
-                # Обновляем статус и сохраняем в историю
-                post_data['status'] = 'published'
-                post_data['published_time'] = datetime.now().isoformat()
-                post_data['id'] = media.pk
-                
-                # Сохраняем в историю
-                history_file = POSTS_DIR / f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-                with open(history_file, 'w', encoding='utf-8') as f:
-                    json.dump(post_data, f, ensure_ascii=False, indent=2)
-                
-                print(f"✅ Пост успешно опубликован автоматически: {media.pk}")
-                
+                claimed = post_store.claim_post(post_id, SCHEDULER_WORKER_ID, SCHEDULER_LEASE_TTL)
             except Exception as e:
-                print(f"❌ Ошибка при автопубликации поста {scheduled_file.name}: {e}")
-                # В случае ошибки возвращаем файл обратно
-                try:
-                    with open(scheduled_file, 'w', encoding='utf-8') as f:
-                        json.dump(post_data, f, ensure_ascii=False, indent=2)
-                except Exception:
-                    pass
+                print(f"❌ Ошибка аренды поста #{post_id}: {e}")
+                scheduled_queue.push(post_id, now + timedelta(seconds=SCHEDULER_RETRY_DELAY))
                 continue
-                
+            if claimed is None:
+                # Пост уже публикует другой воркер - вернется в очередь при синхронизации с базой
+                scheduled_publisher.count('claim_conflicts')
+                continue
+            post_data, previous_owner = claimed
+            if previous_owner:
+                scheduled_publisher.count('reclaimed')
+                print(f"♻️ Пост #{post_id}: аренда воркера {previous_owner} истекла, публикуем заново")
+            
+            # Просроченные посты догоняем с увеличенным интервалом, а не все сразу
+            overdue = (now - datetime.fromisoformat(post_data['scheduled_time'])).total_seconds()
+            catchup = overdue > PUBLISH_CATCHUP_THRESHOLD
+            if catchup:
+                print(f"⏩ Пост #{post_id} просрочен на {int(overdue)} с, догоняющая публикация")
+            spacing = max(PUBLISH_MIN_SPACING, PUBLISH_CATCHUP_SPACING) if catchup else PUBLISH_MIN_SPACING
+            scheduled_publisher.submit(post_id, post_data, spacing, catchup=catchup)
+    
     except Exception as e:
         print(f"❌ Ошибка в планировщике: {e}")
     finally:
-        # Освобождаем блокировку
+        # Освобождаем блокировку и ставим job на следующий пост. Когда все слоты
+        # заняты, job ставит освободившийся воркер (_run): иначе при наступившем
+        # посте тик запускался бы снова и снова, пока идет публикация.
+        # Слоты проверяем после снятия блокировки - тик, запущенный воркером
+        # во время этого тика, был пропущен
         scheduler_lock.release()
+        if scheduled_publisher.free_slots() > 0:
+            arm_scheduler()
+        SCHEDULER_TICK.observe(time.perf_counter() - tick_started)
 
-# Запускаем планировщик (проверка каждую минуту)
-scheduler.add_job(check_and_publish_scheduled_posts, 'interval', minutes=1, id='check_scheduled')
-scheduler.start()
+def renew_scheduled_leases():
+    """Heartbeat: продлевает аренду постов, которые этот воркер сейчас публикует или загружает заранее"""
+    post_ids = scheduled_publisher.in_flight_posts()
+    with staging_lock:
+        staging_ids = list(staging_posts)
+    try:
+        renewed = post_store.renew_leases(post_ids, SCHEDULER_WORKER_ID, SCHEDULER_LEASE_TTL)
+        post_store.renew_staging_leases(staging_ids, SCHEDULER_WORKER_ID, SCHEDULER_LEASE_TTL)
+    except Exception as e:
+        print(f"❌ Ошибка продления аренды постов: {e}")
+        return
+    if renewed < len(post_ids):
+        print(f"⚠️ Не удалось продлить аренду {len(post_ids) - renewed} постов")
+
+def sync_scheduled_queue():
+    """Подхватывает изменения из базы: посты других процессов и истекшие аренды"""
+    try:
+        scheduled_queue.sync(post_store)
+    except Exception as e:
+        print(f"❌ Ошибка синхронизации очереди планировщика: {e}")
+        return
+    arm_scheduler()
 
-print("✅ Планировщик автопубликации запущен")
+def start_scheduler(publish: bool = True):
+    """
+    Запускает фоновый планировщик процесса (повторные вызовы ничего не делают).
+    
+    publish=False - только служебные задачи (сохранение сессий Instagram),
+    запланированные посты публикует отдельный процесс.
+    """
+    with scheduler_start_lock:
+        if scheduler.running:
+            return
+        scheduler.start()
+        scheduler.add_job(ig_clients.flush, 'interval', minutes=5, id='flush_ig_sessions')
+        scheduler.add_job(prune_normalized_cache, 'interval', hours=1, id='prune_normalized_cache')
+        # Задачи генерации видео выполняет любой процесс с планировщиком
+        scheduler.add_job(resume_video_jobs, 'interval', seconds=VIDEO_JOB_LEASE_TTL,
+                          id='resume_video_jobs', next_run_time=datetime.now())
+        scheduler.add_job(renew_video_job_leases, 'interval', seconds=max(VIDEO_JOB_LEASE_TTL // 3, 1),
+                          id='renew_video_job_leases')
+        if not publish:
+            print("ℹ️ Автопубликация в этом процессе выключена (RUN_SCHEDULER=false)")
+            return
+        
+        # Загружаем очередь и включаем автопубликацию
+        loaded_count = scheduled_queue.load(post_store)
+        publishing_enabled.set()
+        scheduler.add_job(renew_scheduled_leases, 'interval', seconds=max(SCHEDULER_LEASE_TTL // 3, 1), id='renew_post_leases')
+        if SCHEDULER_SYNC_INTERVAL > 0:
+            scheduler.add_job(sync_scheduled_queue, 'interval', seconds=SCHEDULER_SYNC_INTERVAL, id='sync_scheduled_queue')
+        if PRESTAGE_LEAD_TIME > 0:
+            if PRESTAGE_LEAD_TIME >= PRESTAGE_MAX_AGE:
+                print("⚠️ PRESTAGE_LEAD_TIME не меньше PRESTAGE_MAX_AGE: заранее загруженные файлы устареют до публикации")
+            scheduler.add_job(prestage_scheduled_posts, 'interval', seconds=max(min(PRESTAGE_LEAD_TIME // 3, 60), 1),
+                              id='prestage_posts', next_run_time=datetime.now())
+        arm_scheduler()
+    
+    print(f"✅ Планировщик автопубликации запущен (в очереди: {loaded_count})")
 
 # ==================== INSTAGRAM AUTH ====================
 
@@ -208,6 +2106,10 @@ def instagram_login():
         session_file = get_session_file(username)
         ig_client.dump_settings(session_file)
 
+        # Залогиненный клиент сразу используется для публикаций
+        with ig_clients.account_lock(username):
+            ig_clients.put(username, ig_client)
+
         session['instagram_logged_in'] = True
         session['instagram_username'] = username
 
@@ -228,8 +2130,6 @@ def instagram_login():
 
 @app.route('/api/instagram/status', methods=['GET'])
 def instagram_status():
-    global ig_client
-    
     # НИКАКОГО авто-восстановления из чужих сессий. Только текущее состояние.
     
     if session.get('instagram_logged_in'):
@@ -239,82 +2139,738 @@ def instagram_status():
         })
     return jsonify({'logged_in': False})
 
+@app.route('/api/publish/progress', methods=['GET'])
+def publish_progress():
+    """Ход загрузки последней карусели текущего аккаунта по элементам"""
+    username = session.get('instagram_username')
+    if not username:
+        return jsonify({'success': False, 'error': 'Не выполнен вход в Instagram'}), 401
+    return jsonify({'success': True, 'album': album_progress.get(username)})
+
+@app.route('/api/scheduler/stats', methods=['GET'])
+def scheduler_stats():
+    """Статистика пула публикации запланированных постов"""
+    return jsonify({'success': True, 'stats': scheduled_publisher.stats()})
+
+@app.route('/api/instagram/clients/stats', methods=['GET'])
+def instagram_clients_stats():
+    """Статистика кэша клиентов: попадания, время создания клиента"""
+    return jsonify({'success': True, 'stats': ig_clients.stats()})
+
 @app.route('/api/instagram/logout', methods=['POST'])
 def instagram_logout():
     global ig_client
+    username = session.get('instagram_username')
+    if username:
+        ig_clients.invalidate(username)
     # Полностью очищаем Flask-сессию
     session.clear()
     ig_client = None
     return jsonify({'success': True, 'message': 'Выход выполнен'})
 
-# ==================== PHOTO GENERATION ====================
+# ==================== MEDIA STORE ====================
+
+# Контентно-адресуемое хранилище: байты каждого файла лежат один раз в objects/
+# под своим SHA-256, а файлы библиотеки - жесткие ссылки на них. Имена вида
+# <дата_время>_<начало хэша> уникальны без блокировок, старые имена и URL не меняются
+OBJECTS_DIR = DATA_DIR / 'objects'
+MEDIA_TMP_DIR = OBJECTS_DIR / 'tmp'
+MEDIA_DB = DATA_DIR / 'media.db'
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_json_atomic(path: Path, data: dict):
+    """Пишет JSON во временный файл и атомарно переименовывает его"""
+    tmp_path = MEDIA_TMP_DIR / f'{uuid.uuid4().hex}.json.part'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+class MediaStore(SQLiteStore):
+    """
+    Индекс имен библиотеки -> SHA-256 содержимого.
+    
+    Одинаковые файлы сохраняются один раз: повторное сохранение тех же
+    байтов возвращает уже существующее имя. Гонку двух одинаковых
+    сохранений решает UNIQUE (kind, sha256) в базе, а не блокировка.
+    """
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS media (
+            name TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_time TEXT NOT NULL,
+            UNIQUE (kind, sha256)
+        );
+    '''
+    
+    DIRECTORIES = {'photos': PHOTOS_DIR, 'videos': VIDEOS_DIR}
+    
+    @staticmethod
+    def new_temp_path(suffix: str) -> Path:
+        """Временный файл на той же ФС, что и хранилище (для атомарного rename)"""
+        return MEDIA_TMP_DIR / f'{uuid.uuid4().hex}{suffix}.part'
+    
+    @staticmethod
+    def object_path(sha: str, suffix: str) -> Path:
+        return OBJECTS_DIR / sha[:2] / f'{sha[2:]}{suffix}'
+    
+    def find(self, kind: str, sha: str):
+        """Имя файла библиотеки с таким содержимым или None"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT name FROM media WHERE kind = ? AND sha256 = ?', (kind, sha)).fetchone()
+            if row is None:
+                return None
+            if not (self.DIRECTORIES[kind] / row['name']).exists():
+                # Файл удален из библиотеки вручную - забываем запись
+                conn.execute('DELETE FROM media WHERE name = ?', (row['name'],))
+                return None
+            return row['name']
+    
+    @staticmethod
+    def _link(object_path: Path, target: Path):
+        try:
+            os.link(object_path, target)
+        except FileExistsError:
+            pass
+        except OSError:
+            # ФС без жестких ссылок - копируем через временный файл
+            tmp_path = MediaStore.new_temp_path(target.suffix)
+            shutil.copyfile(object_path, tmp_path)
+            os.replace(tmp_path, target)
+    
+    def put_file(self, kind: str, tmp_path: Path, suffix: str):
+        """
+        Переносит готовый временный файл в хранилище.
+        
+        Возвращает (имя в библиотеке, created). created=False - такой файл
+        уже был, временный файл удален и возвращено существующее имя.
+        """
+        sha = file_sha256(tmp_path)
+        existing = self.find(kind, sha)
+        if existing:
+            tmp_path.unlink(missing_ok=True)
+            return existing, False
+        
+        object_path = self.object_path(sha, suffix)
+        object_path.parent.mkdir(exist_ok=True)
+        size = tmp_path.stat().st_size
+        if object_path.exists():
+            tmp_path.unlink(missing_ok=True)
+        else:
+            os.replace(tmp_path, object_path)
+        
+        name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{sha[:8]}{suffix}"
+        target = self.DIRECTORIES[kind] / name
+        self._link(object_path, target)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO media (name, kind, sha256, size, created_time) VALUES (?, ?, ?, ?, ?)',
+                (name, kind, sha, size, datetime.now().isoformat())
+            )
+        
+        # Одновременно сохранили те же байты - остается имя, попавшее в базу первым
+        winner = self.find(kind, sha)
+        if winner != name:
+            target.unlink(missing_ok=True)
+            return winner, False
+        return name, True
+    
+    def put_bytes(self, kind: str, content: bytes, suffix: str):
+        tmp_path = self.new_temp_path(suffix)
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        return self.put_file(kind, tmp_path, suffix)
+    
+    def sha256_of(self, name: str):
+        """SHA-256 содержимого файла библиотеки или None (файл сохранен до хранилища)"""
+        row = self._connect().execute('SELECT sha256 FROM media WHERE name = ?', (name,)).fetchone()
+        return row['sha256'] if row else None
+
+media_store = MediaStore(MEDIA_DB)
+
+# ==================== MEDIA SERVING ====================
+
+# Файлы медиа и превью не меняются после записи, поэтому браузер кэширует
+# их без перепроверки (Cache-Control: immutable)
+MEDIA_CACHE_MAX_AGE = int(os.getenv('MEDIA_CACHE_MAX_AGE', str(365 * 24 * 3600)))
+# Отдача байтов фронтенд-сервером: x-accel-redirect (nginx), x-sendfile (Apache, lighttpd)
+# или пусто - файлы отдает само приложение
+MEDIA_SENDFILE = os.getenv('MEDIA_SENDFILE', '').lower()
+# internal location nginx, указывающий на папку data/ (для x-accel-redirect)
+MEDIA_ACCEL_PREFIX = os.getenv('MEDIA_ACCEL_PREFIX', '/_media').rstrip('/')
+
+def media_etag(path: Path, filename: str, kind: str = None) -> str:
+    """Сильный ETag: SHA-256 из хранилища, для старых файлов и превью - размер и время изменения"""
+    sha = media_store.sha256_of(filename) if kind else None
+    if sha:
+        return sha
+    stat = path.stat()
+    return f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+def send_media(directory: Path, filename: str, kind: str = None):
+    """
+    Отдает неизменяемый файл медиа.
+    
+    Сильный ETag и 304 на If-None-Match, Range запросы для перемотки видео
+    (206). С MEDIA_SENDFILE приложение отвечает только заголовками,
+    а сами байты отдает nginx/Apache.
+    """
+    path = safe_join(str(directory), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    path = Path(path)
+    etag = media_etag(path, filename, kind)
+    
+    if MEDIA_SENDFILE in ('x-accel-redirect', 'x-sendfile'):
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        if MEDIA_SENDFILE == 'x-accel-redirect':
+            # Range и отдачу файла nginx выполняет сам
+            response.headers['X-Accel-Redirect'] = f'{MEDIA_ACCEL_PREFIX}/{path.relative_to(DATA_DIR).as_posix()}'
+        else:
+            response.headers['X-Sendfile'] = str(path)
+        response.set_etag(etag)
+        response = response.make_conditional(request)
+    else:
+        response = send_file(path, etag=etag, max_age=MEDIA_CACHE_MAX_AGE, conditional=True)
+    
+    response.cache_control.public = True
+    response.cache_control.max_age = MEDIA_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+# ==================== MEDIA LIBRARY INDEX ====================
+
+LIBRARY_MAX_PAGE_SIZE = 500
+
+class MediaLibraryIndex:
+    """
+    Индекс медиа-библиотеки в памяти.
+    
+    Строится один раз, дальше пополняется эндпоинтами, которые сохраняют
+    файлы. Изменения на диске в обход приложения обнаруживаются по inode и
+    mtime директории: при их смене перечитываются только новые файлы.
+    """
+    
+    # Точность mtime бывает до 2 с (FAT, некоторые сетевые ФС): пока mtime свежее,
+    # два изменения подряд дают одно и то же значение, поэтому совпадение
+    # дополнительно проверяется по числу файлов
+    MTIME_GRANULARITY = 2.0
+    
+    def __init__(self, directory: Path, suffix: str, url_prefix: str):
+        self.directory = directory
+        self.suffix = suffix
+        self.url_prefix = url_prefix
+        self._items = {}  # filename -> элемент ответа API
+        self._names = []  # имена файлов по возрастанию
+        self._dir_signature = None  # (inode, mtime_ns) директории на момент последней сверки
+        self._racy = False  # mtime из _dir_signature слишком свежий, чтобы ему доверять
+        self._lock = threading.Lock()
+    
+    def _make_item(self, filename: str, metadata: dict = None) -> dict:
+        if metadata is None:
+            metadata = {}
+            metadata_file = (self.directory / filename).with_suffix('.json')
+            if metadata_file.exists():
+                try:
+                    with open(metadata_file, 'r', encoding='utf-8') as f:
+                        metadata = json.load(f)
+                except Exception as e:
+                    print(f"Ошибка чтения метаданных для {filename}: {e}")
+        return {
+            'filename': filename,
+            'url': f'{self.url_prefix}/{filename}',
+            'prompt': metadata.get('prompt', ''),
+            'timestamp': metadata.get('timestamp', ''),
+            **thumbnail_urls(self.url_prefix, filename, poster=self.suffix == '.mp4')
+        }
+    
+    def _remember_signature(self, stat):
+        self._dir_signature = (stat.st_ino, stat.st_mtime_ns)
+        self._racy = stat.st_mtime_ns >= (time.time() - self.MTIME_GRANULARITY) * 1e9
+    
+    def _count_files(self) -> int:
+        return sum(1 for entry in os.scandir(self.directory) if entry.name.endswith(self.suffix))
+    
+    def _refresh_if_changed(self):
+        stat = os.stat(self.directory)
+        if (stat.st_ino, stat.st_mtime_ns) == self._dir_signature:
+            if not self._racy:
+                return
+            # Свежий mtime: достаточно сверить число файлов, а не перестраивать индекс
+            if self._count_files() == len(self._items):
+                self._remember_signature(stat)
+                return
+        names = {entry.name for entry in os.scandir(self.directory) if entry.name.endswith(self.suffix)}
+        added = names - self._items.keys()
+        for filename in self._items.keys() - names:
+            del self._items[filename]
+            del self._names[bisect.bisect_left(self._names, filename)]
+        for filename in added:
+            self._items[filename] = self._make_item(filename)
+        if len(added) > len(self._names):
+            self._names = sorted(self._items)
+        else:
+            for filename in added:
+                bisect.insort(self._names, filename)
+        self._remember_signature(stat)
+    
+    def add(self, filename: str, metadata: dict):
+        """Регистрирует только что сохраненный файл без пересканирования"""
+        with self._lock:
+            if filename not in self._items:
+                bisect.insort(self._names, filename)
+            self._items[filename] = self._make_item(filename, metadata)
+            # Файл и его метаданные уже записаны: новый mtime директории - наше же изменение
+            if self._dir_signature is not None:
+                self._remember_signature(os.stat(self.directory))
+    
+    def page(self, limit: int = None, cursor: str = None):
+        """Страница элементов (новые сверху) и курсор следующей страницы"""
+        with self._lock:
+            self._refresh_if_changed()
+            end = bisect.bisect_left(self._names, cursor) if cursor else len(self._names)
+            start = max(end - limit, 0) if limit else 0
+            items = [self._items[name] for name in reversed(self._names[start:end])]
+            next_cursor = self._names[start] if start > 0 else None
+            return items, next_cursor
+
+photo_library = MediaLibraryIndex(PHOTOS_DIR, '.jpg', '/api/photos')
+video_library = MediaLibraryIndex(VIDEOS_DIR, '.mp4', '/api/videos')
+
+def get_library_page_args():
+    """Разбирает limit/cursor из query-параметров"""
+    limit = request.args.get('limit')
+    limit = min(max(int(limit), 1), LIBRARY_MAX_PAGE_SIZE) if limit else None
+    return limit, request.args.get('cursor') or None
+
+# ==================== THUMBNAILS ====================
+
+# Уменьшенные копии медиа для сетки библиотеки (кэшируются на диске)
+THUMBS_DIR = DATA_DIR / 'thumbs'
+THUMBNAIL_WIDTHS = (240, 480, 960)
+THUMBNAIL_FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+THUMBNAIL_QUALITY = int(os.getenv('THUMBNAIL_QUALITY', '80'))
+FFMPEG_BINARY = shutil.which('ffmpeg')
+
+# Фоновый воркер, чтобы генерация превью не задерживала ответ API
+thumbnail_executor = ThreadPoolExecutor(max_workers=int(os.getenv('THUMBNAIL_WORKERS', '2')), thread_name_prefix='thumbs')
+# Сколько запрос превью ждет фоновой генерации, прежде чем ответить 404
+THUMBNAIL_WAIT_TIMEOUT = float(os.getenv('THUMBNAIL_WAIT_TIMEOUT', '2'))
+thumbnail_jobs_lock = threading.Lock()
+thumbnail_jobs = {}  # (kind, filename) -> future генерации, которая идет прямо сейчас
+
+def thumbnail_urls(url_prefix: str, filename: str, poster: bool = False) -> dict:
+    """URL всех вариантов превью для ответа API библиотеки"""
+    stem = Path(filename).stem
+    urls = {
+        'thumbnails': {
+            str(width): {ext: f'{url_prefix}/thumbs/{width}/{stem}.{ext}' for ext in THUMBNAIL_FORMATS}
+            for width in THUMBNAIL_WIDTHS
+        }
+    }
+    if poster:
+        urls['poster'] = f'{url_prefix}/posters/{stem}.jpg'
+    return urls
+
+def save_image_variants(image, target_dir: Path, stem: str):
+    """Сохраняет уменьшенные копии изображения во всех ширинах и форматах"""
+    image = ImageOps.exif_transpose(image).convert('RGB')
+    for width in THUMBNAIL_WIDTHS:
+        variant = image.copy()
+        # Не увеличиваем изображения меньше нужной ширины
+        variant.thumbnail((width, width * 4), Image.LANCZOS)
+        for ext, pil_format in THUMBNAIL_FORMATS.items():
+            target = target_dir / f'{stem}_{width}.{ext}'
+            # Уникальное имя: одно и то же превью могут создавать параллельно несколько потоков и процессов
+            tmp_target = target.with_name(f'.{target.name}.{uuid.uuid4().hex}.tmp')
+            try:
+                variant.save(tmp_target, pil_format, quality=THUMBNAIL_QUALITY, optimize=True)
+                os.replace(tmp_target, target)
+            finally:
+                tmp_target.unlink(missing_ok=True)
+
+def extract_video_poster(video_path: Path, poster_path: Path) -> bool:
+    """Сохраняет первый кадр видео (через ffmpeg или moviepy, если установлены)"""
+    tmp_poster = poster_path.with_name(f'.{poster_path.stem}.{uuid.uuid4().hex}.tmp.jpg')
+    try:
+        if FFMPEG_BINARY:
+            subprocess.run(
+                [FFMPEG_BINARY, '-y', '-loglevel', 'error', '-i', str(video_path), '-frames:v', '1', '-q:v', '3', str(tmp_poster)],
+                check=True, timeout=60
+            )
+        else:
+            try:
+                from moviepy.editor import VideoFileClip
+            except ImportError:
+                return False
+            with VideoFileClip(str(video_path)) as clip:
+                clip.save_frame(str(tmp_poster), t=0)
+        os.replace(tmp_poster, poster_path)
+        return True
+    except Exception as e:
+        print(f"❌ Не удалось получить кадр из видео {video_path.name}: {e}")
+        tmp_poster.unlink(missing_ok=True)
+        return False
+
+def generate_thumbnails(kind: str, filename: str) -> bool:
+    """Создает превью для фото или постер и превью для видео"""
+    stem = Path(filename).stem
+    try:
+        if kind == 'photos':
+            with Image.open(PHOTOS_DIR / filename) as image:
+                save_image_variants(image, THUMBS_DIR / 'photos', stem)
+        else:
+            poster_path = THUMBS_DIR / 'videos' / f'{stem}.jpg'
+            if not poster_path.exists() and not extract_video_poster(VIDEOS_DIR / filename, poster_path):
+                return False
+            with Image.open(poster_path) as image:
+                save_image_variants(image, THUMBS_DIR / 'videos', stem)
+        return True
+    except Exception as e:
+        print(f"❌ Ошибка генерации превью для {filename}: {e}")
+        return False
+
+def schedule_thumbnails(kind: str, filename: str):
+    """
+    Ставит генерацию превью в фоновую очередь и возвращает ее future.
+    
+    Пока файл в работе, повторные вызовы возвращают ту же задачу: сетка
+    запрашивает несколько размеров каждого превью, а генерировать их нужно один раз.
+    """
+    key = (kind, filename)
+    with thumbnail_jobs_lock:
+        future = thumbnail_jobs.get(key)
+        if future is None:
+            future = thumbnail_executor.submit(generate_thumbnails, kind, filename)
+            thumbnail_jobs[key] = future
+    
+    def forget(done):
+        with thumbnail_jobs_lock:
+            if thumbnail_jobs.get(key) is done:
+                del thumbnail_jobs[key]
+    future.add_done_callback(forget)
+    return future
+
+def wait_for_thumbnails(kind: str, filename: str) -> bool:
+    """Запускает фоновую генерацию превью старого файла и недолго ждет ее"""
+    try:
+        return schedule_thumbnails(kind, filename).result(timeout=THUMBNAIL_WAIT_TIMEOUT)
+    except TimeoutError:
+        return False
+
+def send_thumbnail(kind: str, source_dir: Path, source_suffix: str, width: int, filename: str):
+    stem, _, ext = filename.rpartition('.')
+    if width not in THUMBNAIL_WIDTHS or ext not in THUMBNAIL_FORMATS or not stem:
+        return jsonify({'success': False, 'error': 'Неподдерживаемый размер или формат превью'}), 404
+    thumb_dir = THUMBS_DIR / kind
+    thumb_name = f'{stem}_{width}.{ext}'
+    # Превью для старых файлов создаются в фоне при первом обращении
+    if not (thumb_dir / thumb_name).exists():
+        if not (source_dir / f'{stem}{source_suffix}').exists() or not wait_for_thumbnails(kind, f'{stem}{source_suffix}'):
+            return jsonify({'success': False, 'error': 'Превью недоступно'}), 404
+    return send_media(thumb_dir, thumb_name)
+
+@app.route('/api/photos/thumbs/<int:width>/<filename>')
+def get_photo_thumbnail(width, filename):
+    return send_thumbnail('photos', PHOTOS_DIR, '.jpg', width, filename)
+
+@app.route('/api/videos/thumbs/<int:width>/<filename>')
+def get_video_thumbnail(width, filename):
+    return send_thumbnail('videos', VIDEOS_DIR, '.mp4', width, filename)
+
+@app.route('/api/videos/posters/<filename>')
+def get_video_poster(filename):
+    stem = Path(filename).stem
+    poster_dir = THUMBS_DIR / 'videos'
+    if not (poster_dir / f'{stem}.jpg').exists():
+        if not (VIDEOS_DIR / f'{stem}.mp4').exists() or not wait_for_thumbnails('videos', f'{stem}.mp4'):
+            return jsonify({'success': False, 'error': 'Постер недоступен'}), 404
+    return send_media(poster_dir, f'{stem}.jpg')
+
+# ==================== PHOTO GENERATION ====================
+
+# Pollinations API (адрес можно переопределить, например, для бенчмарков)
+POLLINATIONS_API_URL = os.getenv('POLLINATIONS_API_URL', 'https://image.pollinations.ai')
+
+# Пакетная генерация: общий пул на все запросы и лимит вариантов в одном запросе
+PHOTO_BATCH_WORKERS = int(os.getenv('PHOTO_BATCH_WORKERS', '4'))
+PHOTO_BATCH_MAX = int(os.getenv('PHOTO_BATCH_MAX', '8'))
+photo_batch_executor = ThreadPoolExecutor(max_workers=PHOTO_BATCH_WORKERS, thread_name_prefix='photo-batch')
+
+class PhotoGenerationError(Exception):
+    """Ошибка генерации изображения через Pollinations"""
+
+def pollinations_request(prompt: str, width, height, model: str, seed):
+    """URL и параметры запроса к Pollinations API"""
+    url = f"{POLLINATIONS_API_URL}/prompt/{requests.utils.quote(prompt)}"
+    params = {
+        'width': width,
+        'height': height,
+        'model': model,
+        'nologo': 'true'
+    }
+    if seed:
+        params['seed'] = seed
+    return url, params
+
+def request_pollinations_photo(prompt: str, width, height, model: str, seed) -> bytes:
+    """Генерирует изображение через Pollinations API и возвращает его содержимое"""
+    url, params = pollinations_request(prompt, width, height, model, seed)
+    response = http_clients.for_url(url).get(url, params=params)
+    if response.status_code != 200:
+        raise PhotoGenerationError('Ошибка генерации изображения')
+    return response.content
+
+def save_generated_photo(content: bytes, prompt: str, width, height, model: str, seed) -> str:
+    """Сохраняет фото и метаданные рядом с ним, возвращает имя файла"""
+    # Имя - дата и время плюс начало хэша содержимого, так что параллельные
+    # сохранения не перезаписывают друг друга
+    filename, created = media_store.put_bytes('photos', content, '.jpg')
+    if not created:
+        print(f"♻️ Такое фото уже есть в библиотеке: {filename}")
+        return filename
+    timestamp = Path(filename).stem
+    
+    # Сохраняем метаданные (промпт)
+    metadata = {
+        'prompt': prompt,
+        'width': width,
+        'height': height,
+        'model': model,
+        'seed': seed,
+        'timestamp': timestamp
+    }
+    
+    write_json_atomic(PHOTOS_DIR / f"{timestamp}.json", metadata)
+    
+    photo_library.add(filename, metadata)
+    schedule_thumbnails('photos', filename)
+    
+    print(f"Сохранены метаданные для {filename}: prompt='{prompt[:50] if prompt else '(пусто)'}...'")  # Логирование
+    return filename
+
+def photo_request_params(data: dict):
+    """(prompt, width, height, model, seed) из тела запроса генерации фото"""
+    return (
+        data.get('prompt', 'beautiful landscape'),
+        data.get('width', 1024),
+        data.get('height', 1024),
+        data.get('model', 'flux'),
+        data.get('seed', None)
+    )
 
 @app.route('/api/generate-photo', methods=['POST'])
 def generate_photo():
-    data = request.json
-    prompt = data.get('prompt', 'beautiful landscape')
-    width = data.get('width', 1024)
-    height = data.get('height', 1024)
-    model = data.get('model', 'flux')
-    seed = data.get('seed', None)
+    prompt, width, height, model, seed = photo_request_params(request.json)
     
     try:
-        # Pollinations API
-        url = f"https://image.pollinations.ai/prompt/{requests.utils.quote(prompt)}"
-        params = {
-            'width': width,
-            'height': height,
-            'model': model,
-            'nologo': 'true'
-        }
-        if seed:
-            params['seed'] = seed
-        
-        response = requests.get(url, params=params)
+        content = request_pollinations_photo(prompt, width, height, model, seed)
+        filename = save_generated_photo(content, prompt, width, height, model, seed)
         
-        if response.status_code == 200:
-            # Сохраняем фото с именем в формате даты и времени
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{timestamp}.jpg"
-            filepath = PHOTOS_DIR / filename
-            
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
-            
-            # Сохраняем метаданные (промпт)
-            metadata = {
-                'prompt': prompt,
-                'width': width,
-                'height': height,
-                'model': model,
-                'seed': seed,
-                'timestamp': timestamp
-            }
-            
-            metadata_file = PHOTOS_DIR / f"{timestamp}.json"
-            with open(metadata_file, 'w', encoding='utf-8') as f:
-                json.dump(metadata, f, ensure_ascii=False, indent=2)
-            
-            print(f"Сохранены метаданные для {filename}: prompt='{prompt[:50] if prompt else '(пусто)'}...'")  # Логирование
-            
-            return jsonify({
-                'success': True,
-                'filename': filename,
-                'url': f'/api/photos/{filename}'
-            })
-        else:
-            return jsonify({'success': False, 'error': 'Ошибка генерации изображения'}), 400
+        return jsonify({
+            'success': True,
+            'filename': filename,
+            'url': f'/api/photos/{filename}'
+        })
+    except PhotoGenerationError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         print(f"❌ Ошибка при генерации фото: {e}")
         return jsonify({'success': False, 'error': str(e)}), 400
 
+def generate_batch_variant(prompt: str, variant: dict) -> dict:
+    """Генерирует и сохраняет один вариант пакета"""
+    content = request_pollinations_photo(prompt, variant['width'], variant['height'], variant['model'], variant['seed'])
+    filename = save_generated_photo(content, prompt, variant['width'], variant['height'], variant['model'], variant['seed'])
+    return {'filename': filename, 'url': f'/api/photos/{filename}'}
+
+def batch_request_variants(data: dict):
+    """
+    Промпт и список вариантов пакетной генерации из тела запроса.
+    
+    Варианты - все сочетания seeds x models x sizes (или count случайных seed).
+    ValueError - некорректный или слишком большой пакет.
+    """
+    prompt = data.get('prompt', 'beautiful landscape')
+    seeds = data.get('seeds') or [data.get('seed', None)]
+    if not data.get('seeds') and data.get('count'):
+        # count проверяем до создания списка: count=10**9 не должен занимать память
+        try:
+            count = int(data['count'])
+        except (TypeError, ValueError):
+            raise ValueError('count должен быть целым числом')
+        if not 1 <= count <= PHOTO_BATCH_MAX:
+            raise ValueError(f'count должен быть от 1 до {PHOTO_BATCH_MAX}')
+        seeds = [random.randint(1, 2 ** 31 - 1) for _ in range(count)]
+    models = data.get('models') or [data.get('model', 'flux')]
+    sizes = data.get('sizes') or [{'width': data.get('width', 1024), 'height': data.get('height', 1024)}]
+    
+    if not all(isinstance(values, list) for values in (seeds, models, sizes)):
+        raise ValueError('seeds, models и sizes должны быть списками')
+    # Размер пакета - до перебора сочетаний
+    total = len(seeds) * len(models) * len(sizes)
+    if total > PHOTO_BATCH_MAX:
+        raise ValueError(f'Слишком много вариантов: {total} (максимум {PHOTO_BATCH_MAX})')
+    
+    try:
+        variants = [
+            {'seed': seed, 'model': model, 'width': size['width'], 'height': size['height']}
+            for seed, model, size in itertools.product(seeds, models, sizes)
+        ]
+    except (KeyError, TypeError):
+        raise ValueError('sizes должен быть списком объектов {width, height}')
+    return prompt, variants
+
+@app.route('/api/generate-photo-batch', methods=['POST'])
+def generate_photo_batch():
+    """
+    Генерирует несколько вариантов одного промпта параллельно.
+    
+    Результаты отдаются потоком NDJSON: по строке на каждое готовое фото
+    в порядке готовности и итоговая строка {"done": true, ...}.
+    """
+    try:
+        prompt, variants = batch_request_variants(request.json or {})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    print(f"🖼️ Пакетная генерация: {len(variants)} вариантов")
+    futures = {photo_batch_executor.submit(generate_batch_variant, prompt, variant): (index, variant)
+               for index, variant in enumerate(variants)}
+    
+    def results():
+        succeeded = 0
+        for future in as_completed(futures):
+            index, variant = futures[future]
+            try:
+                result = {'success': True, 'index': index, **variant, **future.result()}
+                succeeded += 1
+            except Exception as e:
+                print(f"❌ Ошибка при генерации варианта #{index}: {e}")
+                result = {'success': False, 'index': index, **variant, 'error': str(e)}
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+        yield json.dumps({'done': True, 'total': len(variants), 'succeeded': succeeded}) + '\n'
+    
+    return Response(stream_with_context(results()), mimetype='application/x-ndjson')
+
 @app.route('/api/photos/<filename>')
 def get_photo(filename):
-    return send_from_directory(PHOTOS_DIR, filename)
+    return send_media(PHOTOS_DIR, filename, 'photos')
+
+@app.route('/api/photos', methods=['GET'])
+def list_photos():
+    try:
+        limit, cursor = get_library_page_args()
+        photos, next_cursor = photo_library.page(limit, cursor)
+        return jsonify({'success': True, 'photos': photos, 'next_cursor': next_cursor})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+# ==================== PHOTO UPLOAD ====================
+
+# Пакетная загрузка: файлы пишутся на диск прямо из тела запроса, в запросе
+# проверяется только заголовок, полное декодирование - в фоне
+UPLOAD_BATCH_MAX_FILES = int(os.getenv('UPLOAD_BATCH_MAX_FILES', '500'))
+UPLOAD_PHOTO_WORKERS = int(os.getenv('UPLOAD_PHOTO_WORKERS', '2'))
+# Качество JPEG при пересохранении фото с поворотом из EXIF
+UPLOAD_PHOTO_QUALITY = int(os.getenv('UPLOAD_PHOTO_QUALITY', '95'))
+# MPO - JPEG с дополнительными кадрами, так сохраняют фото некоторые камеры
+UPLOAD_PHOTO_FORMATS = {'JPEG', 'MPO'}
+UPLOAD_BATCHES_KEEP = 200
+
+def check_photo_header(path: Path) -> tuple:
+    """
+    Быстрая проверка загруженного фото по заголовку, возвращает (ширина, высота).
+    
+    Image.open читает только заголовок, пиксели не декодируются.
+    """
+    try:
+        with Image.open(path) as image:
+            image_format, size = image.format, image.size
+    except Exception:
+        raise ValueError('Файл не является изображением')
+    if image_format not in UPLOAD_PHOTO_FORMATS:
+        raise ValueError(f'Только JPG/JPEG файлы разрешены (получен {image_format})')
+    if min(size) < 1:
+        raise ValueError('Некорректный размер изображения')
+    return size
+
+def add_uploaded_photo(tmp_path: Path, original_filename: str):
+    """Переносит проверенное фото в библиотеку, возвращает (имя, created) как put_file"""
+    filename, created = media_store.put_file('photos', tmp_path, '.jpg')
+    if not created:
+        print(f"♻️ Такое фото уже есть в библиотеке: {filename}")
+        return filename, False
+    timestamp = Path(filename).stem
+    metadata = {
+        'prompt': 'Загружено пользователем',
+        'type': 'uploaded',
+        'original_filename': original_filename,
+        'timestamp': timestamp
+    }
+    write_json_atomic(PHOTOS_DIR / f"{timestamp}.json", metadata)
+    photo_library.add(filename, metadata)
+    schedule_thumbnails('photos', filename)
+    print(f"Загружено фото: {filename} (оригинал: {original_filename})")
+    return filename, True
+
+class PhotoUploadBatches:
+    """Статусы файлов пакетных загрузок (последние UPLOAD_BATCHES_KEEP пакетов, в памяти)"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._batches = OrderedDict()
+    
+    def create(self, files: list) -> str:
+        batch_id = uuid.uuid4().hex
+        with self._lock:
+            self._batches[batch_id] = {'created': datetime.now().isoformat(), 'files': files}
+            while len(self._batches) > UPLOAD_BATCHES_KEEP:
+                self._batches.popitem(last=False)
+        return batch_id
+    
+    def update_file(self, batch_id: str, index: int, status: str, **fields):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch:
+                batch['files'][index].update(status=status, **fields)
+    
+    def get(self, batch_id: str):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                return None
+            batch = json.loads(json.dumps(batch))
+        batch['pending'] = sum(1 for item in batch['files'] if item['status'] == 'processing')
+        return batch
+
+upload_batches = PhotoUploadBatches()
+photo_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_PHOTO_WORKERS, thread_name_prefix='photo-upload')
+
+def process_uploaded_photo(batch_id: str, index: int, tmp_path: Path, original_filename: str):
+    """Фоновая проверка файла пакета: декодирование в пуле нормализации, затем перенос в библиотеку"""
+    try:
+        info = get_normalize_executor().submit(verify_uploaded_photo, str(tmp_path), UPLOAD_PHOTO_QUALITY).result()
+        filename, created = add_uploaded_photo(tmp_path, original_filename)
+        upload_batches.update_file(batch_id, index, 'done' if created else 'duplicate',
+                                   filename=filename, url=f'/api/photos/{filename}', **info)
+    except Exception as e:
+        print(f"❌ Фото {original_filename} не прошло проверку: {e}")
+        tmp_path.unlink(missing_ok=True)
+        upload_batches.update_file(batch_id, index, 'failed', error=f'Файл поврежден или не читается: {e}')
 
 @app.route('/api/upload-photo', methods=['POST'])
 def upload_photo():
     """Upload custom photo to library"""
+    tmp_path = None
     try:
         if 'photo' not in request.files:
             return jsonify({'success': False, 'error': 'Файл не найден'}), 400
@@ -324,416 +2880,864 @@ def upload_photo():
         if file.filename == '':
             return jsonify({'success': False, 'error': 'Файл не выбран'}), 400
         
-        # Проверяем расширение файла
-        allowed_extensions = {'jpg', 'jpeg'}
-        file_ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
-        
-        if file_ext not in allowed_extensions:
-            return jsonify({'success': False, 'error': 'Только JPG/JPEG файлы разрешены'}), 400
-        
-        # Сохраняем фото с именем в формате даты и времени
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{timestamp}.jpg"
-        filepath = PHOTOS_DIR / filename
-        
-        file.save(filepath)
-        
-        # Сохраняем метаданные
-        metadata = {
-            'prompt': 'Загружено пользователем',
-            'type': 'uploaded',
-            'original_filename': file.filename,
-            'timestamp': timestamp
-        }
-        
-        metadata_file = PHOTOS_DIR / f"{timestamp}.json"
-        with open(metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-        
-        print(f"Загружено фото: {filename} (оригинал: {file.filename})")
+        # Сохраняем фото во временный файл и проверяем содержимое, а не расширение
+        tmp_path = media_store.new_temp_path('.jpg')
+        file.save(tmp_path)
+        try:
+            check_photo_header(tmp_path)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         
-        return jsonify({
+        filename, created = add_uploaded_photo(tmp_path, file.filename)
+        tmp_path = None
+        response = {
             'success': True,
             'filename': filename,
             'url': f'/api/photos/{filename}'
-        })
+        }
+        if not created:
+            response['duplicate'] = True
+        return jsonify(response)
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
+    finally:
+        if tmp_path:
+            tmp_path.unlink(missing_ok=True)
 
-@app.route('/api/photos', methods=['GET'])
-def list_photos():
+@app.route('/api/upload-photos', methods=['POST'])
+def upload_photos():
+    """
+    Пакетная загрузка фото в библиотеку (multipart, поле photos с несколькими файлами).
+    
+    Каждый файл пишется во временный файл хранилища по мере чтения запроса,
+    без буферизации в памяти. В ответе - статус каждого файла: rejected (не
+    JPEG по заголовку) или processing. Итог фоновой проверки - через
+    /api/upload-photos/<batch_id>: done, duplicate или failed.
+    """
+    parts = []
+    
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        # Части разбираются по очереди: предыдущая уже записана целиком, закрываем ее,
+        # чтобы открытым оставался один файл, а не по одному на каждый файл пакета
+        if parts:
+            parts[-1].close()
+        part = open(media_store.new_temp_path('.jpg'), 'w+b')
+        parts.append(part)
+        return part
+    
+    queued = set()
     try:
-        photos = []
-        for photo_file in sorted(PHOTOS_DIR.glob('*.jpg'), reverse=True):
-            metadata_file = photo_file.with_suffix('.json')
-            metadata = {}
-            if metadata_file.exists():
-                try:
-                    with open(metadata_file, 'r', encoding='utf-8') as f:
-                        metadata = json.load(f)
-                except Exception as e:
-                    print(f"Ошибка чтения метаданных для {photo_file.name}: {e}")
-            
-            photos.append({
-                'filename': photo_file.name,
-                'url': f'/api/photos/{photo_file.name}',
-                'prompt': metadata.get('prompt', ''),
-                'timestamp': metadata.get('timestamp', '')
-            })
+        try:
+            _, _, files = parse_form_data(
+                request.environ, stream_factory=stream_factory,
+                max_form_parts=UPLOAD_BATCH_MAX_FILES + 10, silent=False
+            )
+        except RequestEntityTooLarge:
+            return jsonify({'success': False, 'error': f'Не больше {UPLOAD_BATCH_MAX_FILES} файлов за раз'}), 413
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Ожидается multipart/form-data с полем photos'}), 400
+        
+        for part in parts:
+            part.close()
+        uploads = [file for file in files.getlist('photos') if file.filename]
+        if not uploads:
+            return jsonify({'success': False, 'error': 'Файлы не выбраны'}), 400
+        if len(uploads) > UPLOAD_BATCH_MAX_FILES:
+            return jsonify({'success': False, 'error': f'Не больше {UPLOAD_BATCH_MAX_FILES} файлов за раз'}), 413
+        
+        results = []
+        accepted = []
+        for file in uploads:
+            tmp_path = Path(file.stream.name)
+            item = {'original_filename': file.filename, 'size': tmp_path.stat().st_size}
+            try:
+                width, height = check_photo_header(tmp_path)
+            except ValueError as e:
+                item.update(status='rejected', error=str(e))
+            else:
+                item.update(status='processing', width=width, height=height)
+                accepted.append((len(results), tmp_path, file.filename))
+            results.append(item)
         
-        return jsonify({'success': True, 'photos': photos})
+        batch_id = upload_batches.create(results)
+        for index, tmp_path, original_filename in accepted:
+            photo_upload_executor.submit(process_uploaded_photo, batch_id, index, tmp_path, original_filename)
+            queued.add(tmp_path)
+        
+        print(f"📥 Пакетная загрузка {batch_id}: {len(accepted)} из {len(results)} файлов на проверке")
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'status_url': f'/api/upload-photos/{batch_id}',
+            'accepted': len(accepted),
+            'rejected': len(results) - len(accepted),
+            'files': results
+        }), 202
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
+    finally:
+        # Отклоненные и недописанные части удаляем, принятые удалит фоновая проверка
+        for part in parts:
+            part.close()
+            if Path(part.name) not in queued:
+                Path(part.name).unlink(missing_ok=True)
+
+@app.route('/api/upload-photos/<batch_id>', methods=['GET'])
+def upload_photos_status(batch_id):
+    """Статусы файлов пакетной загрузки"""
+    batch = upload_batches.get(batch_id)
+    if batch is None:
+        return jsonify({'success': False, 'error': 'Загрузка не найдена'}), 404
+    return jsonify({'success': True, 'batch_id': batch_id, **batch})
 
 # ==================== VIDEO GENERATION ====================
 
-@app.route('/api/generate-video', methods=['POST'])
-def generate_video():
+# Kling 2.0 endpoint (Segmind API)
+KLING_API_URL = os.getenv('KLING_API_URL', "https://api.segmind.com/v1/kling-2")
+
+# Генерация видео выполняется в фоновых задачах, а не в потоке запроса
+JOBS_DB = DATA_DIR / 'jobs.db'
+VIDEO_JOB_WORKERS = int(os.getenv('VIDEO_JOB_WORKERS', '3'))
+VIDEO_JOB_MAX_PENDING = int(os.getenv('VIDEO_JOB_MAX_PENDING', '20'))
+# Задачу выполняет воркер, взявший ее в аренду; аренда продлевается, пока
+# задача идет, и истекает, если процесс упал - тогда задачу подхватит другой
+VIDEO_JOB_LEASE_TTL = int(os.getenv('VIDEO_JOB_LEASE_TTL', '120'))
+
+# Видео пишется на диск потоково, в памяти держится только один chunk
+VIDEO_MAX_BYTES = int(os.getenv('VIDEO_MAX_BYTES', str(500 * 1024 * 1024)))
+VIDEO_MIN_BYTES = 1000
+VIDEO_CHUNK_SIZE = 256 * 1024
+VIDEO_CONTENT_TYPES = ('video/', 'application/octet-stream', 'binary/octet-stream')
+
+# Опрос статуса генерации: интервал растет от MIN до MAX, общий лимит - 10 минут
+SEGMIND_POLL_TIMEOUT = int(os.getenv('SEGMIND_POLL_TIMEOUT', '600'))
+SEGMIND_POLL_MIN_INTERVAL = 1.0
+SEGMIND_POLL_MAX_INTERVAL = float(os.getenv('SEGMIND_POLL_MAX_INTERVAL', '10'))
+
+class VideoGenerationError(Exception):
+    """Ошибка генерации видео с сообщением для пользователя"""
+
+class JobStore(SQLiteStore):
     """
-    Генерация видео через Kling 2.0 (Segmind API)
+    Хранилище фоновых задач генерации видео.
     
-    Используемый endpoint: https://api.segmind.com/v1/kling-2
-    Возвращает либо бинарный mp4, либо JSON с полем url/video_url
+    Состояние задачи сохраняется на диск, поэтому после перезапуска
+    сервера незавершенные задачи можно продолжить.
     """
-    if not segmind_api_key:
-        return jsonify({'success': False, 'error': 'Segmind API не настроен. Добавьте SEGMIND_API_KEY в .env файл'}), 400
     
-    data = request.json
-    prompt = data.get('prompt', 'beautiful animation')
-    seed = data.get('seed', None)
-    duration = data.get('duration', '5')  # '5' or '10'
-    aspect_ratio = data.get('aspect_ratio', '16:9')  # '16:9', '9:16', '1:1'
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            params TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            status_url TEXT,
+            created_time TEXT NOT NULL,
+            updated_time TEXT NOT NULL,
+            owner TEXT,
+            lease_expires REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+    '''
     
-    try:
-        # Kling 2.0 endpoint
-        url = "https://api.segmind.com/v1/kling-2"
-        
-        payload = {
-            'prompt': prompt,
-            'duration': int(duration)
-        }
-        # aspect_ratio и другие параметры могут игнорироваться моделью, но сохраняем в метаданных
-        
-        headers = {
-            'x-api-key': segmind_api_key,
-            'Content-Type': 'application/json'
+    TABLE = 'jobs'
+    ADDED_COLUMNS = (('owner', 'TEXT'), ('lease_expires', 'REAL'))
+    
+    @staticmethod
+    def _row_to_job(row) -> dict:
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'params': json.loads(row['params']),
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'status_url': row['status_url'],
+            'created_time': row['created_time'],
+            'updated_time': row['updated_time']
         }
+    
+    def create_job(self, kind: str, params: dict) -> str:
+        job_id = uuid.uuid4().hex
+        now = datetime.now().isoformat()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, params, created_time, updated_time) VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, json.dumps(params, ensure_ascii=False), now, now)
+            )
+        return job_id
+    
+    def update_job(self, job_id: str, **fields):
+        if 'result' in fields:
+            fields['result'] = json.dumps(fields['result'], ensure_ascii=False)
+        fields['updated_time'] = datetime.now().isoformat()
+        assignments = ', '.join(f'{key} = ?' for key in fields)
+        with self._connect() as conn:
+            conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+    
+    def get_job(self, job_id: str):
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._row_to_job(row) if row else None
+    
+    def claim_job(self, job_id: str, owner: str, ttl: float):
+        """
+        Атомарно берет задачу в работу на ttl секунд.
         
-        print("🎬 Генерация видео через Kling 2.0...")
-        print(f"📝 Промпт: {prompt[:100]}...")
-        print(f"⏱️ Параметры: {aspect_ratio}, {duration} сек")
-        
-        response = requests.post(url, json=payload, headers=headers, timeout=450)
-        print("📡 Ответ получен от API!")
-        
-        if response.status_code == 200:
-            content_type = response.headers.get('Content-Type', '')
-            video_content = None
-            
-            if 'application/json' in content_type:
-                try:
-                    result = response.json()
-                except Exception:
-                    return jsonify({'success': False, 'error': f'Не удалось распарсить JSON ответ: {response.text[:200]}'}), 400
-                
-                # Пытаемся скачать по URL
-                video_url = result.get('video_url') or result.get('url')
-                status_url = result.get('status_url') or result.get('status')
-                
-                if video_url:
-                    print(f"🔗 Скачиваем видео по URL: {video_url}")
-                    dl = requests.get(video_url, timeout=180)
-                    if dl.status_code != 200:
-                        return jsonify({'success': False, 'error': f'Не удалось скачать видео: HTTP {dl.status_code}'}), 400
-                    video_content = dl.content
-                elif status_url:
-                    print(f"⏳ Обнаружен статус: {status_url} — polling до 10 минут...")
-                    import time
-                    for _ in range(600):
-                        st = requests.get(status_url, timeout=10)
-                        if st.status_code == 200:
-                            sj = st.json()
-                            ready_url = sj.get('video_url') or sj.get('url')
-                            if ready_url:
-                                file_resp = requests.get(ready_url, timeout=180)
-                                if file_resp.status_code == 200:
-                                    video_content = file_resp.content
-                                    break
-                        time.sleep(1)
-                    if video_content is None:
-                        return jsonify({'success': False, 'error': 'Видео не готово в течение 10 минут'}), 202
-                else:
-                    return jsonify({'success': False, 'error': f'В ответе нет URL видео: {result}'}), 400
-            else:
-                video_content = response.content
-            
-            if not video_content or len(video_content) < 1000:
-                return jsonify({'success': False, 'error': f'Получен некорректный файл ({len(video_content) if video_content else 0} байт)'}), 400
-            
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-            filename = f"{timestamp}.mp4"
-            filepath = VIDEOS_DIR / filename
-            with open(filepath, 'wb') as f:
-                f.write(video_content)
-            
-            metadata = {
-                'prompt': prompt,
-                'aspect_ratio': aspect_ratio,
-                'duration': int(duration),
-                'seed': seed,
-                'timestamp': timestamp,
-                'type': 'text-to-video',
-                'model': 'kling-2'
-            }
-            metadata_file = VIDEOS_DIR / f"{timestamp}.json"
-            with open(metadata_file, 'w', encoding='utf-8') as f:
-                json.dump(metadata, f, ensure_ascii=False, indent=2)
-            
-            print(f"✅ Видео сохранено: {filename}")
-            return jsonify({'success': True, 'filename': filename, 'url': f'/api/videos/{filename}'})
-        else:
-            error_message = response.text if response.text else 'Ошибка генерации видео'
-            print(f"❌ Ошибка Segmind API (status {response.status_code}): {error_message}")
-            print(f"🔗 Использованный URL: {url}")
-            print(f"📦 Payload: {json.dumps(payload, ensure_ascii=False)[:200]}...")
-            
-            # Более детальная обработка распространенных ошибок
-            if response.status_code == 404:
-                return jsonify({
-                    'success': False, 
-                    'error': f'''❌ Модель не найдена (404). 
-                    
+        Возвращает (job, interrupted) или None, если задача завершена или ее
+        выполняет другой воркер. Задача в статусе running достается только
+        после истечения аренды прежнего воркера, тогда interrupted=True.
+        """
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None or row['status'] not in ('queued', 'running'):
+                return None
+            if row['status'] == 'running' and (row['lease_expires'] or 0) > now:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease_expires = ?, updated_time = ? WHERE id = ?",
+                (owner, now + ttl, datetime.now().isoformat(), job_id)
+            )
+        return self._row_to_job(row), row['status'] == 'running'
+    
+    def renew_leases(self, job_ids: list, owner: str, ttl: float) -> int:
+        """Продлевает аренды задач этого воркера, возвращает число продленных"""
+        if not job_ids:
+            return 0
+        placeholders = ', '.join('?' for _ in job_ids)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET lease_expires = ? WHERE owner = ? AND status = 'running' AND id IN ({placeholders})",
+                (time.time() + ttl, owner, *job_ids)
+            )
+            return cursor.rowcount
+    
+    def resumable_job_ids(self) -> list:
+        """Задачи в очереди и задачи, аренда которых истекла (воркер упал)"""
+        rows = self._connect().execute(
+            "SELECT id FROM jobs WHERE status = 'queued' "
+            "OR (status = 'running' AND (lease_expires IS NULL OR lease_expires <= ?)) ORDER BY created_time",
+            (time.time(),)
+        ).fetchall()
+        return [row['id'] for row in rows]
+    
+    def count_pending(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+
+job_store = JobStore(JOBS_DB)
+metrics.register(Gauge('video_jobs_pending', 'Задачи генерации видео в очереди и в работе', job_store.count_pending))
+video_job_executor = ThreadPoolExecutor(max_workers=VIDEO_JOB_WORKERS, thread_name_prefix='video-jobs')
+video_jobs_lock = threading.Lock()
+active_video_jobs = set()  # задачи, поставленные в пул этого процесса
+
+def segmind_error_message(status_code: int, error_message: str, kind: str) -> str:
+    """Понятное пользователю описание ошибки Segmind API"""
+    is_i2v = kind == 'image-to-video'
+    if status_code == 404:
+        return f'''❌ Модель не найдена (404).
+
 Возможные причины:
 1. URL эндпоинта устарел или неправильный
-2. Модель Kling AI больше не доступна через этот эндпоинт
+2. Модель {'Kling AI Image-to-Video' if is_i2v else 'Kling AI'} больше не доступна через этот эндпоинт
 
-Используемый URL: {url}
+Используемый URL: {KLING_API_URL}
 
 Решение:
 1. Проверьте актуальную документацию на https://www.segmind.com/models
-2. Найдите правильный эндпоинт для Kling Video
-3. Обновите URL в app.py (строка 294 для text-to-video)
+2. Найдите правильный эндпоинт для {'Kling Image-to-Video' if is_i2v else 'Kling Video'}
+3. Обновите KLING_API_URL в app.py
 
 API ответ: {error_message[:200]}'''
-                }), 400
-            elif response.status_code == 400:
-                if 'api key' in error_message.lower() or 'unauthorized' in error_message.lower():
-                    return jsonify({'success': False, 'error': 'Неверный API ключ Segmind. Проверьте SEGMIND_API_KEY в .env файле'}), 400
-                elif 'insufficient credits' in error_message.lower() or 'quota' in error_message.lower():
-                    return jsonify({'success': False, 'error': 'Недостаточно кредитов на балансе Segmind. Пополните баланс на https://www.segmind.com/'}), 400
-                else:
-                    return jsonify({'success': False, 'error': f'Ошибка генерации видео: {error_message}'}), 400
-            else:
-                return jsonify({'success': False, 'error': f'Ошибка сервера Segmind ({response.status_code}): {error_message}'}), 400
-    except requests.exceptions.ReadTimeout as e:
-        print(f"❌ ReadTimeout при обращении к Kling 2.0: {e}")
-        return jsonify({'success': False, 'error': 'Таймаут генерации видео. Попробуйте еще раз позже.'}), 202
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Ошибка запроса к API Segmind: {e}")
-        return jsonify({'success': False, 'error': f'Ошибка при обращении к API Segmind: {str(e)}'}), 400
-    except Exception as e:
-        print(f"❌ Непредвиденная ошибка при генерации видео: {e}")
-        return jsonify({'success': False, 'error': str(e)}), 400
+    elif status_code == 400:
+        if 'api key' in error_message.lower() or 'unauthorized' in error_message.lower():
+            return 'Неверный API ключ Segmind. Проверьте SEGMIND_API_KEY в .env файле'
+        elif 'insufficient credits' in error_message.lower() or 'quota' in error_message.lower():
+            return 'Недостаточно кредитов на балансе Segmind. Пополните баланс на https://www.segmind.com/'
+        else:
+            return f"{'Ошибка генерации видео из изображения' if is_i2v else 'Ошибка генерации видео'}: {error_message}"
+    return f'Ошибка сервера Segmind ({status_code}): {error_message}'
 
-@app.route('/api/generate-image-to-video', methods=['POST'])
-def generate_image_to_video():
+class StreamingBase64JSONBody:
     """
-    Генерация видео из изображения через Kling 2.0 (Segmind API)
+    Тело JSON запроса, одно из полей которого - файл в base64 (data URI).
     
-    Используемый endpoint: https://api.segmind.com/v1/kling-2
+    Файл кодируется по частям прямо во время отправки, поэтому ни сам
+    файл, ни его base64 представление не хранятся в памяти целиком.
+    Длина тела известна заранее, так что запрос уходит с Content-Length.
     """
-    if not segmind_api_key:
-        return jsonify({'success': False, 'error': 'Segmind API не настроен. Добавьте SEGMIND_API_KEY в .env файл'}), 400
     
-    data = request.json
-    image_filename = data.get('image_filename', '')
-    prompt = data.get('prompt', 'smooth camera movement')
-    seed = data.get('seed', None)
-    duration = data.get('duration', '5')
-    aspect_ratio = data.get('aspect_ratio', '16:9')
+    # Кратно 3, чтобы base64 части склеивались без промежуточного паддинга
+    CHUNK_SIZE = 3 * 64 * 1024
     
-    if not image_filename:
-        return jsonify({'success': False, 'error': 'Не указано изображение'}), 400
+    def __init__(self, fields: dict, file_field: str, file_path: Path, data_uri_prefix: str):
+        head = json.dumps(fields, ensure_ascii=False)[:-1]
+        separator = ', ' if fields else ''
+        self._prefix = f'{head}{separator}{json.dumps(file_field)}: "{data_uri_prefix}'.encode('utf-8')
+        self._suffix = b'"}'
+        self._file_path = file_path
+        file_size = file_path.stat().st_size
+        self._length = len(self._prefix) + 4 * ((file_size + 2) // 3) + len(self._suffix)
+        self.rewind()
+    
+    def rewind(self):
+        """Возвращает тело в начало (для повторной отправки)"""
+        self._parts = self._iter_parts()
+        self._buffer = b''
+    
+    def _iter_parts(self):
+        yield self._prefix
+        with open(self._file_path, 'rb') as f:
+            while True:
+                chunk = f.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield base64.b64encode(chunk)
+        yield self._suffix
+    
+    def __len__(self):
+        return self._length
+    
+    def __iter__(self):
+        return iter(lambda: self.read(self.CHUNK_SIZE), b'')
+    
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._parts)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def new_video_part_path() -> Path:
+    """Временный файл в VIDEOS_DIR (та же ФС - атомарный rename при сохранении)"""
+    return VIDEOS_DIR / f'.{uuid.uuid4().hex}.mp4.part'
+
+def stream_video_to_file(response, target_path: Path) -> int:
+    """Потоково пишет видео из ответа в файл, проверяя тип и размер"""
+    content_type = response.headers.get('Content-Type', '')
+    if content_type and not content_type.startswith(VIDEO_CONTENT_TYPES):
+        raise VideoGenerationError(f'Получен некорректный тип файла: {content_type}')
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit() and int(content_length) > VIDEO_MAX_BYTES:
+        raise VideoGenerationError(f'Видео слишком большое ({int(content_length)} байт)')
     
+    written = 0
     try:
-        # Проверяем существование файла
-        image_path = PHOTOS_DIR / image_filename
+        with open(target_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=VIDEO_CHUNK_SIZE):
+                written += len(chunk)
+                if written > VIDEO_MAX_BYTES:
+                    raise VideoGenerationError(f'Видео слишком большое (больше {VIDEO_MAX_BYTES} байт)')
+                f.write(chunk)
+    except Exception:
+        target_path.unlink(missing_ok=True)
+        raise
+    finally:
+        response.close()
+    
+    EXTERNAL_BYTES.inc(written, service=external_service_name(urlparse(response.url or '').netloc), direction='down')
+    if written < VIDEO_MIN_BYTES:
+        target_path.unlink(missing_ok=True)
+        raise VideoGenerationError(f'Получен некорректный файл ({written} байт)')
+    return written
+
+def download_video(video_url: str) -> Path:
+    print(f"🔗 Скачиваем видео по URL: {video_url}")
+    dl = http_clients.for_url(video_url).get(video_url, stream=True)
+    if dl.status_code != 200:
+        dl.close()
+        raise VideoGenerationError(f'Не удалось скачать видео: HTTP {dl.status_code}')
+    part_path = new_video_part_path()
+    stream_video_to_file(dl, part_path)
+    return part_path
+
+def poll_segmind_status(status_url: str) -> Path:
+    """Опрашивает статус с растущим интервалом (1 с -> SEGMIND_POLL_MAX_INTERVAL)"""
+    print(f"⏳ Обнаружен статус: {status_url} — polling до {SEGMIND_POLL_TIMEOUT // 60} минут...")
+    client = http_clients.for_url(status_url)
+    deadline = time.monotonic() + SEGMIND_POLL_TIMEOUT
+    interval = SEGMIND_POLL_MIN_INTERVAL
+    while time.monotonic() < deadline:
+        st = client.get(status_url, timeout=(HTTP_CONNECT_TIMEOUT, 10))
+        if st.status_code == 200:
+            sj = st.json()
+            ready_url = sj.get('video_url') or sj.get('url')
+            if ready_url:
+                try:
+                    return download_video(ready_url)
+                except VideoGenerationError as e:
+                    print(f"⚠️ Видео по готовому URL пока недоступно: {e}")
+        # Сервер может сам подсказать, когда спрашивать снова
+        retry_after = st.headers.get('Retry-After', '')
+        delay = float(retry_after) if retry_after.isdigit() else interval
+        time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+        interval = min(interval * 1.5, SEGMIND_POLL_MAX_INTERVAL)
+    raise VideoGenerationError(f'Видео не готово в течение {SEGMIND_POLL_TIMEOUT // 60} минут')
+
+def request_kling_video(job: dict) -> Path:
+    """Отправляет запрос в Kling 2.0 и возвращает путь к временному файлу готового видео"""
+    params = job['params']
+    payload = {
+        'prompt': params['prompt'],
+        'duration': int(params['duration'])
+    }
+    # aspect_ratio и другие параметры могут игнорироваться моделью, но сохраняем в метаданных
+    body = None
+    
+    if job['kind'] == 'image-to-video':
+        image_path = PHOTOS_DIR / params['image_filename']
         if not image_path.exists():
-            return jsonify({'success': False, 'error': f'Изображение не найдено: {image_filename}'}), 400
-        
-        # Читаем изображение и конвертируем в base64
-        import base64
-        with open(image_path, 'rb') as f:
-            image_data = base64.b64encode(f.read()).decode('utf-8')
-        
-        # Kling 2.0 endpoint
-        url = "https://api.segmind.com/v1/kling-2"
-        
-        payload = {
-            'prompt': prompt,
-            'duration': int(duration),
-            'start_image': f'data:image/jpeg;base64,{image_data}'
-        }
-        headers = {
-            'x-api-key': segmind_api_key,
-            'Content-Type': 'application/json'
-        }
+            raise VideoGenerationError(f"Изображение не найдено: {params['image_filename']}")
         
+        # Изображение кодируется в base64 потоково во время отправки запроса
+        body = StreamingBase64JSONBody(payload, 'start_image', image_path, 'data:image/jpeg;base64,')
         print("🎬 Генерация видео из изображения через Kling 2.0...")
-        response = requests.post(url, json=payload, headers=headers, timeout=450)
-        print("📡 Ответ получен от API!")
-        
-        if response.status_code == 200:
-            content_type = response.headers.get('Content-Type', '')
-            video_content = None
-            
-            if 'application/json' in content_type:
-                try:
-                    result = response.json()
-                except Exception:
-                    return jsonify({'success': False, 'error': f'Не удалось распарсить JSON ответ: {response.text[:200]}'}), 400
-                
-                video_url = result.get('video_url') or result.get('url')
-                status_url = result.get('status_url') or result.get('status')
-                
-                if video_url:
-                    print(f"🔗 Скачиваем видео по URL: {video_url}")
-                    dl = requests.get(video_url, timeout=180)
-                    if dl.status_code != 200:
-                        return jsonify({'success': False, 'error': f'Не удалось скачать видео: HTTP {dl.status_code}'}), 400
-                    video_content = dl.content
-                elif status_url:
-                    print(f"⏳ Обнаружен статус: {status_url} — polling до 10 минут...")
-                    import time
-                    for _ in range(600):
-                        st = requests.get(status_url, timeout=10)
-                        if st.status_code == 200:
-                            sj = st.json()
-                            ready_url = sj.get('video_url') or sj.get('url')
-                            if ready_url:
-                                file_resp = requests.get(ready_url, timeout=180)
-                                if file_resp.status_code == 200:
-                                    video_content = file_resp.content
-                                    break
-                        time.sleep(1)
-                    if video_content is None:
-                        return jsonify({'success': False, 'error': 'Видео не готово в течение 10 минут'}), 202
-                else:
-                    return jsonify({'success': False, 'error': f'В ответе нет URL видео: {result}'}), 400
-            else:
-                video_content = response.content
-            
-            if not video_content or len(video_content) < 1000:
-                return jsonify({'success': False, 'error': f'Получен некорректный файл ({len(video_content) if video_content else 0} байт)'}), 400
-            
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-            filename = f"{timestamp}.mp4"
-            filepath = VIDEOS_DIR / filename
-            with open(filepath, 'wb') as f:
-                f.write(video_content)
-            
-            metadata = {
-                'prompt': prompt,
-                'source_image': image_filename,
-                'aspect_ratio': aspect_ratio,
-                'duration': int(duration),
-                'seed': seed,
-                'timestamp': timestamp,
-                'type': 'image-to-video',
-                'model': 'kling-2'
-            }
-            metadata_file = VIDEOS_DIR / f"{timestamp}.json"
-            with open(metadata_file, 'w', encoding='utf-8') as f:
-                json.dump(metadata, f, ensure_ascii=False, indent=2)
-            
-            print(f"✅ Видео сохранено: {filename}")
-            return jsonify({'success': True, 'filename': filename, 'url': f'/api/videos/{filename}'})
+    else:
+        print("🎬 Генерация видео через Kling 2.0...")
+        print(f"📝 Промпт: {params['prompt'][:100]}...")
+        print(f"⏱️ Параметры: {params['aspect_ratio']}, {params['duration']} сек")
+    
+    headers = {
+        'x-api-key': segmind_api_key,
+        'Content-Type': 'application/json'
+    }
+    
+    if body is None:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    response = http_clients.for_url(KLING_API_URL).post(KLING_API_URL, data=body, headers=headers, stream=True)
+    print("📡 Ответ получен от API!")
+    
+    if response.status_code != 200:
+        error_message = response.text if response.text else 'Ошибка генерации видео'
+        print(f"❌ Ошибка Segmind API (status {response.status_code}): {error_message}")
+        print(f"🔗 Использованный URL: {KLING_API_URL}")
+        print(f"📦 Payload keys: {list(payload.keys()) + (['start_image'] if job['kind'] == 'image-to-video' else [])}")
+        raise VideoGenerationError(segmind_error_message(response.status_code, error_message, job['kind']))
+    
+    content_type = response.headers.get('Content-Type', '')
+    if 'application/json' not in content_type:
+        part_path = new_video_part_path()
+        stream_video_to_file(response, part_path)
+        return part_path
+    
+    try:
+        result = response.json()
+    except Exception:
+        raise VideoGenerationError(f'Не удалось распарсить JSON ответ: {response.text[:200]}')
+    
+    # Пытаемся скачать по URL
+    video_url = result.get('video_url') or result.get('url')
+    status_url = result.get('status_url') or result.get('status')
+    
+    if video_url:
+        return download_video(video_url)
+    elif status_url:
+        # Сохраняем status_url, чтобы после перезапуска продолжить опрос без повторной оплаты
+        job_store.update_job(job['id'], status_url=status_url)
+        return poll_segmind_status(status_url)
+    raise VideoGenerationError(f'В ответе нет URL видео: {result}')
+
+def save_generated_video(job: dict, part_path: Path) -> dict:
+    params = job['params']
+    # Атомарно переносим полностью скачанный файл в хранилище
+    filename, created = media_store.put_file('videos', part_path, '.mp4')
+    if not created:
+        print(f"♻️ Такое видео уже есть в библиотеке: {filename}")
+        return {'filename': filename, 'url': f'/api/videos/{filename}'}
+    timestamp = Path(filename).stem
+    
+    metadata = {'prompt': params['prompt']}
+    if job['kind'] == 'image-to-video':
+        metadata['source_image'] = params['image_filename']
+    metadata.update({
+        'aspect_ratio': params['aspect_ratio'],
+        'duration': int(params['duration']),
+        'seed': params['seed'],
+        'timestamp': timestamp,
+        'type': job['kind'],
+        'model': 'kling-2'
+    })
+    write_json_atomic(VIDEOS_DIR / f"{timestamp}.json", metadata)
+    video_library.add(filename, metadata)
+    schedule_thumbnails('videos', filename)
+    
+    print(f"✅ Видео сохранено: {filename}")
+    return {'filename': filename, 'url': f'/api/videos/{filename}'}
+
+def run_video_job(job_id: str):
+    """Выполняет задачу генерации видео в фоновом потоке"""
+    try:
+        execute_video_job(job_id)
+    finally:
+        with video_jobs_lock:
+            active_video_jobs.discard(job_id)
+
+def execute_video_job(job_id: str):
+    # Задачу может одновременно подхватить несколько процессов - выполняет взявший аренду
+    try:
+        claimed = job_store.claim_job(job_id, SCHEDULER_WORKER_ID, VIDEO_JOB_LEASE_TTL)
+    except Exception as e:
+        print(f"❌ Ошибка аренды задачи {job_id}: {e}")
+        return
+    if claimed is None:
+        return
+    job, interrupted = claimed
+    if interrupted and not job['status_url']:
+        # Синхронный запрос к Segmind был оборван, результат получить уже нельзя
+        job_store.update_job(job_id, status='failed', error='Генерация прервана перезапуском сервера. Попробуйте еще раз.')
+        return
+    
+    try:
+        if job['status_url']:
+            # Задача была прервана перезапуском после получения status_url
+            part_path = poll_segmind_status(job['status_url'])
         else:
-            error_message = response.text if response.text else 'Ошибка генерации видео из изображения'
-            print(f"❌ Ошибка Segmind API Image-to-Video (status {response.status_code}): {error_message}")
-            print(f"🔗 Использованный URL: {url}")
-            print(f"📦 Payload keys: {list(payload.keys())}")
-            
-            # Более детальная обработка распространенных ошибок
-            if response.status_code == 404:
-                return jsonify({
-                    'success': False, 
-                    'error': f'''❌ Модель не найдена (404). 
-                    
-Возможные причины:
-1. URL эндпоинта устарел или неправильный
-2. Модель Kling AI Image-to-Video больше не доступна через этот эндпоинт
+            part_path = request_kling_video(job)
+        result = save_generated_video(job, part_path)
+        job_store.update_job(job_id, status='done', result=result)
+    except VideoGenerationError as e:
+        job_store.update_job(job_id, status='failed', error=str(e))
+    except requests.exceptions.ReadTimeout as e:
+        print(f"❌ ReadTimeout при обращении к Kling 2.0: {e}")
+        job_store.update_job(job_id, status='failed', error='Таймаут генерации видео. Попробуйте еще раз позже.')
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Ошибка запроса к API Segmind: {e}")
+        job_store.update_job(job_id, status='failed', error=f'Ошибка при обращении к API Segmind: {str(e)}')
+    except Exception as e:
+        print(f"❌ Непредвиденная ошибка при генерации видео: {e}")
+        job_store.update_job(job_id, status='failed', error=str(e))
+
+def start_video_job(job_id: str):
+    """Ставит задачу в пул, если этот процесс еще не поставил ее"""
+    with video_jobs_lock:
+        if job_id in active_video_jobs:
+            return
+        active_video_jobs.add(job_id)
+    video_job_executor.submit(run_video_job, job_id)
+
+def resume_video_jobs():
+    """
+    Подхватывает задачи из базы: не начатые и брошенные упавшими воркерами.
+    
+    Запускается периодически в каждом процессе; задачу, которую уже
+    выполняет живой воркер, claim_job никому не отдаст.
+    """
+    try:
+        job_ids = job_store.resumable_job_ids()
+    except Exception as e:
+        print(f"❌ Ошибка чтения задач генерации видео: {e}")
+        return
+    for job_id in job_ids:
+        start_video_job(job_id)
+
+def renew_video_job_leases():
+    """Heartbeat: продлевает аренду задач, которые выполняет этот процесс"""
+    with video_jobs_lock:
+        job_ids = list(active_video_jobs)
+    try:
+        job_store.renew_leases(job_ids, SCHEDULER_WORKER_ID, VIDEO_JOB_LEASE_TTL)
+    except Exception as e:
+        print(f"❌ Ошибка продления аренды задач генерации видео: {e}")
+
+def submit_video_job(kind: str, params: dict):
+    if job_store.count_pending() >= VIDEO_JOB_MAX_PENDING:
+        return jsonify({'success': False, 'error': 'Слишком много видео в очереди. Дождитесь завершения текущих задач.'}), 429
+    job_id = job_store.create_job(kind, params)
+    start_video_job(job_id)
+    print(f"📥 Задача генерации видео поставлена в очередь: {job_id}")
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': f'/api/jobs/{job_id}'
+    }), 202
 
-Используемый URL: {url}
+@app.route('/api/generate-video', methods=['POST'])
+def generate_video():
+    """
+    Генерация видео через Kling 2.0 (Segmind API)
+    
+    Используемый endpoint: https://api.segmind.com/v1/kling-2
+    Возвращает job_id задачи, результат доступен через /api/jobs/<job_id>
+    """
+    if not segmind_api_key:
+        return jsonify({'success': False, 'error': 'Segmind API не настроен. Добавьте SEGMIND_API_KEY в .env файл'}), 400
+    
+    data = request.json
+    return submit_video_job('text-to-video', {
+        'prompt': data.get('prompt', 'beautiful animation'),
+        'seed': data.get('seed', None),
+        'duration': data.get('duration', '5'),  # '5' or '10'
+        'aspect_ratio': data.get('aspect_ratio', '16:9')  # '16:9', '9:16', '1:1'
+    })
 
-Решение:
-1. Проверьте актуальную документацию на https://www.segmind.com/models
-2. Найдите правильный эндпоинт для Kling Image-to-Video
-3. Обновите URL в app.py (строка 437 для image-to-video)
+@app.route('/api/generate-image-to-video', methods=['POST'])
+def generate_image_to_video():
+    """
+    Генерация видео из изображения через Kling 2.0 (Segmind API)
+    
+    Используемый endpoint: https://api.segmind.com/v1/kling-2
+    Возвращает job_id задачи, результат доступен через /api/jobs/<job_id>
+    """
+    if not segmind_api_key:
+        return jsonify({'success': False, 'error': 'Segmind API не настроен. Добавьте SEGMIND_API_KEY в .env файл'}), 400
+    
+    data = request.json
+    image_filename = data.get('image_filename', '')
+    
+    if not image_filename:
+        return jsonify({'success': False, 'error': 'Не указано изображение'}), 400
+    
+    # Проверяем существование файла
+    if not (PHOTOS_DIR / image_filename).exists():
+        return jsonify({'success': False, 'error': f'Изображение не найдено: {image_filename}'}), 400
+    
+    return submit_video_job('image-to-video', {
+        'image_filename': image_filename,
+        'prompt': data.get('prompt', 'smooth camera movement'),
+        'seed': data.get('seed', None),
+        'duration': data.get('duration', '5'),
+        'aspect_ratio': data.get('aspect_ratio', '16:9')
+    })
 
-API ответ: {error_message[:200]}'''
-                }), 400
-            elif response.status_code == 400:
-                if 'api key' in error_message.lower() or 'unauthorized' in error_message.lower():
-                    return jsonify({'success': False, 'error': 'Неверный API ключ Segmind. Проверьте SEGMIND_API_KEY в .env файле'}), 400
-                elif 'insufficient credits' in error_message.lower() or 'quota' in error_message.lower():
-                    return jsonify({'success': False, 'error': 'Недостаточно кредитов на балансе Segmind. Пополните баланс на https://www.segmind.com/'}), 400
-                else:
-                    return jsonify({'success': False, 'error': f'Ошибка генерации видео из изображения: {error_message}'}), 400
-            else:
-                return jsonify({'success': False, 'error': f'Ошибка сервера Segmind ({response.status_code}): {error_message}'}), 400
-    except requests.exceptions.ReadTimeout as e:
-        print(f"❌ ReadTimeout при обращении к Kling 2.0: {e}")
-        return jsonify({'success': False, 'error': 'Таймаут генерации видео. Попробуйте еще раз позже.'}), 202
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Ошибка запроса к API Segmind: {e}")
-        return jsonify({'success': False, 'error': f'Ошибка при обращении к API Segmind: {str(e)}'}), 400
-    except Exception as e:
-        print(f"❌ Непредвиденная ошибка при генерации видео из изображения: {e}")
-        return jsonify({'success': False, 'error': str(e)}), 400
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """Статус фоновой задачи: queued, running, done или failed"""
+    job = job_store.get_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Задача не найдена'}), 404
+    return jsonify({
+        'success': True,
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'result': job['result'],
+        'error': job['error'],
+        'created_time': job['created_time'],
+        'updated_time': job['updated_time']
+    })
 
 @app.route('/api/videos/<filename>')
 def get_video(filename):
-    return send_from_directory(VIDEOS_DIR, filename)
+    return send_media(VIDEOS_DIR, filename, 'videos')
 
 @app.route('/api/videos', methods=['GET'])
 def list_videos():
     try:
-        videos = []
-        for video_file in sorted(VIDEOS_DIR.glob('*.mp4'), reverse=True):
-            metadata_file = video_file.with_suffix('.json')
-            metadata = {}
-            if metadata_file.exists():
-                try:
-                    with open(metadata_file, 'r', encoding='utf-8') as f:
-                        metadata = json.load(f)
-                except Exception as e:
-                    print(f"Ошибка чтения метаданных для {video_file.name}: {e}")
-            
-            videos.append({
-                'filename': video_file.name,
-                'url': f'/api/videos/{video_file.name}',
-                'prompt': metadata.get('prompt', ''),
-                'timestamp': metadata.get('timestamp', '')
-            })
-        
-        return jsonify({'success': True, 'videos': videos})
+        limit, cursor = get_library_page_args()
+        videos, next_cursor = video_library.page(limit, cursor)
+        return jsonify({'success': True, 'videos': videos, 'next_cursor': next_cursor})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
 # ==================== GEMINI TEXT GENERATION ====================
 
-@app.route('/api/generate-prompt', methods=['POST'])
-def generate_prompt():
-    """Generate image prompt based on post topic"""
-    if not gemini_api_key:
-        return jsonify({'success': False, 'error': 'Gemini API не настроен. Добавьте GEMINI_API_KEY в .env файл'}), 400
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL', 'gemini-2.0-flash-exp')
+
+# Кэш ответов Gemini: одинаковая тема с теми же настройками не генерируется заново
+GEMINI_CACHE_DB = DATA_DIR / 'gemini_cache.db'
+GEMINI_CACHE_SIZE = int(os.getenv('GEMINI_CACHE_SIZE', '1000'))
+GEMINI_CACHE_TTL = int(os.getenv('GEMINI_CACHE_TTL', str(24 * 3600)))
+
+gemini_model = None
+gemini_model_lock = threading.Lock()
+
+def get_gemini_model():
+    """Один экземпляр модели на весь процесс вместо нового на каждый запрос"""
+    global gemini_model
+    if gemini_model is None:
+        with gemini_model_lock:
+            if gemini_model is None:
+                import google.generativeai as genai
+                
+                genai.configure(api_key=gemini_api_key)
+                gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return gemini_model
+
+class GeminiResponseCache(SQLiteStore):
+    """
+    LRU/TTL кэш ответов Gemini, сохраняемый на диск.
     
-    data = request.json
-    topic = data.get('topic', '')
+    Ключ - хэш полного промпта и настроек генерации. Записи старше TTL
+    считаются промахом, при превышении размера удаляются давно не
+    использованные.
+    """
     
-    try:
-        full_prompt = f"""Ты - эксперт по созданию промптов для генерации изображений. На основе следующей темы создай ВИЗУАЛЬНЫЙ промпт на английском языке для AI генератора изображений.
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used);
+    '''
+    
+    def __init__(self, db_path: Path, max_size: int, ttl: int):
+        super().__init__(db_path)
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'bypasses': 0, 'evictions': 0}
+    
+    @staticmethod
+    def make_key(kind: str, full_prompt: str, options: dict) -> str:
+        raw = json.dumps({'model': GEMINI_MODEL_NAME, 'kind': kind, 'prompt': full_prompt, 'options': options},
+                         ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def _count(self, key: str, delta: int = 1):
+        with self._lock:
+            self._stats[key] += delta
+    
+    def get(self, key: str):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute('SELECT text, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row and now - row['created_at'] < self.ttl:
+                conn.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now, key))
+                self._count('hits')
+                return row['text']
+            if row:
+                conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+        self._count('misses')
+        return None
+    
+    def record_bypass(self):
+        self._count('bypasses')
+    
+    def put(self, key: str, kind: str, text: str):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO responses (key, kind, text, created_at, last_used) VALUES (?, ?, ?, ?, ?)',
+                (key, kind, text, now, now)
+            )
+            # Вытесняем давно не использованные записи сверх лимита
+            evicted = conn.execute(
+                'DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_size,)
+            ).rowcount
+        if evicted:
+            self._count('evictions', evicted)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['size'] = self._connect().execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else None
+        return stats
+
+gemini_cache = GeminiResponseCache(GEMINI_CACHE_DB, GEMINI_CACHE_SIZE, GEMINI_CACHE_TTL)
+
+def gemini_cache_lookup(kind: str, full_prompt: str, options: dict = None, regenerate: bool = False):
+    """Ключ кэша и сохраненный ответ (None - промах или regenerate)"""
+    key = gemini_cache.make_key(kind, full_prompt, options or {})
+    if regenerate:
+        gemini_cache.record_bypass()
+        return key, None
+    return key, gemini_cache.get(key)
+
+def generate_with_cache(kind: str, full_prompt: str, options: dict = None, regenerate: bool = False, postprocess=None,
+                        generation_config: dict = None):
+    """
+    Генерирует текст через Gemini с кэшированием ответа.
+    
+    regenerate=True пропускает чтение кэша (кнопки "создать новый"),
+    но новый ответ все равно сохраняется. Возвращает (text, cached).
+    """
+    key, cached_text = gemini_cache_lookup(kind, full_prompt, options, regenerate)
+    if cached_text is not None:
+        return cached_text, True
+    
+    with track_external('gemini', kind):
+        response = get_gemini_model().generate_content(full_prompt, generation_config=generation_config)
+    text = postprocess(response.text) if postprocess else response.text
+    gemini_cache.put(key, kind, text)
+    return text, False
+
+def clean_markdown(generated_text: str) -> str:
+    """Постобработка: удаляем markdown разметку, если она осталась"""
+    # Убираем markdown заголовки (## Заголовок)
+    generated_text = re.sub(r'^#{1,6}\s+', '', generated_text, flags=re.MULTILINE)
+    # Убираем жирный текст (**текст**)
+    generated_text = re.sub(r'\*\*(.+?)\*\*', r'\1', generated_text)
+    # Убираем курсив (*текст* или _текст_)
+    generated_text = re.sub(r'\*(.+?)\*', r'\1', generated_text)
+    generated_text = re.sub(r'_(.+?)_', r'\1', generated_text)
+    # Убираем зачеркнутый текст (~~текст~~)
+    generated_text = re.sub(r'~~(.+?)~~', r'\1', generated_text)
+    return generated_text
+
+class MarkdownStreamCleaner:
+    """
+    Инкрементальная версия clean_markdown для потоковой генерации.
+    
+    Отдается только та часть текста, очистка которой уже не изменится:
+    сырой текст до первого маркера (*, _, ~) в незавершенной строке, без
+    незаконченного заголовка в конце. Правила выделения не выходят за
+    пределы строки, а любое совпадение начинается с маркера, поэтому
+    очищенная стабильная часть - всегда начало clean_markdown всего текста.
+    Итоговый текст - text(), то есть clean_markdown всего ответа.
+    """
+    
+    MARKERS = re.compile(r'[*_~]')
+    # "#" в начале строки, за которым пока только пробелы: заголовок еще может съесть продолжение
+    OPEN_HEADER = re.compile(r'(?:^|(?<=\n))#{1,6}\s*\Z')
+    
+    def __init__(self):
+        self._text = ''
+        self._emitted = 0  # сколько символов очищенного текста уже отдано
+    
+    def feed(self, chunk: str) -> str:
+        """Принимает кусок сырого текста, возвращает готовый к показу очищенный текст"""
+        self._text += chunk
+        line_start = self._text.rfind('\n') + 1
+        marker = self.MARKERS.search(self._text, line_start)
+        stable = self._text[:marker.start()] if marker else self._text
+        header = self.OPEN_HEADER.search(stable)
+        if header:
+            stable = stable[:header.start()]
+        cleaned = clean_markdown(stable)
+        if len(cleaned) <= self._emitted:
+            return ''
+        piece = cleaned[self._emitted:]
+        self._emitted = len(cleaned)
+        return piece
+    
+    def flush(self) -> str:
+        """Отдает остаток текста в конце генерации"""
+        rest = self.text()[self._emitted:]
+        self._emitted += len(rest)
+        return rest
+    
+    def text(self) -> str:
+        """Полный очищенный текст (совпадает с clean_markdown всего ответа)"""
+        return clean_markdown(self._text)
+
+def sse_event(data: dict, event: str = None) -> str:
+    """Одно событие Server-Sent Events"""
+    prefix = f'event: {event}\n' if event else ''
+    return f'{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+@app.route('/api/gemini/cache/stats', methods=['GET'])
+def gemini_cache_stats():
+    """Статистика кэша ответов Gemini"""
+    return jsonify({'success': True, 'stats': gemini_cache.stats()})
+
+def build_image_prompt(topic: str) -> str:
+    """Промпт Gemini для визуального промпта генератора изображений"""
+    full_prompt = f"""Ты - эксперт по созданию промптов для генерации изображений. На основе следующей темы создай ВИЗУАЛЬНЫЙ промпт на английском языке для AI генератора изображений.
 
 ТЕМА ПОСТА: {topic}
 
@@ -750,20 +3754,11 @@ def generate_prompt():
 - Тема: "Здоровый завтрак" → "Healthy breakfast scene: fresh fruits, avocado toast, smoothie bowl, natural sunlight, minimalist white table, top view, bright and fresh, food photography, instagram style"
 
 Верни ТОЛЬКО промпт на английском, без объяснений и комментариев."""
-        
-        model = genai.GenerativeModel('gemini-2.0-flash-exp')
-        response = model.generate_content(full_prompt)
-        
-        return jsonify({
-            'success': True,
-            'prompt': response.text.strip()
-        })
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 400
+    return full_prompt
 
-@app.route('/api/generate-video-prompt', methods=['POST'])
-def generate_video_prompt():
-    """Generate video prompt based on post topic"""
+@app.route('/api/generate-prompt', methods=['POST'])
+def generate_prompt():
+    """Generate image prompt based on post topic"""
     if not gemini_api_key:
         return jsonify({'success': False, 'error': 'Gemini API не настроен. Добавьте GEMINI_API_KEY в .env файл'}), 400
     
@@ -771,7 +3766,22 @@ def generate_video_prompt():
     topic = data.get('topic', '')
     
     try:
-        full_prompt = f"""Ты - эксперт по созданию промптов для генерации видео. На основе следующей темы создай ДИНАМИЧЕСКИЙ промпт на английском языке для AI генератора видео.
+        full_prompt = build_image_prompt(topic)
+        
+        prompt, cached = generate_with_cache('image-prompt', full_prompt, regenerate=bool(data.get('regenerate')),
+                                             postprocess=str.strip)
+        
+        return jsonify({
+            'success': True,
+            'prompt': prompt,
+            'cached': cached
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+def build_video_prompt(topic: str) -> str:
+    """Промпт Gemini для динамического промпта генератора видео"""
+    full_prompt = f"""Ты - эксперт по созданию промптов для генерации видео. На основе следующей темы создай ДИНАМИЧЕСКИЙ промпт на английском языке для AI генератора видео.
 
 ТЕМА ПОСТА: {topic}
 
@@ -789,40 +3799,44 @@ def generate_video_prompt():
 - Тема: "Природа весной" → "Spring meadow with flowers swaying in breeze, butterflies flying, camera dolly forward through grass, soft sunlight, green and colorful, gentle motion, fresh atmosphere"
 
 Верни ТОЛЬКО промпт на английском, без объяснений и комментариев."""
+    return full_prompt
+
+@app.route('/api/generate-video-prompt', methods=['POST'])
+def generate_video_prompt():
+    """Generate video prompt based on post topic"""
+    if not gemini_api_key:
+        return jsonify({'success': False, 'error': 'Gemini API не настроен. Добавьте GEMINI_API_KEY в .env файл'}), 400
+    
+    data = request.json
+    topic = data.get('topic', '')
+    
+    try:
+        full_prompt = build_video_prompt(topic)
         
-        model = genai.GenerativeModel('gemini-2.0-flash-exp')
-        response = model.generate_content(full_prompt)
+        prompt, cached = generate_with_cache('video-prompt', full_prompt, regenerate=bool(data.get('regenerate')),
+                                             postprocess=str.strip)
         
         return jsonify({
             'success': True,
-            'prompt': response.text.strip()
+            'prompt': prompt,
+            'cached': cached
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
-@app.route('/api/generate-text', methods=['POST'])
-def generate_text():
-    if not gemini_api_key:
-        return jsonify({'success': False, 'error': 'Gemini API не настроен. Добавьте GEMINI_API_KEY в .env файл'}), 400
+def build_caption_prompt(prompt: str, post_size: str, add_hashtags: bool, hashtag_count) -> str:
+    """Промпт Gemini для текста поста с учетом размера и хештегов"""
+    # Определяем размер поста
+    size_descriptions = {
+        'short': 'короткий и лаконичный пост (2-4 предложения, примерно 150-300 символов)',
+        'medium': 'пост средней длины (несколько абзацев, примерно 500-1000 символов)',
+        'long': 'длинный и подробный пост (развернутый текст, примерно 1500-2000 символов, МАКСИМУМ 2200 символов - это лимит Instagram)'
+    }
     
-    data = request.json
-    prompt = data.get('prompt', '')
-    post_size = data.get('post_size', 'medium')  # short, medium, long
-    add_hashtags = data.get('add_hashtags', False)
-    hashtag_count = data.get('hashtag_count', 5)
+    size_description = size_descriptions.get(post_size, size_descriptions['medium'])
     
-    try:
-        # Определяем размер поста
-        size_descriptions = {
-            'short': 'короткий и лаконичный пост (2-4 предложения, примерно 150-300 символов)',
-            'medium': 'пост средней длины (несколько абзацев, примерно 500-1000 символов)',
-            'long': 'длинный и подробный пост (развернутый текст, примерно 1500-2000 символов, МАКСИМУМ 2200 символов - это лимит Instagram)'
-        }
-        
-        size_description = size_descriptions.get(post_size, size_descriptions['medium'])
-        
-        # Формируем промпт с учетом настроек
-        full_prompt = f"""Создай {size_description} для Instagram на тему: {prompt}
+    # Формируем промпт с учетом настроек
+    full_prompt = f"""Создай {size_description} для Instagram на тему: {prompt}
 
 ВАЖНЫЕ ТРЕБОВАНИЯ К ФОРМАТУ:
 - НЕ используй markdown разметку (##, **, _, ~~)
@@ -837,49 +3851,191 @@ def generate_text():
 - Структурируй абзацами для удобства чтения
 - Будь содержательным и интересным
 - Пиши от первого лица или обращайся к аудитории напрямую"""
-        
-        if add_hashtags:
-            full_prompt += f"\n- В конце (через пустую строку) добавь {hashtag_count} релевантных хештегов"
-        
-        full_prompt += "\n\nПомни: это пост для Instagram, а не статья в блоге. Пиши естественно, без излишнего форматирования!"
-        
-        model = genai.GenerativeModel('gemini-2.0-flash-exp')
-        response = model.generate_content(full_prompt)
-        
-        generated_text = response.text
-        
-        # Постобработка: удаляем markdown разметку, если она осталась
-        # Убираем markdown заголовки (## Заголовок)
-        generated_text = re.sub(r'^#{1,6}\s+', '', generated_text, flags=re.MULTILINE)
-        # Убираем жирный текст (**текст**)
-        generated_text = re.sub(r'\*\*(.+?)\*\*', r'\1', generated_text)
-        # Убираем курсив (*текст* или _текст_)
-        generated_text = re.sub(r'\*(.+?)\*', r'\1', generated_text)
-        generated_text = re.sub(r'_(.+?)_', r'\1', generated_text)
-        # Убираем зачеркнутый текст (~~текст~~)
-        generated_text = re.sub(r'~~(.+?)~~', r'\1', generated_text)
+    
+    if add_hashtags:
+        full_prompt += f"\n- В конце (через пустую строку) добавь {hashtag_count} релевантных хештегов"
+    
+    full_prompt += "\n\nПомни: это пост для Instagram, а не статья в блоге. Пиши естественно, без излишнего форматирования!"
+    return full_prompt
+
+def caption_request_params(data: dict):
+    """Промпт Gemini и настройки (часть ключа кэша) из тела запроса текста поста"""
+    post_size = data.get('post_size', 'medium')  # short, medium, long
+    add_hashtags = data.get('add_hashtags', False)
+    hashtag_count = data.get('hashtag_count', 5)
+    full_prompt = build_caption_prompt(data.get('prompt', ''), post_size, add_hashtags, hashtag_count)
+    options = {'post_size': post_size, 'add_hashtags': add_hashtags, 'hashtag_count': hashtag_count}
+    return full_prompt, options
+
+@app.route('/api/generate-text', methods=['POST'])
+def generate_text():
+    if not gemini_api_key:
+        return jsonify({'success': False, 'error': 'Gemini API не настроен. Добавьте GEMINI_API_KEY в .env файл'}), 400
+    
+    data = request.json
+    
+    try:
+        full_prompt, options = caption_request_params(data)
+        generated_text, cached = generate_with_cache('caption', full_prompt, options,
+                                                     regenerate=bool(data.get('regenerate')), postprocess=clean_markdown)
         
         return jsonify({
             'success': True,
-            'text': generated_text
+            'text': generated_text,
+            'cached': cached
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
+@app.route('/api/generate-text-stream', methods=['POST'])
+def generate_text_stream():
+    """
+    Потоковая версия /api/generate-text (Server-Sent Events).
+    
+    События: "data: {text}" с очередным очищенным куском текста,
+    "event: done" с полным текстом и "event: error" при ошибке.
+    Готовый текст кэшируется так же, как в /api/generate-text.
+    """
+    if not gemini_api_key:
+        return jsonify({'success': False, 'error': 'Gemini API не настроен. Добавьте GEMINI_API_KEY в .env файл'}), 400
+    
+    data = request.json
+    full_prompt, options = caption_request_params(data)
+    regenerate = bool(data.get('regenerate'))
+    
+    def events():
+        key, cached_text = gemini_cache_lookup('caption', full_prompt, options, regenerate)
+        if cached_text is not None:
+            yield sse_event({'text': cached_text})
+            yield sse_event({'text': cached_text, 'cached': True}, event='done')
+            return
+        
+        cleaner = MarkdownStreamCleaner()
+        started = time.perf_counter()
+        first_chunk = True
+        try:
+            for chunk in get_gemini_model().generate_content(full_prompt, stream=True):
+                if first_chunk:
+                    first_chunk = False
+                    # Время до первого куска текста - главная метрика потоковой генерации
+                    EXTERNAL_LATENCY.observe(time.perf_counter() - started, service='gemini', operation='caption-stream-first-chunk')
+                piece = cleaner.feed(chunk.text)
+                if piece:
+                    yield sse_event({'text': piece})
+            piece = cleaner.flush()
+            if piece:
+                yield sse_event({'text': piece})
+        except Exception as e:
+            EXTERNAL_ERRORS.inc(service='gemini', operation='caption-stream')
+            print(f"❌ Ошибка потоковой генерации текста: {e}")
+            yield sse_event({'error': str(e)}, event='error')
+            return
+        
+        EXTERNAL_LATENCY.observe(time.perf_counter() - started, service='gemini', operation='caption-stream')
+        # Итоговый текст считается по всему ответу, клиент заменяет им показанные куски
+        generated_text = cleaner.text()
+        gemini_cache.put(key, 'caption', generated_text)
+        yield sse_event({'text': generated_text, 'cached': False}, event='done')
+    
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def build_post_kit_prompt(topic: str, post_size: str, add_hashtags: bool, hashtag_count,
+                          include_image_prompt: bool, include_video_prompt: bool) -> str:
+    """Один промпт Gemini на текст поста и промпты для фото и видео (ответ в JSON)"""
+    sections = [('caption', build_caption_prompt(topic, post_size, add_hashtags, hashtag_count))]
+    if include_image_prompt:
+        sections.append(('image_prompt', build_image_prompt(topic)))
+    if include_video_prompt:
+        sections.append(('video_prompt', build_video_prompt(topic)))
+    
+    parts = ["Выполни для одного поста Instagram несколько заданий. Каждое задание описано ниже отдельно."]
+    for key, task in sections:
+        parts.append(f"=== ЗАДАНИЕ ДЛЯ ПОЛЯ {key} ===\n{task}")
+    keys = ', '.join(f'"{key}"' for key, _ in sections)
+    parts.append(f"Верни ответ ТОЛЬКО как JSON объект с ключами {keys}. "
+                 "Значение каждого ключа - строка с результатом соответствующего задания, без пояснений.")
+    return '\n\n'.join(parts)
+
+def parse_post_kit(raw_text: str, keys: list) -> str:
+    """Проверяет JSON ответ Gemini и применяет ту же постобработку, что и отдельные эндпоинты"""
+    try:
+        kit = json.loads(raw_text)
+    except ValueError:
+        raise ValueError('Gemini вернул некорректный JSON')
+    if not isinstance(kit, dict):
+        raise ValueError('Gemini вернул некорректный JSON')
+    missing = [key for key in keys if not isinstance(kit.get(key), str) or not kit[key].strip()]
+    if missing:
+        raise ValueError(f"В ответе Gemini нет полей: {', '.join(missing)}")
+    
+    result = {'caption': clean_markdown(kit['caption'])}
+    for key in keys[1:]:
+        result[key] = kit[key].strip()
+    return json.dumps(result, ensure_ascii=False)
+
+def post_kit_request_params(data: dict):
+    """Промпт Gemini, настройки (часть ключа кэша) и ожидаемые поля ответа из тела запроса набора поста"""
+    topic = data.get('topic', '')
+    post_size = data.get('post_size', 'medium')  # short, medium, long
+    add_hashtags = data.get('add_hashtags', False)
+    hashtag_count = data.get('hashtag_count', 5)
+    include_image_prompt = data.get('include_image_prompt', True)
+    include_video_prompt = data.get('include_video_prompt', True)
+    
+    keys = ['caption']
+    if include_image_prompt:
+        keys.append('image_prompt')
+    if include_video_prompt:
+        keys.append('video_prompt')
+    
+    full_prompt = build_post_kit_prompt(topic, post_size, add_hashtags, hashtag_count,
+                                        include_image_prompt, include_video_prompt)
+    options = {'post_size': post_size, 'add_hashtags': add_hashtags, 'hashtag_count': hashtag_count}
+    return full_prompt, options, keys
+
+@app.route('/api/generate-post-kit', methods=['POST'])
+def generate_post_kit():
+    """Текст поста, промпт фото и промпт видео за один запрос к Gemini"""
+    if not gemini_api_key:
+        return jsonify({'success': False, 'error': 'Gemini API не настроен. Добавьте GEMINI_API_KEY в .env файл'}), 400
+    
+    data = request.json
+    full_prompt, options, keys = post_kit_request_params(data)
+    
+    try:
+        # Некорректный JSON бывает редко - пробуем еще раз, прежде чем вернуть ошибку
+        for attempt in range(2):
+            try:
+                kit_json, cached = generate_with_cache(
+                    'post-kit', full_prompt, options, regenerate=bool(data.get('regenerate')) or attempt > 0,
+                    postprocess=lambda text: parse_post_kit(text, keys),
+                    generation_config={'response_mime_type': 'application/json'}
+                )
+                break
+            except ValueError as e:
+                print(f"⚠️ Некорректный ответ Gemini для набора поста: {e}")
+                if attempt:
+                    raise
+        
+        return jsonify({'success': True, **json.loads(kit_json), 'cached': cached})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
 # ==================== POST PUBLISHING ====================
 
 @app.route('/api/publish-post', methods=['POST'])
 def publish_post():
-    global ig_client
-    
     # Должны быть выполнены вход и выбран текущий аккаунт
     current_username = session.get('instagram_username')
     if not session.get('instagram_logged_in') or not current_username:
         return jsonify({'success': False, 'error': 'Не выполнен вход в Instagram. Пожалуйста, войдите снова.'}), 401
     
-    # Поднимаем клиент для текущего аккаунта, если глобальный не соответствует/отсутствует
+    # Поднимаем клиент для текущего аккаунта (из кэша или из файла сессии)
     try:
-        ig_client_local = load_client_for_username(current_username)
+        ig_clients.get(current_username)
     except Exception as e:
         print(f"Ошибка загрузки клиента для {current_username}: {e}")
         return jsonify({'success': False, 'error': 'Не удалось загрузить сессию текущего аккаунта'}), 401
@@ -902,19 +4058,7 @@ def publish_post():
                 return jsonify({'success': False, 'error': f'Файл не найден: {path}'}), 400
         
         # Публикуем пост
-        media = None
-        
-        # Если только одно видео
-        if len(video_paths) == 1 and len(photo_paths) == 0:
-            media = ig_client_local.video_upload(video_paths[0], caption)
-        # Если только одно фото
-        elif len(photo_paths) == 1 and len(video_paths) == 0:
-            media = ig_client_local.photo_upload(photo_paths[0], caption)
-        # Если альбом (микс фото и видео)
-        else:
-            # Instagram поддерживает альбомы с миксом фото и видео
-            all_paths = photo_paths + video_paths
-            media = ig_client_local.album_upload(all_paths, caption)
+        media = publish_media(current_username, caption, photo_paths, video_paths)
         
         # Сохраняем в историю
         post_data = {
@@ -927,9 +4071,7 @@ def publish_post():
             'status': 'published'
         }
         
-        history_file = POSTS_DIR / f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(history_file, 'w', encoding='utf-8') as f:
-            json.dump(post_data, f, ensure_ascii=False, indent=2)
+        post_store.add_post(post_data)
         
         return jsonify({
             'success': True,
@@ -983,9 +4125,13 @@ def schedule_post():
             'status': 'scheduled'
         }
         
-        scheduled_file = SCHEDULED_DIR / f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(scheduled_file, 'w', encoding='utf-8') as f:
-            json.dump(post_data, f, ensure_ascii=False, indent=2)
+        post_id = post_store.add_post(post_data)
+        
+        # Добавляем пост в очередь планировщика без пересканирования базы
+        enqueue_scheduled_posts([(post_id, scheduled_time)])
+        
+        # Готовим фото для публикации заранее, в фоне
+        prepare_photos_for_publish([str(PHOTOS_DIR / filename) for filename in photo_filenames], wait=False)
         
         print(f"📅 Пост запланирован на {scheduled_time.strftime('%d.%m.%Y %H:%M')}")
         
@@ -998,30 +4144,259 @@ def schedule_post():
         print(f"❌ Ошибка планирования поста: {e}")
         return jsonify({'success': False, 'error': str(e)}), 400
 
+# ==================== BULK SCHEDULING ====================
+
+# Пакетное планирование контент-плана: CSV или JSON, все строки проверяются
+# до записи, пакет сохраняется одной транзакцией
+SCHEDULE_BATCH_MAX = int(os.getenv('SCHEDULE_BATCH_MAX', '5000'))
+INSTAGRAM_CAPTION_MAX = 2200
+INSTAGRAM_ALBUM_MAX = 10
+# Колонки CSV; списки файлов в ячейке разделяются точкой с запятой
+SCHEDULE_CSV_COLUMNS = ('scheduled_time', 'caption', 'photos', 'videos', 'username')
+
+def parse_schedule_time(value) -> datetime:
+    """Время публикации (локальное, ISO формат); время с часовым поясом переводится в локальное"""
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError('не указано время публикации')
+    try:
+        scheduled_time = datetime.fromisoformat(value.strip())
+    except ValueError:
+        raise ValueError(f'неверный формат даты и времени: {value}')
+    if scheduled_time.tzinfo is not None:
+        scheduled_time = scheduled_time.astimezone().replace(tzinfo=None)
+    if scheduled_time <= datetime.now():
+        raise ValueError('время публикации должно быть в будущем')
+    return scheduled_time
+
+def read_schedule_batch() -> list:
+    """Строки пакета: JSON {"posts": [...]}, CSV в теле запроса или файл (CSV/JSON) в поле file"""
+    upload = request.files.get('file')
+    if upload is not None:
+        content = upload.read().decode('utf-8-sig')
+        is_json = upload.filename.lower().endswith('.json')
+    elif request.is_json:
+        content, is_json = None, True
+    else:
+        content = request.get_data(as_text=True).lstrip('\ufeff')
+        is_json = False
+    
+    if is_json:
+        data = request.get_json(silent=True) if content is None else json.loads(content)
+        rows = data.get('posts') if isinstance(data, dict) else data
+        if not isinstance(rows, list):
+            raise ValueError('Ожидается список постов в поле posts')
+        return rows
+    
+    reader = csv.DictReader(io.StringIO(content))
+    missing = {'scheduled_time'} - set(reader.fieldnames or ())
+    if missing:
+        raise ValueError(f'В CSV нет колонок: {", ".join(sorted(missing))} (ожидаются {", ".join(SCHEDULE_CSV_COLUMNS)})')
+    rows = []
+    for row in reader:
+        for column in ('photos', 'videos'):
+            row[column] = [name.strip() for name in (row.get(column) or '').split(';') if name.strip()]
+        rows.append(row)
+    return rows
+
+def validate_schedule_rows(rows: list, default_username: str):
+    """
+    Проверяет все строки пакета до записи в базу.
+    
+    Возвращает (посты, ошибки); ошибки - список {'row': номер, 'error': текст},
+    нумерация строк с 1.
+    """
+    media_exists = {}
+    accounts = {}
+    
+    def file_exists(directory: Path, name) -> bool:
+        key = (directory, name)
+        if key not in media_exists:
+            media_exists[key] = (isinstance(name, str) and name == Path(name).name
+                                 and not name.startswith('.') and (directory / name).is_file())
+        return media_exists[key]
+    
+    posts = []
+    errors = []
+    created_time = datetime.now().isoformat()
+    for index, row in enumerate(rows, start=1):
+        try:
+            if not isinstance(row, dict):
+                raise ValueError('строка должна быть объектом')
+            scheduled_time = parse_schedule_time(row.get('scheduled_time'))
+            
+            photos = row.get('photos') or []
+            videos = row.get('videos') or []
+            if not isinstance(photos, list) or not isinstance(videos, list):
+                raise ValueError('photos и videos должны быть списками')
+            if not photos and not videos:
+                raise ValueError('не выбраны фотографии или видео')
+            if len(photos) + len(videos) > INSTAGRAM_ALBUM_MAX:
+                raise ValueError(f'в альбоме больше {INSTAGRAM_ALBUM_MAX} файлов')
+            missing = ([name for name in photos if not file_exists(PHOTOS_DIR, name)]
+                       + [name for name in videos if not file_exists(VIDEOS_DIR, name)])
+            if missing:
+                raise ValueError(f'файлы не найдены: {", ".join(map(str, missing))}')
+            
+            caption = row.get('caption') or ''
+            if not isinstance(caption, str):
+                raise ValueError('caption должен быть строкой')
+            if len(caption) > INSTAGRAM_CAPTION_MAX:
+                raise ValueError(f'подпись длиннее {INSTAGRAM_CAPTION_MAX} символов')
+            
+            # Публиковать можно только от аккаунтов с сохраненной сессией
+            username = row.get('username') or default_username
+            if not username:
+                raise ValueError('не указан аккаунт')
+            if username not in accounts:
+                accounts[username] = get_session_file(username).exists()
+            if not accounts[username]:
+                raise ValueError(f'нет сохраненной сессии аккаунта {username}')
+        except ValueError as e:
+            errors.append({'row': index, 'error': str(e)})
+            continue
+        
+        posts.append({
+            'caption': caption,
+            'photos': photos,
+            'videos': videos,
+            'scheduled_time': scheduled_time.isoformat(),
+            'created_time': created_time,
+            'username': username,
+            'status': 'scheduled'
+        })
+    return posts, errors
+
+def read_post_id(value) -> int:
+    if isinstance(value, bool):
+        raise ValueError(f'неверный id поста: {value}')
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'неверный id поста: {value}')
+
+@app.route('/api/schedule-posts', methods=['POST'])
+def schedule_posts_bulk():
+    """
+    Планирует пакет постов (контент-план) из CSV или JSON.
+    
+    Если хотя бы одна строка не проходит проверку, ничего не сохраняется
+    и в ответе перечислены все ошибки.
+    """
+    try:
+        rows = read_schedule_batch()
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'success': False, 'error': f'Не удалось прочитать пакет: {e}'}), 400
+    if not rows:
+        return jsonify({'success': False, 'error': 'Пакет пуст'}), 400
+    if len(rows) > SCHEDULE_BATCH_MAX:
+        return jsonify({'success': False, 'error': f'Слишком много постов в пакете (максимум {SCHEDULE_BATCH_MAX})'}), 400
+    
+    posts, errors = validate_schedule_rows(rows, session.get('instagram_username'))
+    if errors:
+        return jsonify({'success': False, 'error': f'Ошибки в {len(errors)} строках, пакет не сохранен', 'errors': errors}), 400
+    
+    try:
+        post_ids = post_store.add_posts(posts)
+    except Exception as e:
+        print(f"❌ Ошибка сохранения пакета постов: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    # Фото не нормализуем заранее: посты пакета обычно расписаны на недели вперед
+    enqueue_scheduled_posts([(post_id, datetime.fromisoformat(post['scheduled_time']))
+                             for post_id, post in zip(post_ids, posts)])
+    print(f"📅 Запланировано постов пакетом: {len(post_ids)}")
+    return jsonify({'success': True, 'count': len(post_ids), 'post_ids': post_ids})
+
+@app.route('/api/scheduled-posts/reschedule', methods=['POST'])
+def reschedule_posts_bulk():
+    """Переносит запланированные посты: {"posts": [{"post_id": 1, "scheduled_time": "..."}]}"""
+    items = (request.json or {}).get('posts')
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'Не указаны посты'}), 400
+    if len(items) > SCHEDULE_BATCH_MAX:
+        return jsonify({'success': False, 'error': f'Слишком много постов за раз (максимум {SCHEDULE_BATCH_MAX})'}), 400
+    
+    changes = {}
+    errors = []
+    for index, item in enumerate(items, start=1):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('элемент должен быть объектом')
+            changes[read_post_id(item.get('post_id'))] = parse_schedule_time(item.get('scheduled_time'))
+        except ValueError as e:
+            errors.append({'row': index, 'error': str(e)})
+    if errors:
+        return jsonify({'success': False, 'error': f'Ошибки в {len(errors)} строках, посты не перенесены', 'errors': errors}), 400
+    
+    try:
+        updated = post_store.reschedule_posts(list(changes.items()))
+    except Exception as e:
+        print(f"❌ Ошибка переноса постов: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    enqueue_scheduled_posts([(post_id, changes[post_id]) for post_id in updated])
+    updated_set = set(updated)
+    return jsonify({
+        'success': True,
+        'updated': updated,
+        # Не найдены, уже опубликованы/отменены или публикуются прямо сейчас
+        'skipped': [post_id for post_id in changes if post_id not in updated_set]
+    })
+
+@app.route('/api/scheduled-posts/cancel', methods=['POST'])
+def cancel_posts_bulk():
+    """Отменяет запланированные посты: {"post_ids": [1, 2, 3]}"""
+    values = (request.json or {}).get('post_ids')
+    if not isinstance(values, list) or not values:
+        return jsonify({'success': False, 'error': 'Не указаны посты'}), 400
+    if len(values) > SCHEDULE_BATCH_MAX:
+        return jsonify({'success': False, 'error': f'Слишком много постов за раз (максимум {SCHEDULE_BATCH_MAX})'}), 400
+    try:
+        post_ids = list(dict.fromkeys(read_post_id(value) for value in values))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    try:
+        cancelled = post_store.cancel_posts(post_ids)
+    except Exception as e:
+        print(f"❌ Ошибка отмены постов: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    for post_id in cancelled:
+        scheduled_queue.remove(post_id)
+    arm_scheduler()
+    cancelled_set = set(cancelled)
+    return jsonify({
+        'success': True,
+        'cancelled': cancelled,
+        'skipped': [post_id for post_id in post_ids if post_id not in cancelled_set]
+    })
+
 @app.route('/api/posts/history', methods=['GET'])
 def get_posts_history():
+    """
+    История постов с курсорной пагинацией.
+    
+    Query-параметры: limit, cursor, username, status (published/scheduled),
+    from и to (ISO дата или дата-время).
+    """
     try:
-        posts = []
-        
-        # Добавляем опубликованные посты
-        for post_file in sorted(POSTS_DIR.glob('*.json'), reverse=True):
-            with open(post_file, 'r', encoding='utf-8') as f:
-                post_data = json.load(f)
-                # Устанавливаем статус если его нет (для старых постов)
-                if 'status' not in post_data:
-                    post_data['status'] = 'published'
-                posts.append(post_data)
+        limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+        date_to = request.args.get('to') or None
+        # Дата без времени включает весь день
+        if date_to and len(date_to) == 10:
+            date_to += 'T23:59:59.999999'
         
-        # Добавляем запланированные посты
-        for scheduled_file in sorted(SCHEDULED_DIR.glob('*.json'), reverse=True):
-            with open(scheduled_file, 'r', encoding='utf-8') as f:
-                post_data = json.load(f)
-                posts.append(post_data)
+        posts, next_cursor = post_store.list_posts(
+            limit=limit,
+            cursor=request.args.get('cursor') or None,
+            username=request.args.get('username') or None,
+            status=request.args.get('status') or None,
+            date_from=request.args.get('from') or None,
+            date_to=date_to
+        )
         
-        # Сортируем: запланированные по времени публикации, опубликованные по времени публикации
-        posts.sort(key=lambda x: x.get('scheduled_time') or x.get('timestamp') or '', reverse=True)
-        
-        return jsonify({'success': True, 'posts': posts})
+        return jsonify({'success': True, 'posts': posts, 'next_cursor': next_cursor})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 400
 
@@ -1031,7 +4406,56 @@ def get_posts_history():
 def index():
     return render_template('index.html')
 
+# ==================== ENTRY POINTS ====================
+
+def init_storage():
+    """Создает папки данных и один раз переносит старые JSON посты в базу"""
+    for directory in [DATA_DIR, PHOTOS_DIR, VIDEOS_DIR, SESSION_DIR, POSTS_DIR, SCHEDULED_DIR,
+                      NORMALIZED_DIR, MEDIA_TMP_DIR, THUMBS_DIR / 'photos', THUMBS_DIR / 'videos']:
+        directory.mkdir(parents=True, exist_ok=True)
+    imported_count = post_store.import_json_dirs(POSTS_DIR, SCHEDULED_DIR)
+    if imported_count:
+        print(f"📦 Импортировано постов из JSON в базу: {imported_count}")
+
+def create_app(run_scheduler: bool = None) -> Flask:
+    """
+    Приложение для WSGI серверов: gunicorn 'app:create_app()'.
+    
+    Импорт app.py ничего не запускает и не создает на диске: папки данных,
+    пул подготовки фото и планировщик создаются здесь, базы SQLite - при
+    первом обращении. С RUN_SCHEDULER=false веб-процессы только принимают
+    запросы, а посты публикует отдельный процесс: python app.py scheduler
+    """
+    init_storage()
+    start_normalize_pool()
+    start_scheduler(publish=RUN_SCHEDULER if run_scheduler is None else run_scheduler)
+    return app
+
+def run_scheduler_process():
+    """Отдельный процесс автопубликации без веб-сервера"""
+    if SCHEDULER_SYNC_INTERVAL <= 0:
+        print("⚠️ SCHEDULER_SYNC_INTERVAL=0: процесс планировщика не увидит новые посты из веб-процессов")
+    init_storage()
+    start_normalize_pool()
+    start_scheduler(publish=True)
+    # SIGTERM (systemd, docker stop) завершает процесс так же, как Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.shutdown()
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    if sys.argv[1:2] == ['scheduler']:
+        run_scheduler_process()
+    else:
+        # Перезагрузчик Flask выполняет app.py дважды: планировщик запускаем
+        # только в дочернем процессе, который обслуживает запросы
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            create_app()
+        app.run(debug=True, host='0.0.0.0', port=5000)
 
 
@@ -0,0 +1,392 @@
+"""
+ASGI режим сервера: uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+Маршруты, которые почти все время ждут внешние API (Pollinations, Gemini),
+обслуживаются асинхронно: ожидание держит event loop, а не поток, поэтому
+один процесс выдерживает сотни одновременных генераций. Синхронный
+instagrapi (публикация и вход в Instagram) работает в отдельном
+ограниченном пуле потоков, остальные маршруты - то же Flask приложение
+из app.py в общем пуле. JSON контракт API такой же, как у app.run().
+"""
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import httpx
+from a2wsgi import WSGIMiddleware
+
+import app as core
+
+# Потоки для синхронных маршрутов Flask
+ASGI_WSGI_WORKERS = int(os.getenv('ASGI_WSGI_WORKERS', '8'))
+# Потоки для instagrapi: публикация и вход в Instagram
+ASGI_INSTAGRAM_WORKERS = int(os.getenv('ASGI_INSTAGRAM_WORKERS', '4'))
+# Потоки для диска и SQLite внутри асинхронных маршрутов
+ASGI_BLOCKING_WORKERS = int(os.getenv('ASGI_BLOCKING_WORKERS', '4'))
+# Одновременные соединения к внешним API из асинхронных маршрутов
+ASGI_HTTP_MAX_CONNECTIONS = int(os.getenv('ASGI_HTTP_MAX_CONNECTIONS', '200'))
+
+INSTAGRAM_PATHS = ('/api/publish-post', '/api/instagram/login')
+GEMINI_NOT_CONFIGURED = 'Gemini API не настроен. Добавьте GEMINI_API_KEY в .env файл'
+
+flask_routes = WSGIMiddleware(core.app, workers=ASGI_WSGI_WORKERS)
+instagram_routes = WSGIMiddleware(core.app, workers=ASGI_INSTAGRAM_WORKERS)
+blocking_executor = ThreadPoolExecutor(max_workers=ASGI_BLOCKING_WORKERS, thread_name_prefix='asgi-blocking')
+
+async def run_blocking(func, *args):
+    """Выполняет короткую блокирующую операцию (диск, SQLite) вне event loop"""
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, func, *args)
+
+# ==================== HTTP CLIENT ====================
+
+class AsyncHTTPClient:
+    """
+    Асинхронный аналог HostClient для GET запросов: общий пул соединений,
+    те же таймауты по хостам, повторы с jitter и метрики.
+    """
+
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Создается при первом запросе, уже внутри event loop сервера
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=core.HTTP_POOL_SIZE),
+                follow_redirects=True
+            )
+        return self._client
+
+    async def get(self, url: str, params: dict = None, retries: int = core.HTTP_MAX_RETRIES) -> httpx.Response:
+        host = urlparse(url).netloc
+        service = core.external_service_name(host)
+        timeout = httpx.Timeout(core.HTTP_HOST_READ_TIMEOUTS.get(host, core.HTTP_READ_TIMEOUT),
+                                connect=core.HTTP_CONNECT_TIMEOUT)
+
+        for attempt in range(retries + 1):
+            started = time.perf_counter()
+            try:
+                response = await self.client.get(url, params=params, timeout=timeout)
+            except httpx.TransportError as e:
+                core.EXTERNAL_ERRORS.inc(service=service, operation='GET')
+                if attempt >= retries:
+                    raise
+                delay = core.HostClient.backoff_delay(attempt)
+                print(f"🔁 GET {host}: {e.__class__.__name__}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                core.EXTERNAL_LATENCY.observe(time.perf_counter() - started, service=service, operation='GET')
+
+            core.EXTERNAL_BYTES.inc(len(response.content), service=service, direction='down')
+            if response.status_code in core.RETRY_STATUS_CODES and attempt < retries:
+                delay = core.HostClient.backoff_delay(attempt, response)
+                print(f"🔁 GET {host}: HTTP {response.status_code}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                continue
+            if response.status_code >= 400:
+                core.EXTERNAL_ERRORS.inc(service=service, operation='GET')
+            return response
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+http = AsyncHTTPClient(ASGI_HTTP_MAX_CONNECTIONS)
+
+# ==================== PHOTO GENERATION ====================
+
+# Общий на все запросы лимит параллельных вариантов пакета, как пул в app.py
+photo_batch_slots = asyncio.Semaphore(core.PHOTO_BATCH_WORKERS)
+
+async def request_pollinations_photo(prompt: str, width, height, model: str, seed) -> bytes:
+    url, params = core.pollinations_request(prompt, width, height, model, seed)
+    response = await http.get(url, params=params)
+    if response.status_code != 200:
+        raise core.PhotoGenerationError('Ошибка генерации изображения')
+    return response.content
+
+async def generate_photo(data: dict):
+    prompt, width, height, model, seed = core.photo_request_params(data)
+
+    try:
+        content = await request_pollinations_photo(prompt, width, height, model, seed)
+        filename = await run_blocking(core.save_generated_photo, content, prompt, width, height, model, seed)
+
+        return {
+            'success': True,
+            'filename': filename,
+            'url': f'/api/photos/{filename}'
+        }
+    except core.PhotoGenerationError as e:
+        return {'success': False, 'error': str(e)}, 400
+    except Exception as e:
+        print(f"❌ Ошибка при генерации фото: {e}")
+        return {'success': False, 'error': str(e)}, 400
+
+async def generate_batch_variant(prompt: str, index: int, variant: dict) -> dict:
+    async with photo_batch_slots:
+        try:
+            content = await request_pollinations_photo(prompt, variant['width'], variant['height'],
+                                                       variant['model'], variant['seed'])
+            filename = await run_blocking(core.save_generated_photo, content, prompt, variant['width'],
+                                          variant['height'], variant['model'], variant['seed'])
+            return {'success': True, 'index': index, **variant, 'filename': filename, 'url': f'/api/photos/{filename}'}
+        except Exception as e:
+            print(f"❌ Ошибка при генерации варианта #{index}: {e}")
+            return {'success': False, 'index': index, **variant, 'error': str(e)}
+
+async def generate_photo_batch(data: dict):
+    try:
+        prompt, variants = core.batch_request_variants(data)
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}, 400
+
+    print(f"🖼️ Пакетная генерация: {len(variants)} вариантов")
+    # Варианты запускаются сразу и доводятся до конца, даже если клиент отключился
+    tasks = [asyncio.ensure_future(generate_batch_variant(prompt, index, variant))
+             for index, variant in enumerate(variants)]
+
+    async def results():
+        succeeded = 0
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            succeeded += result['success']
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+        yield json.dumps({'done': True, 'total': len(variants), 'succeeded': succeeded}) + '\n'
+
+    return StreamingResponse(results(), 'application/x-ndjson')
+
+# ==================== GEMINI TEXT GENERATION ====================
+
+async def generate_with_cache(kind: str, full_prompt: str, options: dict = None, regenerate: bool = False,
+                              postprocess=None, generation_config: dict = None):
+    """Асинхронная версия app.generate_with_cache (тот же кэш), возвращает (text, cached)"""
+    key, cached_text = await run_blocking(core.gemini_cache_lookup, kind, full_prompt, options, regenerate)
+    if cached_text is not None:
+        return cached_text, True
+
+    with core.track_external('gemini', kind):
+        response = await core.get_gemini_model().generate_content_async(full_prompt, generation_config=generation_config)
+    text = postprocess(response.text) if postprocess else response.text
+    await run_blocking(core.gemini_cache.put, key, kind, text)
+    return text, False
+
+async def generate_topic_prompt(kind: str, build_prompt, data: dict):
+    """Промпт для фото или видео по теме поста"""
+    if not core.gemini_api_key:
+        return {'success': False, 'error': GEMINI_NOT_CONFIGURED}, 400
+
+    try:
+        prompt, cached = await generate_with_cache(kind, build_prompt(data.get('topic', '')),
+                                                   regenerate=bool(data.get('regenerate')), postprocess=str.strip)
+        return {'success': True, 'prompt': prompt, 'cached': cached}
+    except Exception as e:
+        return {'success': False, 'error': str(e)}, 400
+
+async def generate_prompt(data: dict):
+    return await generate_topic_prompt('image-prompt', core.build_image_prompt, data)
+
+async def generate_video_prompt(data: dict):
+    return await generate_topic_prompt('video-prompt', core.build_video_prompt, data)
+
+async def generate_text(data: dict):
+    if not core.gemini_api_key:
+        return {'success': False, 'error': GEMINI_NOT_CONFIGURED}, 400
+
+    try:
+        full_prompt, options = core.caption_request_params(data)
+        generated_text, cached = await generate_with_cache('caption', full_prompt, options,
+                                                           regenerate=bool(data.get('regenerate')),
+                                                           postprocess=core.clean_markdown)
+        return {'success': True, 'text': generated_text, 'cached': cached}
+    except Exception as e:
+        return {'success': False, 'error': str(e)}, 400
+
+async def generate_text_stream(data: dict):
+    """Потоковая генерация текста (SSE), события те же, что в app.generate_text_stream"""
+    if not core.gemini_api_key:
+        return {'success': False, 'error': GEMINI_NOT_CONFIGURED}, 400
+
+    full_prompt, options = core.caption_request_params(data)
+    regenerate = bool(data.get('regenerate'))
+
+    async def events():
+        key, cached_text = await run_blocking(core.gemini_cache_lookup, 'caption', full_prompt, options, regenerate)
+        if cached_text is not None:
+            yield core.sse_event({'text': cached_text})
+            yield core.sse_event({'text': cached_text, 'cached': True}, event='done')
+            return
+
+        cleaner = core.MarkdownStreamCleaner()
+        parts = []
+        started = time.perf_counter()
+        first_chunk = True
+        try:
+            response = await core.get_gemini_model().generate_content_async(full_prompt, stream=True)
+            async for chunk in response:
+                if first_chunk:
+                    first_chunk = False
+                    core.EXTERNAL_LATENCY.observe(time.perf_counter() - started, service='gemini',
+                                                  operation='caption-stream-first-chunk')
+                piece = cleaner.feed(chunk.text)
+                if piece:
+                    parts.append(piece)
+                    yield core.sse_event({'text': piece})
+            piece = cleaner.flush()
+            if piece:
+                parts.append(piece)
+                yield core.sse_event({'text': piece})
+        except Exception as e:
+            core.EXTERNAL_ERRORS.inc(service='gemini', operation='caption-stream')
+            print(f"❌ Ошибка потоковой генерации текста: {e}")
+            yield core.sse_event({'error': str(e)}, event='error')
+            return
+
+        core.EXTERNAL_LATENCY.observe(time.perf_counter() - started, service='gemini', operation='caption-stream')
+        generated_text = ''.join(parts)
+        await run_blocking(core.gemini_cache.put, key, 'caption', generated_text)
+        yield core.sse_event({'text': generated_text, 'cached': False}, event='done')
+
+    return StreamingResponse(events(), 'text/event-stream',
+                             headers={'cache-control': 'no-cache', 'x-accel-buffering': 'no'})
+
+async def generate_post_kit(data: dict):
+    if not core.gemini_api_key:
+        return {'success': False, 'error': GEMINI_NOT_CONFIGURED}, 400
+
+    full_prompt, options, keys = core.post_kit_request_params(data)
+
+    try:
+        # Некорректный JSON бывает редко - пробуем еще раз, прежде чем вернуть ошибку
+        for attempt in range(2):
+            try:
+                kit_json, cached = await generate_with_cache(
+                    'post-kit', full_prompt, options, regenerate=bool(data.get('regenerate')) or attempt > 0,
+                    postprocess=lambda text: core.parse_post_kit(text, keys),
+                    generation_config={'response_mime_type': 'application/json'}
+                )
+                break
+            except ValueError as e:
+                print(f"⚠️ Некорректный ответ Gemini для набора поста: {e}")
+                if attempt:
+                    raise
+
+        return {'success': True, **json.loads(kit_json), 'cached': cached}
+    except Exception as e:
+        return {'success': False, 'error': str(e)}, 400
+
+# ==================== ASGI APPLICATION ====================
+
+# Асинхронные маршруты (POST, JSON тело); все остальное обслуживает Flask
+ASYNC_ROUTES = {
+    '/api/generate-photo': generate_photo,
+    '/api/generate-photo-batch': generate_photo_batch,
+    '/api/generate-prompt': generate_prompt,
+    '/api/generate-video-prompt': generate_video_prompt,
+    '/api/generate-text': generate_text,
+    '/api/generate-text-stream': generate_text_stream,
+    '/api/generate-post-kit': generate_post_kit,
+}
+
+class StreamingResponse:
+    """Потоковый ответ асинхронного маршрута: асинхронный генератор строк"""
+
+    def __init__(self, chunks, content_type: str, headers: dict = None):
+        self.chunks = chunks
+        self.content_type = content_type
+        self.headers = headers or {}
+
+async def read_json(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return json.loads(body) if body else None
+
+def response_start(status: int, content_type: str, headers: dict = None) -> dict:
+    headers = {'content-type': f'{content_type}; charset=utf-8', 'access-control-allow-origin': '*', **(headers or {})}
+    return {
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+    }
+
+async def send_json(send, data: dict, status: int = 200):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    await send(response_start(status, 'application/json', {'content-length': str(len(body))}))
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_stream(send, response: StreamingResponse):
+    await send(response_start(200, response.content_type, response.headers))
+    async for chunk in response.chunks:
+        await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def handle_async_route(handler, scope, receive, send):
+    started = time.perf_counter()
+    try:
+        data = await read_json(receive)
+    except ValueError:
+        data = None
+
+    if not isinstance(data, dict):
+        result = {'success': False, 'error': 'Ожидается JSON объект в теле запроса'}, 400
+    else:
+        try:
+            result = await handler(data)
+        except Exception as e:
+            print(f"❌ Ошибка в {scope['path']}: {e}")
+            result = {'success': False, 'error': str(e)}, 500
+
+    # Как и в Flask, длительность считается до начала отправки ответа
+    status = result[1] if isinstance(result, tuple) else 200
+    core.ROUTE_LATENCY.observe(time.perf_counter() - started, endpoint=scope['path'], method='POST')
+    if status >= 500:
+        core.ROUTE_ERRORS.inc(endpoint=scope['path'], method='POST', status=status)
+
+    if isinstance(result, StreamingResponse):
+        await send_stream(send, result)
+    elif isinstance(result, tuple):
+        await send_json(send, *result)
+    else:
+        await send_json(send, result)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Фоновые задачи запускаются при старте сервера, а не при импорте
+            core.create_app()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await http.aclose()
+            blocking_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if scope['type'] == 'http':
+        handler = ASYNC_ROUTES.get(scope['path'])
+        if handler is not None and scope['method'] == 'POST':
+            await handle_async_route(handler, scope, receive, send)
+            return
+        if scope['path'] in INSTAGRAM_PATHS:
+            await instagram_routes(scope, receive, send)
+            return
+
+    await flask_routes(scope, receive, send)
@@ -0,0 +1,171 @@
+"""
+Общие части бенчмарков: изолированная копия приложения, HTTP сервер
+приложения, нагрузочный прогон и статистика задержек.
+"""
+
+import importlib
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from werkzeug.serving import make_server
+
+from bench.stubs import FakeGeminiModel, FakeInstagramClient, StubServer, StubState
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+def load_app(args):
+    """
+    Импортирует копию app.py из временной папки, направив внешние API на заглушки.
+
+    app.py хранит данные рядом с собой (data/), поэтому копия не трогает
+    настоящую библиотеку и историю.
+    """
+    workdir = Path(tempfile.mkdtemp(prefix='bench-'))
+    for module in ('app.py', 'asgi.py'):
+        shutil.copy(REPO_DIR / module, workdir / module)
+    for directory in ('templates', 'static'):
+        shutil.copytree(REPO_DIR / directory, workdir / directory)
+
+    state = StubState(
+        pollinations_latency=args.pollinations_latency,
+        segmind_latency=args.segmind_latency,
+        status_polls=args.status_polls
+    )
+    stub = StubServer(state).start()
+
+    os.environ.update({
+        'POLLINATIONS_API_URL': stub.pollinations_url,
+        'KLING_API_URL': stub.kling_url,
+        'SEGMIND_API_KEY': 'bench',
+        'GEMINI_API_KEY': 'bench',
+        # Интервалы между публикациями в бенчмарке только мешают измерениям
+        'PUBLISH_MIN_SPACING': '0',
+        'PUBLISH_CATCHUP_SPACING': '0',
+        'SEGMIND_POLL_MAX_INTERVAL': '0.2',
+    })
+    sys.path.insert(0, str(workdir))
+    os.chdir(workdir)
+    app = importlib.import_module('app')
+
+    app.SEGMIND_POLL_MIN_INTERVAL = 0.05
+    # Пауза перед configure ждет обработки файлов настоящим Instagram
+    app.CONFIGURE_DELAY = 0
+    app.gemini_model = FakeGeminiModel(latency=args.gemini_latency)
+    app.load_client_for_username = lambda username: FakeInstagramClient(latency=args.instagram_latency)
+    # Заглушка не хранит состояния запросов, отдельный клиент на загрузку ей не нужен
+    app.upload_worker_client = lambda client: client
+    # Папки данных и пул процессов подготовки фото, как в create_app()
+    app.init_storage()
+    app.start_normalize_pool()
+    # Планировщик вызывается сценариями напрямую, фоновый job не должен вмешиваться
+    app.scheduler.start(paused=True)
+    app.publishing_enabled.set()
+    return app, stub, workdir
+
+class AppServer:
+    """Настоящий HTTP сервер приложения (многопоточный, как app.run)"""
+
+    def __init__(self, flask_app):
+        self.server = make_server('127.0.0.1', 0, flask_app, threaded=True)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+class ASGIServer:
+    """uvicorn с asgi:application (ASGI режим) в фоновом потоке"""
+
+    def __init__(self):
+        import uvicorn
+        asgi = importlib.import_module('asgi')
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.base_url = f'http://127.0.0.1:{self.socket.getsockname()[1]}'
+        self.server = uvicorn.Server(uvicorn.Config(asgi.application, log_level='warning', timeout_keep_alive=75))
+        self._thread = threading.Thread(target=self.server.run, kwargs={'sockets': [self.socket]}, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self._thread.join()
+
+def app_server(app, mode: str):
+    """Сервер приложения: wsgi - как app.run, asgi - uvicorn asgi:application"""
+    return ASGIServer() if mode == 'asgi' else AppServer(app.app)
+
+def percentile(sorted_values: list, p: float):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(latencies: list, errors: int = 0, wall_time: float = None) -> dict:
+    """Сводка по задержкам (мс) и пропускной способности"""
+    values = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    summary = {
+        'requests': len(values) + errors,
+        'errors': errors,
+        'mean_ms': ms(sum(values) / len(values)) if values else None,
+        'p50_ms': ms(percentile(values, 50)),
+        'p95_ms': ms(percentile(values, 95)),
+        'p99_ms': ms(percentile(values, 99)),
+        'max_ms': ms(values[-1]) if values else None,
+    }
+    if wall_time:
+        summary['wall_time_s'] = round(wall_time, 3)
+        summary['throughput_rps'] = round(len(values) / wall_time, 2)
+    return summary
+
+def run_load(call, requests: int, concurrency: int) -> dict:
+    """Выполняет call(i) requests раз в concurrency потоков и возвращает сводку"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def one(index: int):
+        started = time.perf_counter()
+        try:
+            call(index)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    summary = summarize(latencies, len(errors), time.perf_counter() - started)
+    summary['concurrency'] = concurrency
+    if errors:
+        summary['first_error'] = errors[0]
+    return summary
+
+def time_calls(call, repeat: int) -> dict:
+    """Последовательно замеряет call() repeat раз"""
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - started)
+    return summarize(latencies)
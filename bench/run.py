@@ -0,0 +1,143 @@
+"""
+Бенчмарки приложения без обращений к платным API.
+
+Pollinations, Segmind, Gemini и Instagram заменяются локальными заглушками
+с настраиваемой задержкой. Каждый сценарий запускается в отдельном процессе
+на копии приложения во временной папке, данные в data/ не затрагиваются.
+
+Примеры:
+    python -m bench.run
+    python -m bench.run --scenario scheduler --quick
+    python -m bench.run --scenario endpoints --server asgi --concurrency 200
+    python -m bench.run --gemini-latency 1.5 --output bench/results/baseline.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from bench.harness import REPO_DIR, load_app
+from bench.scenarios import SCENARIOS
+
+def parse_sizes(value: str) -> list:
+    return [int(size) for size in value.split(',') if size]
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Бенчмарки с заглушками внешних API')
+    parser.add_argument('--scenario', choices=['all', *SCENARIOS], default='all')
+    parser.add_argument('--output', help='Путь к JSON отчету (по умолчанию bench/results/<время>.json)')
+    parser.add_argument('--quick', action='store_true', help='Меньше запросов и размеров - для быстрой проверки')
+    parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi',
+                        help='Сервер для сценария endpoints: wsgi - как app.run, asgi - uvicorn asgi:application')
+
+    latency = parser.add_argument_group('задержки заглушек, секунды')
+    latency.add_argument('--pollinations-latency', type=float, default=0.2)
+    latency.add_argument('--segmind-latency', type=float, default=0.5)
+    latency.add_argument('--gemini-latency', type=float, default=0.3)
+    latency.add_argument('--instagram-latency', type=float, default=0.2)
+    latency.add_argument('--status-polls', type=int, default=2, help='Сколько опросов статуса до готовности видео')
+
+    load = parser.add_argument_group('нагрузка')
+    load.add_argument('--requests', type=int, default=40, help='Запросов на каждый эндпоинт')
+    load.add_argument('--video-requests', type=int, default=6, help='Задач генерации видео на каждый режим')
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--repeat', type=int, default=50, help='Повторов для последовательных замеров')
+    load.add_argument('--due-posts', type=int, default=20, help='Наступивших постов в сценарии планировщика')
+    load.add_argument('--scheduler-sizes', type=parse_sizes, default=[100, 1000, 10000])
+    load.add_argument('--library-sizes', type=parse_sizes, default=[100, 1000, 5000])
+
+    parser.add_argument('--child-output', help=argparse.SUPPRESS)
+    return parser
+
+def apply_quick(args):
+    args.requests = min(args.requests, 10)
+    args.video_requests = min(args.video_requests, 2)
+    args.repeat = min(args.repeat, 10)
+    args.scheduler_sizes = [size for size in args.scheduler_sizes if size <= 1000] or [100]
+    args.library_sizes = [size for size in args.library_sizes if size <= 1000] or [100]
+
+def run_child(args):
+    """Один сценарий в текущем процессе, результат - в файл --child-output"""
+    app, stub, workdir = load_app(args)
+    try:
+        result = SCENARIOS[args.scenario](app, stub, args)
+    finally:
+        stub.stop()
+    Path(args.child_output).write_text(json.dumps(result, ensure_ascii=False), encoding='utf-8')
+
+def child_args(args) -> list:
+    """Аргументы командной строки для процесса одного сценария (уже с учетом --quick)"""
+    values = {
+        '--server': args.server,
+        '--pollinations-latency': args.pollinations_latency,
+        '--segmind-latency': args.segmind_latency,
+        '--gemini-latency': args.gemini_latency,
+        '--instagram-latency': args.instagram_latency,
+        '--status-polls': args.status_polls,
+        '--requests': args.requests,
+        '--video-requests': args.video_requests,
+        '--concurrency': args.concurrency,
+        '--repeat': args.repeat,
+        '--due-posts': args.due_posts,
+        '--scheduler-sizes': ','.join(map(str, args.scheduler_sizes)),
+        '--library-sizes': ','.join(map(str, args.library_sizes)),
+    }
+    return [str(item) for option, value in values.items() for item in (option, value)]
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.quick:
+        apply_quick(args)
+
+    if args.child_output:
+        run_child(args)
+        return
+
+    scenarios = list(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    report = {
+        'meta': {
+            'started': datetime.now().isoformat(),
+            'git_commit': git_commit(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'args': {key: value for key, value in vars(args).items() if key not in ('output', 'child_output')},
+        },
+        'scenarios': {}
+    }
+
+    for name in scenarios:
+        print(f'▶️ Сценарий {name}')
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as tmp:
+            child_output = tmp.name
+        started = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, '-m', 'bench.run', *child_args(args), '--scenario', name, '--child-output', child_output],
+            cwd=REPO_DIR
+        )
+        if completed.returncode != 0:
+            report['scenarios'][name] = {'error': f'процесс сценария завершился с кодом {completed.returncode}'}
+            continue
+        report['scenarios'][name] = json.loads(Path(child_output).read_text(encoding='utf-8'))
+        report['scenarios'][name]['duration_s'] = round(time.perf_counter() - started, 2)
+        Path(child_output).unlink(missing_ok=True)
+
+    output = Path(args.output) if args.output else REPO_DIR / 'bench' / 'results' / f"{datetime.now():%Y%m%d_%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+    print(f'✅ Отчет сохранен: {output}')
+
+if __name__ == '__main__':
+    main()
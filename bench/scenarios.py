@@ -0,0 +1,185 @@
+"""
+Сценарии бенчмарков. Каждый получает загруженное приложение (с заглушками
+вместо внешних API) и возвращает словарь с результатами для отчета.
+"""
+
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import requests
+
+from bench.harness import app_server, run_load, time_calls
+
+def session_cookie(app, username: str = 'bench') -> dict:
+    """Подписанная cookie Flask-сессии залогиненного аккаунта"""
+    serializer = app.app.session_interface.get_signing_serializer(app.app)
+    value = serializer.dumps({'instagram_logged_in': True, 'instagram_username': username})
+    return {app.app.config['SESSION_COOKIE_NAME']: value}
+
+def check_response(response: requests.Response):
+    if response.status_code >= 400:
+        raise RuntimeError(f'HTTP {response.status_code}: {response.text[:200]}')
+    return response
+
+def wait_for_job(http: requests.Session, base_url: str, job_id: str, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = check_response(http.get(f'{base_url}/api/jobs/{job_id}')).json()
+        if job['status'] == 'done':
+            return job
+        if job['status'] == 'failed':
+            raise RuntimeError(job['error'])
+        time.sleep(0.02)
+    raise TimeoutError(f'Задача {job_id} не завершилась за {timeout} с')
+
+def scenario_endpoints(app, stub, args) -> dict:
+    """Задержки и пропускная способность эндпоинтов под параллельной нагрузкой"""
+    photo_name, _ = app.media_store.put_bytes('photos', stub.state.image, '.jpg')
+    cookies = session_cookie(app)
+    results = {}
+
+    with app_server(app, args.server) as server:
+        base = server.base_url
+        http = requests.Session()
+        http.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency * 2))
+
+        def post_json(path: str, body: dict, **kwargs):
+            return check_response(http.post(f'{base}{path}', json=body, **kwargs))
+
+        cases = {
+            'generate_photo': lambda i: post_json('/api/generate-photo', {'prompt': f'bench photo {uuid.uuid4().hex}'}),
+            'generate_photo_batch_4': lambda i: post_json(
+                '/api/generate-photo-batch', {'prompt': f'bench batch {uuid.uuid4().hex}', 'count': 4}).content,
+            'generate_text_miss': lambda i: post_json('/api/generate-text', {'prompt': f'bench {uuid.uuid4().hex}'}),
+            'generate_text_hit': lambda i: post_json('/api/generate-text', {'prompt': 'bench cached topic'}),
+            'generate_text_stream': lambda i: post_json(
+                '/api/generate-text-stream', {'prompt': f'bench {uuid.uuid4().hex}'}).content,
+            'generate_post_kit': lambda i: post_json('/api/generate-post-kit', {'topic': f'bench {uuid.uuid4().hex}'}),
+            'list_photos_page': lambda i: check_response(http.get(f'{base}/api/photos?limit=100')),
+            'posts_history_page': lambda i: check_response(http.get(f'{base}/api/posts/history?limit=50')),
+            'publish_post': lambda i: post_json(
+                '/api/publish-post', {'caption': 'bench', 'photos': [photo_name]}, cookies=cookies),
+        }
+        for name, call in cases.items():
+            print(f'  {name}...')
+            results[name] = run_load(call, args.requests, args.concurrency)
+
+        # Видео: от отправки задачи до готового файла, для каждого режима ответа Segmind
+        for mode in ('binary', 'url', 'status'):
+            stub.state.segmind_mode = mode
+            print(f'  generate_video_{mode}...')
+
+            def video(i):
+                job = post_json('/api/generate-video', {'prompt': f'bench video {i}', 'duration': '5'}).json()
+                wait_for_job(http, base, job['job_id'])
+
+            results[f'generate_video_{mode}'] = run_load(video, args.video_requests, min(args.concurrency, 3))
+
+    results['stub_requests'] = dict(stub.state.requests)
+    return results
+
+def scenario_scheduler(app, stub, args) -> dict:
+    """Стоимость прохода планировщика в зависимости от числа постов в очереди"""
+    photo_name, _ = app.media_store.put_bytes('photos', stub.state.image, '.jpg')
+    results = []
+    far_future = datetime.now() + timedelta(days=30)
+    queued = 0
+
+    for size in args.scheduler_sizes:
+        print(f'  {size} постов в очереди...')
+        while queued < size:
+            scheduled_time = far_future + timedelta(seconds=queued)
+            post_id = app.post_store.add_post({
+                'caption': 'bench', 'photos': [photo_name], 'videos': [],
+                'scheduled_time': scheduled_time.isoformat(), 'created_time': datetime.now().isoformat(),
+                'username': f'account{queued % 10}', 'status': 'scheduled'
+            })
+            app.scheduled_queue.push(post_id, scheduled_time)
+            queued += 1
+
+        # Загрузка очереди из базы при старте
+        load = time_calls(lambda: app.ScheduledPostQueue().load(app.post_store), repeat=3)
+
+        # Проход без наступивших постов - так планировщик работает почти всегда
+        idle_tick = time_calls(app.check_and_publish_scheduled_posts, repeat=args.repeat)
+
+        # Проход с наступившими постами разных аккаунтов
+        due_count = min(args.due_posts, size)
+        now = datetime.now()
+        for index in range(due_count):
+            post_id = app.post_store.add_post({
+                'caption': 'bench due', 'photos': [photo_name], 'videos': [],
+                'scheduled_time': now.isoformat(), 'created_time': now.isoformat(),
+                'username': f'due{index}', 'status': 'scheduled'
+            })
+            app.scheduled_queue.push(post_id, now)
+        published_before = app.scheduled_publisher.stats()['published']
+        started = time.perf_counter()
+        app.check_and_publish_scheduled_posts()
+        dispatch_time = time.perf_counter() - started
+        # Остальные посты раздаются по мере освобождения слотов пула
+        while app.scheduled_publisher.stats()['published'] - published_before < due_count:
+            app.check_and_publish_scheduled_posts()
+            time.sleep(0.005)
+        drain_time = time.perf_counter() - started
+
+        results.append({
+            'queued_posts': size,
+            'queue_load': load,
+            'idle_tick': idle_tick,
+            'due_posts': due_count,
+            'due_dispatch_ms': round(dispatch_time * 1000, 3),
+            'due_drain_s': round(drain_time, 3),
+        })
+    return {'sizes': results}
+
+def scenario_library(app, stub, args) -> dict:
+    """Стоимость /api/photos и /api/posts/history в зависимости от размера библиотеки"""
+    client = app.app.test_client()
+    results = []
+    photos = 0
+    posts = 0
+
+    for size in args.library_sizes:
+        print(f'  {size} фото и постов...')
+        # Файлы создаются напрямую, без генерации: важен только размер библиотеки
+        while photos < size:
+            stem = f'20240101_{photos:06d}_bench'
+            (app.PHOTOS_DIR / f'{stem}.jpg').write_bytes(b'\xff\xd8\xff\xd9')
+            with open(app.PHOTOS_DIR / f'{stem}.json', 'w', encoding='utf-8') as f:
+                json.dump({'prompt': 'bench', 'timestamp': stem}, f)
+            photos += 1
+        while posts < size:
+            published_time = (datetime(2024, 1, 1) + timedelta(minutes=posts)).isoformat()
+            app.post_store.add_post({
+                'caption': 'bench', 'photos': [], 'videos': [], 'status': 'published',
+                'timestamp': published_time, 'published_time': published_time,
+                'username': f'account{posts % 10}'
+            })
+            posts += 1
+
+        def get(path: str):
+            response = client.get(path)
+            if response.status_code != 200:
+                raise RuntimeError(f'HTTP {response.status_code}: {path}')
+
+        cold_index = time_calls(
+            lambda: app.MediaLibraryIndex(app.PHOTOS_DIR, '.jpg', '/api/photos').page(100), repeat=3)
+        results.append({
+            'library_size': size,
+            'photo_index_cold_build': cold_index,
+            'list_photos_page': time_calls(lambda: get('/api/photos?limit=100'), repeat=args.repeat),
+            'list_photos_all': time_calls(lambda: get('/api/photos'), repeat=max(3, args.repeat // 10)),
+            'posts_history_page': time_calls(lambda: get('/api/posts/history?limit=50'), repeat=args.repeat),
+            'posts_history_filtered': time_calls(
+                lambda: get('/api/posts/history?limit=50&username=account3&status=published'), repeat=args.repeat),
+        })
+    return {'sizes': results}
+
+SCENARIOS = {
+    'endpoints': scenario_endpoints,
+    'scheduler': scenario_scheduler,
+    'library': scenario_library,
+}
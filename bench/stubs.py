@@ -0,0 +1,261 @@
+"""
+Локальные заглушки внешних сервисов для бенчмарков.
+
+- StubServer: HTTP сервер, отвечающий как Pollinations (GET /prompt/...)
+  и Segmind kling-2 (POST /v1/kling-2) в режимах binary, url и status.
+- FakeGeminiModel: замена genai.GenerativeModel (обычный, JSON и потоковый ответ,
+  синхронно и асинхронно).
+- FakeInstagramClient: замена instagrapi.Client для публикаций.
+
+Задержки всех заглушек настраиваются, чтобы измерять накладные расходы
+самого приложения, а не платных API.
+"""
+
+import asyncio
+import io
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+SEGMIND_MODES = ('binary', 'url', 'status')
+
+def make_jpeg(width: int = 1024, height: int = 1024) -> bytes:
+    """JPEG с шумом, чтобы размер был похож на настоящую генерацию"""
+    image = Image.effect_noise((width, height), 64).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+class StubState:
+    """Настройки и счетчики заглушек (общие для всех потоков сервера)"""
+
+    def __init__(self, pollinations_latency: float = 0.0, segmind_latency: float = 0.0,
+                 segmind_mode: str = 'binary', status_polls: int = 2, video_size: int = 2 * 1024 * 1024):
+        self.pollinations_latency = pollinations_latency
+        self.segmind_latency = segmind_latency
+        self.segmind_mode = segmind_mode
+        self.status_polls = status_polls
+        self.video = b'\x00\x00\x00\x18ftypmp42' + b'\x00' * (video_size - 12)
+        self.image = make_jpeg()
+        self.requests = {'pollinations': 0, 'segmind': 0, 'status': 0, 'file': 0}
+        self._polls = {}
+        self._lock = threading.Lock()
+
+    def count(self, key: str):
+        with self._lock:
+            self.requests[key] += 1
+
+    def poll(self, task_id: str) -> bool:
+        """True, когда задача "готова" (после status_polls опросов)"""
+        with self._lock:
+            self._polls[task_id] = self._polls.get(task_id, 0) + 1
+            return self._polls[task_id] > self.status_polls
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self) -> StubState:
+        return self.server.state
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data: dict, status: int = 200):
+        self._send(status, json.dumps(data).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        if self.path.startswith('/prompt/'):
+            self.state.count('pollinations')
+            time.sleep(self.state.pollinations_latency)
+            self._send(200, self.state.image, 'image/jpeg')
+        elif self.path.startswith('/status/'):
+            self.state.count('status')
+            task_id = self.path.rsplit('/', 1)[-1]
+            if self.state.poll(task_id):
+                self._send_json({'status': 'COMPLETED', 'video_url': f'{self.server.base_url}/file/{task_id}'})
+            else:
+                self._send_json({'status': 'PROCESSING'})
+        elif self.path.startswith('/file/'):
+            self.state.count('file')
+            self._send(200, self.state.video, 'video/mp4')
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        # Читаем тело целиком (в т.ч. chunked), как настоящий API
+        length = self.headers.get('Content-Length')
+        if length:
+            self.rfile.read(int(length))
+        elif self.headers.get('Transfer-Encoding') == 'chunked':
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                self.rfile.read(size + 2)
+                if size == 0:
+                    break
+
+        if not self.path.startswith('/v1/kling-2'):
+            self._send_json({'error': 'not found'}, status=404)
+            return
+
+        self.state.count('segmind')
+        time.sleep(self.state.segmind_latency)
+        task_id = uuid.uuid4().hex
+        if self.state.segmind_mode == 'binary':
+            self._send(200, self.state.video, 'video/mp4')
+        elif self.state.segmind_mode == 'url':
+            self._send_json({'video_url': f'{self.server.base_url}/file/{task_id}'})
+        else:
+            self._send_json({'status_url': f'{self.server.base_url}/status/{task_id}'})
+
+class StubServer:
+    """HTTP сервер заглушек Pollinations и Segmind в фоновом потоке"""
+
+    def __init__(self, state: StubState):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = state
+        self.httpd.base_url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.state = state
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return self.httpd.base_url
+
+    @property
+    def pollinations_url(self) -> str:
+        return self.base_url
+
+    @property
+    def kling_url(self) -> str:
+        return f'{self.base_url}/v1/kling-2'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class FakeGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+class FakeGeminiModel:
+    """Замена genai.GenerativeModel: отвечает после latency секунд"""
+
+    CAPTION = ('Утро начинается с чашки кофе и тишины. ☕ Пока город просыпается, '
+               'есть время подумать о планах и просто насладиться моментом.\n\n'
+               '#утро #кофе #настроение')
+    PROMPT = 'Cozy morning scene, cup of coffee on a wooden table, soft window light, photorealistic'
+
+    def __init__(self, latency: float = 0.0, stream_chunks: int = 8):
+        self.latency = latency
+        self.stream_chunks = stream_chunks
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _text(self, generation_config) -> str:
+        if generation_config and generation_config.get('response_mime_type') == 'application/json':
+            return json.dumps({'caption': self.CAPTION, 'image_prompt': self.PROMPT, 'video_prompt': self.PROMPT},
+                              ensure_ascii=False)
+        return self.CAPTION
+
+    def generate_content(self, prompt: str, generation_config: dict = None, stream: bool = False):
+        with self._lock:
+            self.calls += 1
+        text = self._text(generation_config)
+        if stream:
+            return self._stream(text)
+        time.sleep(self.latency)
+        return FakeGeminiResponse(text)
+
+    def _stream(self, text: str):
+        # Общая задержка распределяется по кускам, как при настоящей генерации
+        size = max(1, len(text) // self.stream_chunks)
+        for start in range(0, len(text), size):
+            time.sleep(self.latency / self.stream_chunks)
+            yield FakeGeminiResponse(text[start:start + size])
+
+    async def generate_content_async(self, prompt: str, generation_config: dict = None, stream: bool = False):
+        with self._lock:
+            self.calls += 1
+        text = self._text(generation_config)
+        if stream:
+            return self._stream_async(text)
+        await asyncio.sleep(self.latency)
+        return FakeGeminiResponse(text)
+
+    async def _stream_async(self, text: str):
+        size = max(1, len(text) // self.stream_chunks)
+        for start in range(0, len(text), size):
+            await asyncio.sleep(self.latency / self.stream_chunks)
+            yield FakeGeminiResponse(text[start:start + size])
+
+class FakeMedia:
+    def __init__(self):
+        self.pk = str(uuid.uuid4().int)[:19]
+
+class FakeInstagramClient:
+    """Замена instagrapi.Client: публикация занимает latency секунд"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.uploads = 0
+
+    def load_settings(self, path):
+        pass
+
+    def dump_settings(self, path):
+        pass
+
+    def _upload(self, *args, **kwargs) -> FakeMedia:
+        time.sleep(self.latency)
+        self.uploads += 1
+        return FakeMedia()
+
+    photo_upload = _upload
+    video_upload = _upload
+    album_upload = _upload
+
+    # Загрузка файлов и configure по отдельности (карусели и заранее загруженные посты)
+    last_response = None
+    last_json = {}
+
+    def photo_rupload(self, path, upload_id: str = '', to_album: bool = False):
+        time.sleep(self.latency)
+        return upload_id or str(int(time.time() * 1000)), 1080, 1350
+
+    def _configure(self, caption: str, media_type: int) -> dict:
+        self.uploads += 1
+        media = FakeMedia()
+        return {'media': {
+            'pk': media.pk, 'id': f'{media.pk}_1', 'code': 'bench', 'taken_at': int(time.time()),
+            'media_type': media_type, 'product_type': '', 'user': {'pk': '1', 'username': 'bench'},
+            'caption': {'text': caption}, 'like_count': 0, 'carousel_media': []
+        }}
+
+    def photo_configure(self, upload_id, width, height, caption: str) -> dict:
+        return self._configure(caption, 1)
+
+    def video_configure(self, upload_id, width, height, duration, thumbnail, caption: str) -> dict:
+        return self._configure(caption, 2)
+
+    def album_configure(self, children: list, caption: str) -> dict:
+        return self._configure(caption, 8)
+
+    def expose(self):
+        pass
@@ -215,9 +215,12 @@ document.getElementById('generate-post-btn').addEventListener('click', async ()
     btn.innerHTML = '<span class="loading"></span> Создание поста...';
     
     try {
-        // Step 1: Generate text
+        // Step 1: Generate text and auto prompts with one Gemini call
         showStatus(statusDiv, '📝 Генерация текста...', 'loading');
-        const postText = await generatePostText(topic);
+        const autoPhotoPrompt = includePhoto && document.getElementById('auto-prompt-photo').checked;
+        const autoVideoPrompt = includeVideo && document.getElementById('auto-prompt-video').checked;
+        const postKit = await generatePostKit(topic, autoPhotoPrompt, autoVideoPrompt);
+        const postText = postKit.caption;
         
         const generatedMedia = [];
         
@@ -226,8 +229,8 @@ document.getElementById('generate-post-btn').addEventListener('click', async ()
             showStatus(statusDiv, '🎨 Подготовка фото...', 'loading');
             let photoPrompt;
             
-            if (document.getElementById('auto-prompt-photo').checked) {
-                photoPrompt = await generateAutoPrompt(topic);
+            if (autoPhotoPrompt) {
+                photoPrompt = postKit.image_prompt;
             } else {
                 photoPrompt = document.getElementById('manual-photo-prompt').value.trim();
                 if (!photoPrompt) {
@@ -248,8 +251,8 @@ document.getElementById('generate-post-btn').addEventListener('click', async ()
             showStatus(statusDiv, '🎬 Подготовка видео...', 'loading');
             let videoPrompt;
             
-            if (document.getElementById('auto-prompt-video').checked) {
-                videoPrompt = await generateVideoPrompt(topic);
+            if (autoVideoPrompt) {
+                videoPrompt = postKit.video_prompt;
             } else {
                 videoPrompt = document.getElementById('manual-video-prompt').value.trim();
                 if (!videoPrompt) {
@@ -277,34 +280,89 @@ document.getElementById('generate-post-btn').addEventListener('click', async ()
     }
 });
 
-// Generate post text
-async function generatePostText(topic) {
+// Generate post text (streamed over SSE, onChunk receives the text so far)
+async function generatePostText(topic, regenerate = false, onChunk = null) {
     const postSize = document.getElementById('create-post-size').value;
     const addHashtags = document.getElementById('create-add-hashtags').checked;
     const hashtagCount = parseInt(document.getElementById('create-hashtag-count').value);
     
-    const response = await fetch('/api/generate-text', {
+    const response = await fetch('/api/generate-text-stream', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
             prompt: topic,
             post_size: postSize,
             add_hashtags: addHashtags,
-            hashtag_count: hashtagCount
+            hashtag_count: hashtagCount,
+            regenerate
+        })
+    });
+    
+    if (!response.ok) {
+        const data = await response.json();
+        throw new Error(data.error || 'Ошибка генерации текста');
+    }
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let text = '';
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        // Events are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            
+            let eventName = 'message';
+            let payload = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) eventName = line.slice(7);
+                else if (line.startsWith('data: ')) payload += line.slice(6);
+            });
+            const data = JSON.parse(payload);
+            
+            if (eventName === 'error') throw new Error(data.error || 'Ошибка генерации текста');
+            if (eventName === 'done') return data.text;
+            text += data.text;
+            if (onChunk) onChunk(text);
+        }
+    }
+    
+    throw new Error('Генерация текста прервана');
+}
+
+// Generate caption, photo prompt and video prompt with one request
+async function generatePostKit(topic, includeImagePrompt, includeVideoPrompt) {
+    const response = await fetch('/api/generate-post-kit', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            topic,
+            post_size: document.getElementById('create-post-size').value,
+            add_hashtags: document.getElementById('create-add-hashtags').checked,
+            hashtag_count: parseInt(document.getElementById('create-hashtag-count').value),
+            include_image_prompt: includeImagePrompt,
+            include_video_prompt: includeVideoPrompt
         })
     });
     
     const data = await response.json();
     if (!data.success) throw new Error(data.error || 'Ошибка генерации текста');
-    return data.text;
+    return data;
 }
 
 // Generate auto prompt for photo
-async function generateAutoPrompt(topic) {
+async function generateAutoPrompt(topic, regenerate = false) {
     const response = await fetch('/api/generate-prompt', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ topic })
+        body: JSON.stringify({ topic, regenerate })
     });
     
     const data = await response.json();
@@ -313,11 +371,11 @@ async function generateAutoPrompt(topic) {
 }
 
 // Generate auto prompt for video
-async function generateVideoPrompt(topic) {
+async function generateVideoPrompt(topic, regenerate = false) {
     const response = await fetch('/api/generate-video-prompt', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ topic })
+        body: JSON.stringify({ topic, regenerate })
     });
     
     const data = await response.json();
@@ -368,7 +426,27 @@ async function generatePostVideo(prompt) {
     
     const data = await response.json();
     if (!data.success) throw new Error(data.error || 'Ошибка генерации видео');
-    return { filename: data.filename, url: data.url };
+    const result = await waitForJob(data.job_id);
+    return { filename: result.filename, url: result.url };
+}
+
+// Wait for background job (video generation runs as a job on the server)
+async function waitForJob(jobId, intervalMs = 3000) {
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, intervalMs));
+        let data;
+        try {
+            const response = await fetch(`/api/jobs/${jobId}`);
+            data = await response.json();
+        } catch (error) {
+            // Временная ошибка сети - продолжаем ждать
+            console.error('Error polling job:', error);
+            continue;
+        }
+        if (!data.success) throw new Error(data.error || 'Задача не найдена');
+        if (data.status === 'done') return data.result;
+        if (data.status === 'failed') throw new Error(data.error || 'Ошибка генерации видео');
+    }
 }
 
 // Show preview section
@@ -512,7 +590,10 @@ document.getElementById('regenerate-text-btn').addEventListener('click', async (
     btn.innerHTML = '<span class="loading"></span> Генерация...';
     
     try {
-        const newText = await generatePostText(currentPostTopic);
+        const newText = await generatePostText(currentPostTopic, true, partialText => {
+            document.getElementById('preview-caption').value = partialText;
+            document.getElementById('preview-caption-display').textContent = partialText;
+        });
         document.getElementById('preview-caption').value = newText;
         document.getElementById('preview-caption-display').textContent = newText;
         updateCaptionCharCount(); // Update character count
@@ -539,7 +620,7 @@ document.getElementById('generate-another-photo-btn').addEventListener('click',
         let photoPrompt;
         
         if (document.getElementById('auto-prompt-photo').checked) {
-            photoPrompt = await generateAutoPrompt(currentPostTopic);
+            photoPrompt = await generateAutoPrompt(currentPostTopic, true);
         } else {
             photoPrompt = document.getElementById('manual-photo-prompt').value.trim();
             if (!photoPrompt) {
@@ -576,7 +657,7 @@ document.getElementById('generate-another-video-btn').addEventListener('click',
         let videoPrompt;
         
         if (document.getElementById('auto-prompt-video').checked) {
-            videoPrompt = await generateVideoPrompt(currentPostTopic);
+            videoPrompt = await generateVideoPrompt(currentPostTopic, true);
         } else {
             videoPrompt = document.getElementById('manual-video-prompt').value.trim();
             if (!videoPrompt) {
@@ -801,34 +882,58 @@ async function loadLibrary() {
     showLibraryPhotos(); // Default to photos
 }
 
-async function loadPhotos() {
+const LIBRARY_PAGE_SIZE = 100;
+let photosNextCursor = null;
+let videosNextCursor = null;
+
+async function loadPhotos(append = false) {
     try {
-        const response = await fetch('/api/photos');
+        const params = new URLSearchParams({ limit: LIBRARY_PAGE_SIZE });
+        if (append && photosNextCursor) {
+            params.set('cursor', photosNextCursor);
+        }
+        const response = await fetch('/api/photos?' + params.toString());
         const data = await response.json();
         
         if (data.success) {
-            allPhotos = data.photos;
-            console.log('Загружено фотографий:', data.photos.length);
+            allPhotos = append ? allPhotos.concat(data.photos) : data.photos;
+            photosNextCursor = data.next_cursor;
+            console.log('Загружено фотографий:', allPhotos.length);
         }
     } catch (error) {
         console.error('Error loading photos:', error);
     }
 }
 
-async function loadVideos() {
+async function loadVideos(append = false) {
     try {
-        const response = await fetch('/api/videos');
+        const params = new URLSearchParams({ limit: LIBRARY_PAGE_SIZE });
+        if (append && videosNextCursor) {
+            params.set('cursor', videosNextCursor);
+        }
+        const response = await fetch('/api/videos?' + params.toString());
         const data = await response.json();
         
         if (data.success) {
-            allVideos = data.videos;
-            console.log('Загружено видео:', data.videos.length);
+            allVideos = append ? allVideos.concat(data.videos) : data.videos;
+            videosNextCursor = data.next_cursor;
+            console.log('Загружено видео:', allVideos.length);
         }
     } catch (error) {
         console.error('Error loading videos:', error);
     }
 }
 
+document.getElementById('library-load-more-btn').addEventListener('click', async () => {
+    if (currentLibraryView === 'videos') {
+        await loadVideos(true);
+        showLibraryVideos();
+    } else {
+        await loadPhotos(true);
+        showLibraryPhotos();
+    }
+});
+
 function showLibraryPhotos() {
     currentLibraryView = 'photos';
     displayLibraryMedia(allPhotos, 'photo');
@@ -841,6 +946,8 @@ function showLibraryVideos() {
 
 function displayLibraryMedia(items, type) {
     const grid = document.getElementById('library-grid');
+    const nextCursor = type === 'video' ? videosNextCursor : photosNextCursor;
+    document.getElementById('library-load-more-btn').style.display = nextCursor ? 'inline-block' : 'none';
     
     if (items.length === 0) {
         const mediaType = type === 'video' ? 'видео' : 'фото';
@@ -850,8 +957,8 @@ function displayLibraryMedia(items, type) {
     
     grid.innerHTML = items.map((item, index) => {
         const mediaElement = type === 'video'
-            ? `<video src="${item.url}" style="width: 100%; height: 100%; object-fit: cover;"></video>`
-            : `<img src="${item.url}" alt="${item.filename}">`;
+            ? videoThumbnailHTML(item)
+            : photoThumbnailHTML(item);
         
         return `
             <div class="photo-item" data-media-index="${index}" data-media-type="${type}">
@@ -874,6 +981,30 @@ function displayLibraryMedia(items, type) {
     });
 }
 
+// Thumbnails: сетка грузит уменьшенные копии вместо оригиналов
+function thumbnailSrcset(item, ext) {
+    if (!item.thumbnails) return '';
+    return Object.entries(item.thumbnails).map(([width, urls]) => `${urls[ext]} ${width}w`).join(', ');
+}
+
+function photoThumbnailHTML(item) {
+    if (!item.thumbnails) {
+        return `<img src="${item.url}" alt="${item.filename}">`;
+    }
+    const sizes = '(max-width: 600px) 50vw, 240px';
+    return `
+        <picture>
+            <source type="image/webp" srcset="${thumbnailSrcset(item, 'webp')}" sizes="${sizes}">
+            <img src="${item.thumbnails['480'].jpg}" srcset="${thumbnailSrcset(item, 'jpg')}" sizes="${sizes}" alt="${item.filename}" loading="lazy">
+        </picture>
+    `;
+}
+
+function videoThumbnailHTML(item) {
+    const poster = item.thumbnails ? item.thumbnails['480'].jpg : '';
+    return `<video src="${item.url}" poster="${poster}" preload="none" style="width: 100%; height: 100%; object-fit: cover;"></video>`;
+}
+
 function showMediaDetail(filename, prompt, timestamp, type) {
     const modal = document.getElementById('detail-modal');
     const imageElement = document.getElementById('detail-image');
@@ -922,12 +1053,14 @@ function showModalPhotos() {
     const grid = document.getElementById('modal-photo-grid');
     const previewFilenames = previewMedia.filter(m => m.type === 'photo').map(m => m.filename);
     
+    document.getElementById('modal-load-more-btn').style.display = photosNextCursor ? 'inline-block' : 'none';
+    
     grid.innerHTML = allPhotos.map(photo => `
         <div class="photo-item ${previewFilenames.includes(photo.filename) ? 'selected' : ''}" 
              data-filename="${photo.filename}"
              data-type="photo"
              onclick="toggleMediaSelection('${photo.filename}', '${photo.url}', 'photo')">
-            <img src="${photo.url}" alt="${photo.filename}">
+            ${photoThumbnailHTML(photo)}
         </div>
     `).join('');
 }
@@ -937,16 +1070,29 @@ function showModalVideos() {
     const grid = document.getElementById('modal-photo-grid');
     const previewFilenames = previewMedia.filter(m => m.type === 'video').map(m => m.filename);
     
+    document.getElementById('modal-load-more-btn').style.display = videosNextCursor ? 'inline-block' : 'none';
+    
     grid.innerHTML = allVideos.map(video => `
         <div class="photo-item ${previewFilenames.includes(video.filename) ? 'selected' : ''}" 
              data-filename="${video.filename}"
              data-type="video"
              onclick="toggleMediaSelection('${video.filename}', '${video.url}', 'video')">
-            <video src="${video.url}" style="width: 100%; height: 100%; object-fit: cover;"></video>
+            ${videoThumbnailHTML(video)}
         </div>
     `).join('');
 }
 
+// Модалка показывает ту же постраничную библиотеку, что и страница "Библиотека"
+document.getElementById('modal-load-more-btn').addEventListener('click', async () => {
+    if (currentModalView === 'videos') {
+        await loadVideos(true);
+        showModalVideos();
+    } else {
+        await loadPhotos(true);
+        showModalPhotos();
+    }
+});
+
 function toggleMediaSelection(filename, url, type) {
     const index = previewMedia.findIndex(m => m.filename === filename && m.type === type);
     
@@ -970,21 +1116,35 @@ document.getElementById('confirm-selection-btn').addEventListener('click', () =>
 
 // ==================== HISTORY ====================
 
-async function loadHistory() {
+let historyPosts = [];
+let historyNextCursor = null;
+
+async function loadHistory(append = false) {
     try {
-        const response = await fetch('/api/posts/history');
+        const params = new URLSearchParams();
+        if (append && historyNextCursor) {
+            params.set('cursor', historyNextCursor);
+        }
+        const response = await fetch('/api/posts/history?' + params.toString());
         const data = await response.json();
         
         if (data.success) {
-            displayHistory(data.posts);
+            historyPosts = append ? historyPosts.concat(data.posts) : data.posts;
+            historyNextCursor = data.next_cursor;
+            displayHistory(historyPosts);
         }
     } catch (error) {
         console.error('Error loading history:', error);
     }
 }
 
+document.getElementById('history-load-more-btn').addEventListener('click', () => {
+    loadHistory(true);
+});
+
 function displayHistory(posts) {
     const container = document.getElementById('history-list');
+    document.getElementById('history-load-more-btn').style.display = historyNextCursor ? 'inline-block' : 'none';
     
     if (posts.length === 0) {
         container.innerHTML = '<p style="color: var(--text-secondary);">История постов пуста</p>';
@@ -1004,6 +1164,10 @@ function displayHistory(posts) {
             const scheduledDate = new Date(post.scheduled_time);
             dateDisplay = `Запланировано на: ${scheduledDate.toLocaleString('ru-RU')}`;
             statusBadge = '<span style="background: var(--tertiary); color: white; padding: 4px 12px; border-radius: 12px; font-size: 12px; font-weight: bold;">📅 ЗАПЛАНИРОВАН</span>';
+        } else if (status === 'cancelled') {
+            const scheduledDate = new Date(post.scheduled_time);
+            dateDisplay = `Было запланировано на: ${scheduledDate.toLocaleString('ru-RU')}`;
+            statusBadge = '<span style="background: var(--text-secondary); color: white; padding: 4px 12px; border-radius: 12px; font-size: 12px; font-weight: bold;">🚫 ОТМЕНЕН</span>';
         } else {
             // Используем published_time если есть, иначе timestamp
             const publishedTime = post.published_time || post.timestamp;
@@ -1216,8 +1380,9 @@ document.getElementById('content-generate-video-btn').addEventListener('click',
         const data = await response.json();
         
         if (data.success) {
+            const result = await waitForJob(data.job_id);
             showStatus(statusDiv, '✅ Видео создано и сохранено в библиотеке!', 'success');
-            previewVid.src = data.url;
+            previewVid.src = result.url;
             previewDiv.style.display = 'block';
             
             // Обновляем библиотеку
@@ -1251,20 +1416,29 @@ document.getElementById('i2v-remove-image-btn').addEventListener('click', () =>
 // Show I2V Image Selection Modal
 function showI2VImageModal() {
     const modal = document.getElementById('i2v-image-modal');
+    renderI2VImageGrid();
+    modal.classList.add('show');
+}
+
+function renderI2VImageGrid() {
     const grid = document.getElementById('i2v-image-grid');
+    document.getElementById('i2v-load-more-btn').style.display = photosNextCursor ? 'inline-block' : 'none';
     
-    // Отображаем все фото
+    // Отображаем загруженные страницы фото
     grid.innerHTML = allPhotos.map(photo => `
         <div class="photo-item ${selectedI2VImage && selectedI2VImage.filename === photo.filename ? 'selected' : ''}" 
              data-filename="${photo.filename}"
              onclick="selectI2VImage('${photo.filename}', '${photo.url}')">
-            <img src="${photo.url}" alt="${photo.filename}">
+            ${photoThumbnailHTML(photo)}
         </div>
     `).join('');
-    
-    modal.classList.add('show');
 }
 
+document.getElementById('i2v-load-more-btn').addEventListener('click', async () => {
+    await loadPhotos(true);
+    renderI2VImageGrid();
+});
+
 // Select image for I2V
 function selectI2VImage(filename, url) {
     selectedI2VImage = { filename, url };
@@ -1332,8 +1506,9 @@ document.getElementById('i2v-generate-btn').addEventListener('click', async () =
         const data = await response.json();
         
         if (data.success) {
+            const result = await waitForJob(data.job_id);
             showStatus(statusDiv, '✅ Видео создано из изображения и сохранено в библиотеке!', 'success');
-            previewVid.src = data.url;
+            previewVid.src = result.url;
             previewDiv.style.display = 'block';
             
             // Обновляем библиотеку